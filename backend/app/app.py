@@ -7,17 +7,21 @@ from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 
+from app.middleware import CompressionMiddleware, TracingMiddleware
 from app.routes import router
 
 app = FastAPI()
 app.include_router(router)
+app.add_middleware(CompressionMiddleware)
 app.add_middleware(
     CORSMiddleware,  # type: ignore
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
+app.add_middleware(TracingMiddleware)  # type: ignore
 
 
 @app.exception_handler(RequestValidationError)
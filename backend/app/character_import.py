@@ -0,0 +1,325 @@
+import asyncio
+import codecs
+import json
+import time
+from typing import Any, AsyncGenerator, AsyncIterator, Optional
+
+from pydantic import ValidationError
+
+from database.database import Database
+from datamodels.models import (
+    Character,
+    CharacterCreate,
+    CharacterImportError,
+    CharacterImportResult,
+)
+from jobs.handlers import character_jobs
+from jobs.workers import job_workers
+from utils.consts import IMPORT_BATCH_SIZE, IMPORT_MAX_ERRORS, IMPORT_MAX_ROW_BYTES
+from utils.metrics import IMPORT_BATCH_DURATION, IMPORTED_ROWS
+
+# A parsed row: its position, its value and why it could not be parsed
+Row = tuple[int, Any, Optional[str]]
+
+WHITESPACE = " \t\n\r"
+
+
+class ImportAborted(Exception):
+    """Exception raised when the rest of an upload cannot be parsed."""
+
+
+async def ndjson_rows(
+    chunks: AsyncIterator[bytes], max_row_bytes: int = IMPORT_MAX_ROW_BYTES
+) -> AsyncGenerator[Row, None]:
+    """Parses newline-delimited JSON, one line after another.
+
+    Lines that are not valid JSON or longer than `max_row_bytes` are
+    rejected, the following lines are still parsed. Only one line is kept
+    in memory at a time.
+
+    Args:
+        chunks (AsyncIterator[bytes]): The chunks of the upload.
+        max_row_bytes (int, optional): The maximum length of a line.
+            Defaults to IMPORT_MAX_ROW_BYTES.
+
+    Yields:
+        Row: The line number, the parsed line and the parse error, if any.
+    """
+    buffer = b""
+    line_number = 0
+    oversized = False
+
+    async for chunk in chunks:
+        *lines, buffer = (buffer + chunk).split(b"\n")
+        for line in lines:
+            line_number += 1
+            if oversized or len(line) > max_row_bytes:
+                oversized = False
+                yield line_number, None, f"Longer than {max_row_bytes} bytes."
+            elif line.strip():
+                yield _parse_line(line_number, line)
+        if len(buffer) > max_row_bytes:
+            # The rest of the line is dropped until its end arrives
+            oversized, buffer = True, b""
+
+    if oversized:
+        yield line_number + 1, None, f"Longer than {max_row_bytes} bytes."
+    elif buffer.strip():
+        yield _parse_line(line_number + 1, buffer)
+
+
+def _parse_line(line_number: int, line: bytes) -> Row:
+    """Parses a line of NDJSON.
+
+    Args:
+        line_number (int): The line number.
+        line (bytes): The line.
+
+    Returns:
+        Row: The line number, the parsed line and the parse error, if any.
+    """
+    try:
+        return line_number, json.loads(line), None
+    except ValueError as exc:
+        return line_number, None, f"Invalid JSON: {exc}"
+
+
+async def json_array_rows(
+    chunks: AsyncIterator[bytes], max_row_bytes: int = IMPORT_MAX_ROW_BYTES
+) -> AsyncGenerator[Row, None]:
+    """Parses the elements of a JSON array, one after another.
+
+    Only the element being parsed is kept in memory, so the array may be
+    larger than the memory of the app.
+
+    Args:
+        chunks (AsyncIterator[bytes]): The chunks of the upload.
+        max_row_bytes (int, optional): The maximum length of an element.
+            Defaults to IMPORT_MAX_ROW_BYTES.
+
+    Yields:
+        Row: The position of the element (from 1), the element and None.
+
+    Raises:
+        ImportAborted: If the upload is not a JSON array or an element is
+            invalid JSON or too long, the array cannot be parsed further.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    text = ""
+    # Whether the array started, and whether an element or a separator is next
+    started, expect_element, ended = False, True, False
+    position = 0
+
+    async def _chunks() -> AsyncGenerator[tuple[bytes, bool], None]:
+        async for chunk in chunks:
+            yield chunk, False
+        yield b"", True
+
+    async for chunk, final in _chunks():
+        try:
+            text += utf8.decode(chunk, final)
+        except UnicodeDecodeError as exc:
+            raise ImportAborted(f"Invalid UTF-8: {exc}")
+        index = 0
+        while True:
+            while index < len(text) and text[index] in WHITESPACE:
+                index += 1
+            if index == len(text):
+                break
+            if ended:
+                raise ImportAborted("Unexpected data after the end of the array.")
+            if not started:
+                if text[index] != "[":
+                    raise ImportAborted("The upload is not a JSON array.")
+                started = True
+                index += 1
+            elif text[index] == "]" and (not expect_element or position == 0):
+                ended = True
+                index += 1
+            elif not expect_element:
+                if text[index] != ",":
+                    raise ImportAborted(
+                        f"Expected ',' or ']' after element {position}."
+                    )
+                expect_element = True
+                index += 1
+            else:
+                try:
+                    element, end = decoder.raw_decode(text, index)
+                except json.JSONDecodeError as exc:
+                    if final:
+                        raise ImportAborted(
+                            f"Invalid JSON in element {position + 1}: {exc}"
+                        )
+                    if len(text) - index > max_row_bytes:
+                        raise ImportAborted(
+                            f"Element {position + 1} is longer than "
+                            f"{max_row_bytes} bytes."
+                        )
+                    break
+                # A number at the end of a chunk may continue in the next one
+                if end == len(text) and not final:
+                    break
+                # A character takes at most 4 bytes, only long ones are encoded
+                if end - index > max_row_bytes // 4 and (
+                    len(text[index:end].encode()) > max_row_bytes
+                ):
+                    raise ImportAborted(
+                        f"Element {position + 1} is longer than "
+                        f"{max_row_bytes} bytes."
+                    )
+                position += 1
+                expect_element = False
+                index = end
+                yield position, element, None
+        text = text[index:]
+
+    if not ended:
+        raise ImportAborted("The JSON array is incomplete.")
+
+
+class CharacterImporter:
+    """Imports characters streamed in NDJSON or as a JSON array.
+
+    Rows are validated as `CharacterCreate` and inserted in batches, every
+    batch in one transaction (see `Database.create_many`). Batches are
+    validated and inserted in a thread, while the next batch is parsed, so
+    at most two batches are in memory, however large the upload is.
+    Rejected rows are counted, the first `max_errors` of them reported.
+
+    Attributes:
+        db (Database): The database to import into.
+        enqueue_jobs (bool): Whether to enqueue the jobs creating the
+            embeddings and personality summaries of imported characters.
+        batch_size (int): The number of rows inserted per transaction.
+        max_errors (int): The maximum number of reported rejected rows.
+        max_row_bytes (int): The maximum size of a row.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        enqueue_jobs: bool = False,
+        batch_size: int = IMPORT_BATCH_SIZE,
+        max_errors: int = IMPORT_MAX_ERRORS,
+        max_row_bytes: int = IMPORT_MAX_ROW_BYTES,
+    ) -> None:
+        """Initializes the CharacterImporter.
+
+        Args:
+            db (Database): The database to import into.
+            enqueue_jobs (bool, optional): Whether to enqueue the jobs
+                preparing imported characters for chats. Defaults to False.
+            batch_size (int, optional): The number of rows inserted per
+                transaction. Defaults to IMPORT_BATCH_SIZE.
+            max_errors (int, optional): The maximum number of reported
+                rejected rows. Defaults to IMPORT_MAX_ERRORS.
+            max_row_bytes (int, optional): The maximum size of a row.
+                Defaults to IMPORT_MAX_ROW_BYTES.
+        """
+        self.db = db
+        self.enqueue_jobs = enqueue_jobs
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+        self.max_row_bytes = max_row_bytes
+        self.result = CharacterImportResult()
+
+    async def run(self, chunks: AsyncIterator[bytes]) -> CharacterImportResult:
+        """Imports the characters of an upload.
+
+        The format is detected from the first character: a JSON array starts
+        with '[', anything else is parsed as NDJSON.
+
+        Args:
+            chunks (AsyncIterator[bytes]): The chunks of the upload.
+
+        Returns:
+            CharacterImportResult: What was imported and what was rejected.
+        """
+        first, chunks = await _peek(chunks)
+        parse = json_array_rows if first == b"[" else ndjson_rows
+        batch: list[Row] = []
+        inserting: Optional[asyncio.Task] = None
+        try:
+            async for row in parse(chunks, self.max_row_bytes):
+                batch.append(row)
+                if len(batch) >= self.batch_size:
+                    if inserting is not None:
+                        await inserting
+                    inserting = asyncio.create_task(
+                        asyncio.to_thread(self._import_batch, batch)
+                    )
+                    batch = []
+        except ImportAborted as exc:
+            self.result.error = str(exc)
+        finally:
+            if inserting is not None:
+                await inserting
+        if batch:
+            await asyncio.to_thread(self._import_batch, batch)
+        return self.result
+
+    def _import_batch(self, batch: list[Row]) -> None:
+        """Validates and inserts a batch of rows.
+
+        Args:
+            batch (list[Row]): The parsed rows.
+        """
+        start = time.perf_counter()
+        characters = []
+        for position, value, error in batch:
+            errors = [error] if error else []
+            if not errors:
+                try:
+                    character = CharacterCreate.model_validate(value)
+                    characters.append(character.model_dump())
+                except ValidationError as exc:
+                    errors = [
+                        f"{'.'.join(map(str, item['loc'])) or 'row'}: {item['msg']}"
+                        for item in exc.errors()
+                    ]
+            if errors:
+                self.result.failed += 1
+                if len(self.result.errors) < self.max_errors:
+                    self.result.errors.append(
+                        CharacterImportError(row=position, errors=errors)
+                    )
+
+        character_ids = self.db.create_many(Character, characters)
+        self.result.imported += len(character_ids)
+        if self.enqueue_jobs and character_ids:
+            self.result.jobs += len(job_workers.enqueue(character_jobs(character_ids)))
+        IMPORTED_ROWS.labels("imported").inc(len(character_ids))
+        IMPORTED_ROWS.labels("rejected").inc(len(batch) - len(characters))
+        IMPORT_BATCH_DURATION.observe(time.perf_counter() - start)
+
+
+async def _peek(
+    chunks: AsyncIterator[bytes],
+) -> tuple[bytes, AsyncIterator[bytes]]:
+    """Reads the first non-whitespace byte of a stream without consuming it.
+
+    Args:
+        chunks (AsyncIterator[bytes]): The chunks of the stream.
+
+    Returns:
+        tuple[bytes, AsyncIterator[bytes]]: The byte (empty if the stream is
+            empty or whitespace) and the chunks of the whole stream.
+    """
+    read: list[bytes] = []
+    first = b""
+    async for chunk in chunks:
+        read.append(chunk)
+        stripped = chunk.lstrip()
+        if stripped:
+            first = stripped[:1]
+            break
+
+    async def _replay() -> AsyncGenerator[bytes, None]:
+        for chunk in read:
+            yield chunk
+        async for chunk in chunks:
+            yield chunk
+
+    return first, _replay()
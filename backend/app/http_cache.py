@@ -0,0 +1,87 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+from fastapi import Request
+
+from utils.metrics import CONDITIONAL_REQUESTS, VERSIONED_CACHE
+
+
+def is_not_modified(request: Request, etag: str, route: str) -> bool:
+    """Checks if the response cached by the client is still current.
+
+    Conditional requests are counted in the metrics, so the share of
+    `not_modified` results is the revalidation hit rate of the route.
+
+    Args:
+        request (Request): The HTTP request, with an optional `If-None-Match`.
+        etag (str): The current entity tag of the response, e.g. '"42"'.
+        route (str): The name of the route in the metrics.
+
+    Returns:
+        bool: True if the client may reuse its response (304 Not Modified).
+    """
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return False
+    # Weak comparison, as for GET requests (RFC 9110, section 13.1.2)
+    tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    not_modified = "*" in tags or etag.removeprefix("W/") in tags
+    CONDITIONAL_REQUESTS.labels(
+        route, "not_modified" if not_modified else "modified"
+    ).inc()
+    return not_modified
+
+
+class VersionedCache:
+    """LRU cache of serialized responses that are valid for one data version.
+
+    Entries are looked up by key and version, e.g. the shape of a query and
+    the version of the queried table. An entry of another version is stale
+    and replaced, so writes invalidate the cache without being tracked.
+
+    Attributes:
+        name (str): The name of the cache in the metrics.
+        max_size (int): The maximum number of cached responses.
+    """
+
+    def __init__(self, name: str, max_size: int) -> None:
+        """Initializes an empty VersionedCache.
+
+        Args:
+            name (str): The name of the cache in the metrics.
+            max_size (int): The maximum number of cached responses.
+        """
+        self.name = name
+        self.max_size = max_size
+        self._entries: OrderedDict[Hashable, tuple[int, bytes]] = OrderedDict()
+        # Sync routes run in threads
+        self._lock = threading.Lock()
+
+    def get_or_load(
+        self, key: Hashable, version: int, load: Callable[[], bytes]
+    ) -> bytes:
+        """Returns the cached response of a key, loading it if needed.
+
+        Args:
+            key (Hashable): The key of the response.
+            version (int): The current version of the data.
+            load (Callable[[], bytes]): Loads and serializes the response.
+
+        Returns:
+            bytes: The response body.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                VERSIONED_CACHE.labels(self.name, "hit").inc()
+                return entry[1]
+        VERSIONED_CACHE.labels(self.name, "miss" if entry is None else "stale").inc()
+        body = load()
+        with self._lock:
+            self._entries[key] = (version, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return body
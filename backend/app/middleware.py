@@ -0,0 +1,228 @@
+import asyncio
+import gzip
+from collections import OrderedDict
+from functools import partial
+from typing import Callable, Optional
+
+import brotli
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from utils.consts import (
+    COMPRESSION_BROTLI_QUALITY,
+    COMPRESSION_CACHE_SIZE,
+    COMPRESSION_GZIP_LEVEL,
+    COMPRESSION_MIN_BYTES,
+)
+from utils.metrics import COMPRESSED_RESPONSES, COMPRESSION_BYTES
+from utils.tracing import tracer
+
+# Supported content encodings, preferred first if the client accepts several
+ENCODINGS = ("br", "gzip")
+
+# Larger bodies are compressed in a thread, so they do not block the loop
+THREAD_MIN_BYTES = 256 * 1024
+
+
+class TracingMiddleware:
+    """ASGI middleware that runs every HTTP request within a root span.
+
+    The span covers the whole response, including streamed bodies, and
+    its trace ID is returned to the client in the `X-Trace-Id` header.
+
+    Attributes:
+        app (ASGIApp): The wrapped ASGI app.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        """Initializes the middleware.
+
+        Args:
+            app (ASGIApp): The wrapped ASGI app.
+        """
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Handles an ASGI request.
+
+        Args:
+            scope (Scope): The ASGI connection scope.
+            receive (Receive): The ASGI receive channel.
+            send (Send): The ASGI send channel.
+        """
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with tracer.span(
+            f"{scope['method']} {scope['path']}", method=scope["method"]
+        ) as span:
+
+            async def send_with_trace_id(message: Message) -> None:
+                if message["type"] == "http.response.start":
+                    span.set_attribute("status_code", message["status"])
+                    message["headers"] = [
+                        *message.get("headers", []),
+                        (b"x-trace-id", span.trace_id.encode()),
+                    ]
+                await send(message)
+
+            await self.app(scope, receive, send_with_trace_id)
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """Picks the content encoding of a response from `Accept-Encoding`.
+
+    Args:
+        accept_encoding (str): The `Accept-Encoding` header of the request.
+
+    Returns:
+        Optional[str]: The supported encoding with the highest quality value,
+            None if the client accepts none of them.
+    """
+    qualities: dict[str, float] = {}
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding.strip()] = quality
+    default = qualities.get("*", 0.0)
+    best = max(ENCODINGS, key=lambda coding: qualities.get(coding, default))
+    return best if qualities.get(best, default) > 0 else None
+
+
+class CompressionMiddleware:
+    """ASGI middleware that compresses responses with brotli or gzip.
+
+    The encoding is negotiated from the `Accept-Encoding` header of the
+    request. Only complete bodies of at least `minimum_size` bytes are
+    compressed: streamed responses, e.g. chat event streams, are sent as
+    they are produced, and responses that already have a `Content-Encoding`
+    are left alone. A response with an `ETag` has the same body until its
+    tag changes, so its compressed body is kept and reused for the last
+    `cache_size` such responses.
+
+    Attributes:
+        app (ASGIApp): The wrapped ASGI app.
+        minimum_size (int): The minimum body size in bytes to compress.
+        gzip_level (int): The gzip compression level (1-9).
+        brotli_quality (int): The brotli compression quality (0-11).
+        cache_size (int): The number of compressed bodies kept for reuse.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = COMPRESSION_MIN_BYTES,
+        gzip_level: int = COMPRESSION_GZIP_LEVEL,
+        brotli_quality: int = COMPRESSION_BROTLI_QUALITY,
+        cache_size: int = COMPRESSION_CACHE_SIZE,
+    ) -> None:
+        """Initializes the middleware.
+
+        Args:
+            app (ASGIApp): The wrapped ASGI app.
+            minimum_size (int, optional): The minimum body size in bytes to
+                compress. Defaults to COMPRESSION_MIN_BYTES.
+            gzip_level (int, optional): The gzip compression level.
+                Defaults to COMPRESSION_GZIP_LEVEL.
+            brotli_quality (int, optional): The brotli compression quality.
+                Defaults to COMPRESSION_BROTLI_QUALITY.
+            cache_size (int, optional): The number of compressed bodies kept
+                for reuse. Defaults to COMPRESSION_CACHE_SIZE.
+        """
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.cache_size = cache_size
+        self._cache: OrderedDict[tuple[str, bytes, Optional[str], str], bytes] = (
+            OrderedDict()
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Handles an ASGI request.
+
+        Args:
+            scope (Scope): The ASGI connection scope.
+            receive (Receive): The ASGI receive channel.
+            send (Send): The ASGI send channel.
+        """
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        # The response start is held back until the first body tells its size
+        start: Optional[Message] = None
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if start is None:
+                await send(message)
+                return
+            response_start, start = start, None
+            body = message.get("body", b"")
+            complete = not message.get("more_body", False)
+            if complete and len(body) >= self.minimum_size:
+                headers = MutableHeaders(raw=response_start["headers"])
+                headers.add_vary_header("Accept-Encoding")
+                if "content-encoding" not in headers:
+                    etag = headers.get("etag")
+                    key = (scope["path"], scope["query_string"], etag, encoding)
+                    compressed = self._cache.get(key) if etag else None
+                    if compressed is None:
+                        compressed = await self._compress(encoding, body)
+                        if etag and self.cache_size > 0:
+                            self._cache[key] = compressed
+                            if len(self._cache) > self.cache_size:
+                                self._cache.popitem(last=False)
+                    else:
+                        self._cache.move_to_end(key)
+                    if etag and not etag.startswith("W/"):
+                        # The compressed body is no longer byte-identical
+                        headers["ETag"] = f"W/{etag}"
+                    headers["Content-Encoding"] = encoding
+                    headers["Content-Length"] = str(len(compressed))
+                    message = {**message, "body": compressed}
+                    COMPRESSED_RESPONSES.labels(encoding).inc()
+                    COMPRESSION_BYTES.labels(encoding, "raw").inc(len(body))
+                    COMPRESSION_BYTES.labels(encoding, "sent").inc(len(compressed))
+            await send(response_start)
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+    async def _compress(self, encoding: str, body: bytes) -> bytes:
+        """Compresses a response body.
+
+        Args:
+            encoding (str): The content encoding, one of ENCODINGS.
+            body (bytes): The uncompressed body.
+
+        Returns:
+            bytes: The compressed body.
+        """
+        compress: Callable[[], bytes]
+        if encoding == "br":
+            compress = partial(
+                brotli.compress,
+                body,
+                mode=brotli.MODE_TEXT,
+                quality=self.brotli_quality,
+            )
+        else:
+            compress = partial(gzip.compress, body, compresslevel=self.gzip_level)
+        if len(body) >= THREAD_MIN_BYTES:
+            return await asyncio.to_thread(compress)
+        return compress()
@@ -0,0 +1,51 @@
+from functools import cache
+from typing import Any
+
+from pydantic import BaseModel
+from pydantic_core import PydanticUndefined
+
+
+@cache
+def field_defaults(model: type[BaseModel]) -> dict[str, Any]:
+    """Returns the default values of the fields of a model that have one.
+
+    Args:
+        model (type[BaseModel]): The model.
+
+    Returns:
+        dict[str, Any]: The default values by field name.
+    """
+    defaults = {}
+    for name, field in model.model_fields.items():
+        if field.default is not PydanticUndefined:
+            defaults[name] = field.default
+        elif field.default_factory is not None:
+            defaults[name] = field.default_factory()
+    return defaults
+
+
+def exclude_defaults(
+    model: type[BaseModel], rows: list[dict[str, Any]]
+) -> list[dict[str, Any]]:
+    """Drops the values of rows that equal the defaults of their fields.
+
+    Gives trusted database rows the shape of `response_model_exclude_defaults`,
+    without validating and re-serializing them through the model.
+
+    Args:
+        model (type[BaseModel]): The model of the rows.
+        rows (list[dict[str, Any]]): The rows, e.g. fetched from the database.
+
+    Returns:
+        list[dict[str, Any]]: The rows without their default values.
+    """
+    defaults = field_defaults(model)
+    missing = object()
+    return [
+        {
+            key: value
+            for key, value in row.items()
+            if defaults.get(key, missing) != value
+        }
+        for row in rows
+    ]
@@ -1,74 +1,288 @@
+import asyncio
+from contextlib import aclosing
 from http import HTTPStatus
-from typing import Any, AsyncGenerator
+from typing import Annotated, Any, AsyncGenerator, Callable, Hashable, Optional
 
-from fastapi import APIRouter, Body, Request
-from langchain_core.messages import AIMessageChunk, HumanMessage, SystemMessage
+import ujson
+from fastapi import APIRouter, Body, Query, Request, WebSocket
+from fastapi.responses import JSONResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from starlette.responses import StreamingResponse
 
+from app.character_import import CharacterImporter
+from app.http_cache import VersionedCache, is_not_modified
+from app.responses import exclude_defaults
+from app.sse import EventStream, interleave
+from app.warmup import Warmup
+from app.websocket import ChatSocket
 from database.database import Database
-from datamodels.enums import Sender
-from datamodels.models import Character, CharacterCreate, GetCharactersParams, Message
-from llm.llm_workflow import LlmWorkflow
-from scraper.scraper import NarutoWikiScraper
+from database.session_store import session_store
+from datamodels.enums import JobKind, Sender, StreamChannel, StreamEvent, TaskStatus
+from datamodels.models import (
+    Character,
+    CharacterCreate,
+    CharacterImportResult,
+    GetCharactersParams,
+    Job,
+    Message,
+)
+from jobs.handlers import character_jobs, missing_character_job_kinds
+from jobs.workers import job_workers
+from utils.consts import (
+    BROADCAST_MAX_CHARACTERS,
+    CHARACTER_CACHE_MAX_AGE_S,
+    CHARACTER_CACHE_SIZE,
+    JOBS_WAIT_TIMEOUT_S,
+    MISTRAL_LANGUAGE_MODEL_LARGE,
+    MISTRAL_LANGUAGE_MODEL_MEDIUM,
+)
+from utils.exceptions import NotFoundError
 from utils.logger import get_logger
+from utils.tracing import tracer
+
+# The LLM modules (langchain, langgraph, chroma, mistralai) are imported
+# lazily inside the chat routes to keep the app startup fast.
 
 router = APIRouter()
 db = Database()
 logger = get_logger()
+warmup = Warmup()
+character_cache = VersionedCache("characters", CHARACTER_CACHE_SIZE)
 
 
 @router.on_event("startup")
 async def on_startup() -> None:
-    """Scrapes all Naruto characters on startup."""
-    scraper = NarutoWikiScraper()
-    await scraper.scrape_all_characters()
+    """Starts the job workers and the warm-up tasks (e.g. scraping characters)."""
+    job_workers.start()
+    warmup.start()
+
+
+@router.on_event("shutdown")
+async def on_shutdown() -> None:
+    """Cancels warm-up tasks, stops the job workers and exports the last traces."""
+    await warmup.stop()
+    await job_workers.stop()
+    await asyncio.to_thread(tracer.close)
+
+
+@router.get("/healthz")
+def healthz() -> dict:
+    """Liveness probe, succeeds as soon as the app accepts requests.
+
+    Returns:
+        dict: The liveness status.
+    """
+    return {"status": "ok"}
+
+
+@router.get("/readyz")
+def readyz() -> JSONResponse:
+    """Readiness probe, succeeds once all required warm-up tasks are done.
+
+    Returns:
+        JSONResponse: The readiness status and the status of each warm-up task,
+            with status code 503 while the app is not ready yet.
+    """
+    return JSONResponse(
+        status_code=HTTPStatus.OK if warmup.ready else HTTPStatus.SERVICE_UNAVAILABLE,
+        content={
+            "status": "ready" if warmup.ready else "starting",
+            "tasks": warmup.status,
+            "errors": warmup.errors,
+        },
+    )
+
+
+@router.get("/metrics")
+def metrics() -> Response:
+    """Exposes the app metrics in the Prometheus text format.
+
+    Returns:
+        Response: The current values of all metrics.
+    """
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@router.get("/debug/traces")
+def get_traces(limit: int = 20) -> list[list[dict[str, Any]]]:
+    """Fetches the most recently completed request traces.
+
+    Args:
+        limit (int): The maximum number of traces to return. Defaults to 20.
+
+    Returns:
+        list[list[dict[str, Any]]]: The traces (newest first), each a list of spans.
+    """
+    return tracer.recent(limit)
+
+
+@router.get("/jobs")
+def get_jobs(
+    status: Optional[TaskStatus] = None,
+    kind: Optional[JobKind] = None,
+    limit: int = Query(default=100, le=100),
+) -> list[Job]:
+    """Fetches the most recently enqueued background jobs.
+
+    Args:
+        status (Optional[TaskStatus]): Only jobs of this status.
+        kind (Optional[JobKind]): Only jobs of this kind.
+        limit (int): The maximum number of jobs. Defaults to 100 (maximum).
+
+    Returns:
+        list[Job]: The jobs, newest first.
+    """
+    return job_workers.queue.list(status, kind, limit)
+
+
+@router.get("/jobs/{job_id}")
+def get_job(job_id: int) -> Job:
+    """Fetches a background job, e.g. to check whether it is done.
+
+    Args:
+        job_id (int): The ID of the job.
+
+    Raises:
+        NotFoundError: If the job does not exist, e.g. it was purged.
+
+    Returns:
+        Job: The job.
+    """
+    job = job_workers.queue.get(job_id)
+    if job is None:
+        raise NotFoundError(detail=f"Job with {job_id=} not found.")
+    return job
 
 
 @router.post("/characters", status_code=HTTPStatus.CREATED)
 def create_character(character_create: CharacterCreate) -> Character:
     """Creates a new character in the database.
 
+    Jobs creating the embeddings and the personality summary of the
+    character are enqueued, so the first chat with it does not wait.
+
     Args:
         character_create (CharacterCreate): The character object to create.
 
     Returns:
         Character: The created character object.
     """
-    return db.create(Character(**character_create.dict()))
+    character = db.create(Character(**character_create.dict()))
+    assert character.id is not None
+    job_workers.enqueue(character_jobs([character.id]))
+    return character
 
 
-@router.get(
-    "/characters",
-    response_model=list[Character],
-    response_model_exclude_defaults=True,
-)
-def get_characters(request: Request) -> list[dict[str, Any]]:
+@router.post("/characters/import", response_model=CharacterImportResult)
+async def import_characters(request: Request, enqueue_jobs: bool = False) -> Response:
+    """Imports characters from NDJSON or a JSON array in the request body.
+
+    The body is parsed while it is uploaded, and the characters are
+    inserted in batches, so uploads of any size need little memory. Rows
+    that are not valid characters are rejected and reported, the other
+    rows are imported either way.
+
+    Args:
+        request (Request): The HTTP request, with one character per line
+            (NDJSON) or a JSON array of characters as body.
+        enqueue_jobs (bool): Whether to enqueue the jobs creating the
+            embeddings and personality summaries of the imported characters.
+            Defaults to False, they are created on the first chat.
+
+    Returns:
+        Response: The numbers of imported and rejected rows and the first
+            rejected rows. Status 400 if the rest of the body could not be
+            parsed, the rows before were imported.
+    """
+    importer = CharacterImporter(db, enqueue_jobs=enqueue_jobs)
+    result = await importer.run(request.stream())
+    return JSONResponse(
+        result.model_dump(),
+        status_code=HTTPStatus.BAD_REQUEST if result.error else HTTPStatus.OK,
+    )
+
+
+def cached_character_response(
+    request: Request, route: str, key: Hashable, load: Callable[[], Any]
+) -> Response:
+    """Serves character data from the cache, with HTTP caching headers.
+
+    The version of the character table is the entity tag, so clients and
+    CDNs revalidating their copy get a 304 Not Modified without the data
+    being fetched. Otherwise the serialized data is served from the cache
+    if it is still of the current version.
+
+    Args:
+        request (Request): The HTTP request, with an optional `If-None-Match`.
+        route (str): The name of the route in the metrics.
+        key (Hashable): The shape of the query.
+        load (Callable[[], Any]): Fetches the JSON-serializable data.
+
+    Returns:
+        Response: The JSON data, or 304 Not Modified.
+    """
+    version = db.version(Character)
+    etag = f'"{version}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={CHARACTER_CACHE_MAX_AGE_S}",
+    }
+    if is_not_modified(request, etag, route):
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+
+    body = character_cache.get_or_load(
+        (route, key), version, lambda: ujson.dumps(load(), ensure_ascii=False).encode()
+    )
+    return Response(body, media_type="application/json", headers=headers)
+
+
+@router.get("/characters", response_model=list[Character])
+def get_characters(request: Request) -> Response:
     """Fetches a list of characters based on the provided parameters.
 
     Allows ordering by and selecting specific columns (meaning
     the resulting object may not contain all Character fields).
+    Values equal to their field's default are left out. The rows come
+    from our own database, so they are serialized with ujson without
+    validating them against the response model. Responses are cached
+    until the characters change (see `cached_character_response`).
 
     Args:
         request (Request): The HTTP request containing query parameters.
 
     Returns:
-        list[dict[str, Any]]: A list of (partial) character objects.
+        Response: A list of (partial) character objects, or 304 Not Modified.
     """
     params = GetCharactersParams.from_request(request)
-    return db.get(params)
+    return cached_character_response(
+        request,
+        "characters",
+        params.cache_key,
+        lambda: exclude_defaults(Character, db.get(params)),
+    )
 
 
-@router.get("/characters/{character_id}")
-def read_character(character_id: int) -> Character:
+@router.get("/characters/{character_id}", response_model=Character)
+def read_character(request: Request, character_id: int) -> Response:
     """Fetches a character by their ID.
 
+    Responses are cached until the characters change (see
+    `cached_character_response`).
+
     Args:
+        request (Request): The HTTP request, with an optional `If-None-Match`.
         character_id (int): The ID of the character to fetch.
 
     Returns:
-        Character: The character object corresponding to the given ID.
+        Response: The character object corresponding to the given ID,
+            or 304 Not Modified.
     """
-    return db.get_by_id(character_id, Character)
+    return cached_character_response(
+        request,
+        "character",
+        character_id,
+        lambda: db.get_by_id(character_id, Character).model_dump(),
+    )
 
 
 @router.delete("/characters/{character_id}", status_code=HTTPStatus.ACCEPTED)
@@ -85,28 +299,56 @@ def delete_character(character_id: int) -> dict:
     return {}
 
 
-@router.get("/chats/{thread_id}/{character_id}")
-def get_chat_history(thread_id: str, character_id: int) -> list[Message]:
+@router.get("/chats/{thread_id}/{character_id}", response_model=list[Message])
+def get_chat_history(
+    request: Request,
+    thread_id: str,
+    character_id: int,
+    cursor: int = 0,
+    limit: Annotated[Optional[int], Query(ge=1)] = None,
+) -> Response:
     """Fetches the chat history for a specific thread and character.
 
+    Read straight from the session store, without loading the character's
+    workflow. The response carries the version of the conversation as its
+    `ETag`, so clients polling the history get a 304 Not Modified until a
+    new message arrives. If a `limit` is given and more messages follow,
+    the `X-Next-Cursor` header holds the `cursor` of the next page.
+
     Args:
+        request (Request): The HTTP request, with an optional `If-None-Match`.
         thread_id (str): The ID of the client thread to fetch.
         character_id (int): The ID of the character.
+        cursor (int): Only messages after this cursor are returned.
+            Defaults to 0, from the first message.
+        limit (Optional[int]): The maximum number of messages to return.
+            Defaults to all messages.
 
     Returns:
-        dict[str, list[dict[str, Any]]]: A dictionary containing the chat history data.
+        Response: The messages, oldest first, or 304 Not Modified.
     """
-    agent = LlmWorkflow.from_thread_id(thread_id, character_id)
-    chat_history = agent.get_state(thread_id).values.get("chat_history", [])
-
-    return [
+    etag = f'"{session_store.version(thread_id, character_id)}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if is_not_modified(request, etag, "chat_history"):
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+
+    # One more message than the limit tells if there is a next page
+    page = session_store.messages(
+        thread_id, character_id, after=cursor, limit=limit and limit + 1
+    )
+    if limit is not None and len(page) > limit:
+        page = page[:limit]
+        headers["X-Next-Cursor"] = str(page[-1][0])
+
+    messages = [
         Message(
-            sender=Sender.human if isinstance(message, HumanMessage) else Sender.ai,
-            text=message.content,
-        )
-        for message in chat_history
-        if not isinstance(message, SystemMessage)
+            sender=Sender.human if message["type"] == Sender.human else Sender.ai,
+            text=message["data"]["content"],
+        ).model_dump(mode="json")
+        for _, message in page
+        if message["type"] != Sender.system
     ]
+    return JSONResponse(messages, headers=headers)
 
 
 @router.get("/chats/{thread_id}")
@@ -119,6 +361,8 @@ def get_chats(thread_id: str) -> list[int]:
     Returns:
         dict[str, list[int]]: A dictionary containing the character IDs.
     """
+    from llm.llm_workflow import LlmWorkflow
+
     character_ids = LlmWorkflow.get_chat_character_ids(thread_id)
 
     return character_ids
@@ -135,46 +379,174 @@ def delete_chat(thread_id: str, character_id: int) -> dict:
     Returns:
         dict[str, list[int]]: A dictionary containing the character IDs.
     """
+    from llm.llm_workflow import LlmWorkflow
+
     LlmWorkflow.delete_character_chat_history(thread_id, character_id)
 
     return {}
 
 
+def admit_chat_turn() -> None:
+    """Checks that the LLM calls of a new chat turn can be served.
+
+    Raises:
+        OverloadedError: If the LLM queues are full.
+    """
+    from llm.scheduler import llm_scheduler
+
+    llm_scheduler.admit([MISTRAL_LANGUAGE_MODEL_LARGE, MISTRAL_LANGUAGE_MODEL_MEDIUM])
+
+
+async def prepare_character(character_id: int) -> None:
+    """Waits for the jobs preparing a character for chats, if any are missing.
+
+    The jobs create the embeddings and the personality summary of the
+    character. They run before background jobs, and concurrent first
+    turns with the character, also in other app workers, share them. If
+    the jobs fail or take too long, the turn creates what is missing itself.
+
+    Args:
+        character_id (int): The ID of the character.
+    """
+    kinds = await asyncio.to_thread(missing_character_job_kinds, db, character_id)
+    if not kinds:
+        return
+    with tracer.span("chat.prepare_character", character_id=character_id):
+        # Chat turns wait for these jobs, so they run first
+        jobs = await asyncio.to_thread(
+            job_workers.enqueue, character_jobs([character_id], kinds, priority=1)
+        )
+        await asyncio.gather(
+            *(job_workers.wait(job.id, JOBS_WAIT_TIMEOUT_S) for job in jobs)
+        )
+
+
+async def chat_turn_events(
+    thread_id: str, character_id: int, query: str, channels: list[StreamChannel]
+) -> AsyncGenerator[tuple[StreamEvent, Any], None]:
+    """Generates the response of a character to a query, event by event.
+
+    Args:
+        thread_id (str): The ID of the chat thread.
+        character_id (int): The ID of the character participating in the chat.
+        query (str): The input query from the user.
+        channels (list[StreamChannel]): Additional event channels to stream.
+
+    Yields:
+        tuple[StreamEvent, Any]: The event types and payloads of the turn.
+    """
+    from llm.llm_workflow import LlmWorkflow
+
+    with tracer.span("chat.turn", thread_id=thread_id, character_id=character_id):
+        if character_id not in LlmWorkflow.workflows:
+            await prepare_character(character_id)
+        agent = await asyncio.to_thread(LlmWorkflow.for_character, character_id)
+        await asyncio.to_thread(agent.summarize_character_personality)
+
+        async for event in agent.stream_response(thread_id, query, channels):
+            yield event
+
+
 @router.post("/chats/stream", status_code=HTTPStatus.ACCEPTED)
 async def stream(
+    request: Request,
     query: str = Body(),
     character_id: int = Body(),
     thread_id: str = Body(),
+    channels: list[StreamChannel] = Body(default=[]),
 ) -> StreamingResponse:
-    """Streams the LLM responses chunk by chunk as an event stream.
+    """Streams the LLM responses chunk by chunk as server-sent events.
+
+    Emits `token` events carrying the response text, followed by a `done`
+    event, or an `error` event if the response could not be generated.
+    Events of the requested `channels` are emitted in between.
+    The generation is cancelled as soon as the client disconnects.
+    If too many LLM calls are already waiting, the request is rejected
+    before the stream starts.
 
     Args:
+        request (Request): The HTTP request, used to detect client disconnects.
         query (str): The input query from the user.
         character_id (int): The ID of the character participating in the chat.
         thread_id (str): The ID of the chat thread.
+        channels (list[StreamChannel]): Additional event channels to stream,
+            e.g. the retrieved context. Defaults to none.
 
     Returns:
         StreamingResponse: An event stream that yields LLM responses as text chunks.
+
+    Raises:
+        OverloadedError: If the LLM queues are full (503 with Retry-After).
     """
+    admit_chat_turn()
+    events = chat_turn_events(thread_id, character_id, query, channels)
+    return EventStream(request, events).response()
 
-    async def event_stream() -> AsyncGenerator[str, None]:
-        """Internal function to stream LLM responses in real-time."""
-        agent = LlmWorkflow.from_thread_id(thread_id, character_id)
-        chat_history = agent.get_state(thread_id).values.get("chat_history", [])
-        agent.summarize_character_personality()
 
-        n_message = 0 if len(chat_history) > 0 else 1
-        n_to_stream = 3  # stream only 3rd AI message (actual character response)
+@router.post("/chats/broadcast", status_code=HTTPStatus.ACCEPTED)
+async def broadcast(
+    request: Request,
+    query: str = Body(),
+    character_ids: list[int] = Body(min_length=1, max_length=BROADCAST_MAX_CHARACTERS),
+    thread_id: str = Body(),
+    channels: list[StreamChannel] = Body(default=[]),
+) -> StreamingResponse:
+    """Streams the responses of several characters to one query at once.
+
+    The characters respond concurrently, each in its own chat of the
+    thread, and their events are interleaved in one event stream. Every
+    event carries the `character_id` it belongs to. A character's response
+    ends with its own `done` (or `error`) event, the stream ends with a
+    `done` event without `character_id` once all characters responded.
+    Concurrent turns share the embedding of the query (see
+    `QueryEmbeddings`).
 
-        async for msg, metadata in agent.graph.astream(
-            {"input": query},
-            stream_mode="messages",
-            config=agent.get_config(thread_id),
+    Args:
+        request (Request): The HTTP request, used to detect client disconnects.
+        query (str): The input query from the user.
+        character_ids (list[int]): The IDs of the characters to respond.
+        thread_id (str): The ID of the chat thread.
+        channels (list[StreamChannel]): Additional event channels to stream,
+            e.g. the retrieved context. Defaults to none.
+
+    Returns:
+        StreamingResponse: An event stream of the interleaved responses.
+
+    Raises:
+        OverloadedError: If the LLM queues are full (503 with Retry-After).
+    """
+    admit_chat_turn()
+
+    async def events() -> AsyncGenerator[tuple[StreamEvent, Any], None]:
+        """Internal function to interleave the responses of the characters."""
+        streams = {
+            character_id: chat_turn_events(thread_id, character_id, query, channels)
+            for character_id in dict.fromkeys(character_ids)
+        }
+        with tracer.span(
+            "chat.broadcast", thread_id=thread_id, characters=len(streams)
         ):
-            if isinstance(msg, AIMessageChunk):
-                if msg.usage_metadata:
-                    n_message += 1
-                if n_message == n_to_stream:
-                    yield msg.content
+            async with aclosing(interleave(streams, "character_id")) as interleaved:
+                async for event in interleaved:
+                    yield event
+
+    return EventStream(request, events()).response()
 
-    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+@router.websocket("/chats/{thread_id}/ws")
+async def chat_socket(websocket: WebSocket, thread_id: str) -> None:
+    """Streams the LLM responses of a thread over a WebSocket connection.
+
+    Unlike `/chats/stream`, the connection is kept open across turns, and
+    turns to several characters can be in flight at once. The client sends
+    `{"type": "turn", "id", "character_id", "query", "channels"}` to start
+    a turn and `{"type": "cancel", "id"}` to cancel it. The server sends
+    the events of `/chats/stream` as `{"id", "event", "data"}` messages,
+    tagged with the ID of their turn. Turns that cannot be admitted get an
+    `error` event with a `retry_after` in seconds.
+
+    Args:
+        websocket (WebSocket): The connection to the client.
+        thread_id (str): The ID of the chat thread.
+    """
+    await ChatSocket(websocket, thread_id, chat_turn_events, admit_chat_turn).serve()
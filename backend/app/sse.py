@@ -0,0 +1,381 @@
+import asyncio
+import json
+import re
+import time
+from contextlib import aclosing
+from functools import partial
+from typing import Any, AsyncGenerator, AsyncIterator, Callable, Mapping, Optional
+
+from fastapi import Request
+from pydantic import BaseModel
+from starlette.responses import StreamingResponse
+
+from datamodels.enums import StreamEvent
+from utils.consts import (
+    SSE_DISCONNECT_POLL_INTERVAL,
+    SSE_FLUSH_BYTES,
+    SSE_FLUSH_INTERVAL_MS,
+    SSE_FLUSH_ON_SENTENCE,
+    SSE_HEARTBEAT_INTERVAL,
+)
+from utils.logger import get_logger
+
+logger = get_logger()
+
+HEARTBEAT = ": keep-alive\n\n"
+
+# Marks the end of the producer's events in the queue
+_END = object()
+
+SENTENCE_END = re.compile(r"([.!?]['\")\]]*\s*|\n)$")
+
+
+def format_sse(event: StreamEvent, data: Any, event_id: int) -> str:
+    """Formats a single server-sent event.
+
+    The data is JSON-encoded, so it always fits on a single `data:` line.
+
+    Args:
+        event (StreamEvent): The event type.
+        data (Any): The JSON-serializable event payload.
+        event_id (int): The ID of the event within the stream.
+
+    Returns:
+        str: The event in the `text/event-stream` wire format.
+    """
+    return f"id: {event_id}\nevent: {event.value}\ndata: {json.dumps(data)}\n\n"
+
+
+class FlushPolicy(BaseModel):
+    """Policy for coalescing consecutive token events into fewer writes.
+
+    Buffered tokens are flushed as soon as any limit is reached.
+
+    Attributes:
+        max_bytes (int): Flush once the buffered text reaches this many bytes.
+            0 disables coalescing, every event is written on its own.
+        max_delay_ms (float): Flush once the oldest buffered token is this old.
+        on_sentence (bool): Flush when the buffered text ends a sentence.
+    """
+
+    max_bytes: int = SSE_FLUSH_BYTES
+    max_delay_ms: float = SSE_FLUSH_INTERVAL_MS
+    on_sentence: bool = SSE_FLUSH_ON_SENTENCE
+
+    @property
+    def coalesce(self) -> bool:
+        """Whether token events are coalesced at all."""
+        return self.max_bytes > 0
+
+    def should_flush(self, last_text: str, n_bytes: int) -> bool:
+        """Checks the size and sentence-boundary limits of the buffered text.
+
+        Args:
+            last_text (str): The most recently buffered text.
+            n_bytes (int): The size of all buffered text in bytes.
+
+        Returns:
+            bool: True if the buffered text should be flushed now.
+        """
+        return n_bytes >= self.max_bytes or (
+            self.on_sentence and SENTENCE_END.search(last_text) is not None
+        )
+
+
+class _TokenBuffer:
+    """Buffers consecutive token events that only differ in their text."""
+
+    def __init__(self) -> None:
+        """Initializes an empty buffer."""
+        self.data: Optional[dict[str, Any]] = None
+        self.parts: list[str] = []
+        self.n_bytes = 0
+        self.since = 0.0
+
+    def accepts(self, data: dict[str, Any]) -> bool:
+        """Checks if a token event can be merged into the buffered one.
+
+        Args:
+            data (dict[str, Any]): The token event data.
+
+        Returns:
+            bool: True if the buffer is empty or the events only differ in text.
+        """
+        return self.data is None or all(
+            self.data.get(key) == value for key, value in data.items() if key != "text"
+        )
+
+    def add(self, data: dict[str, Any], now: float) -> None:
+        """Adds a token event to the buffer.
+
+        Args:
+            data (dict[str, Any]): The token event data.
+            now (float): The current `time.monotonic()`.
+        """
+        if self.data is None:
+            self.data = data
+            self.since = now
+        self.parts.append(data["text"])
+        self.n_bytes += len(data["text"].encode())
+
+    def pop(self) -> Optional[dict[str, Any]]:
+        """Empties the buffer.
+
+        Returns:
+            Optional[dict[str, Any]]: The merged token event data,
+                or None if the buffer was empty.
+        """
+        if self.data is None:
+            return None
+        data = {**self.data, "text": "".join(self.parts)}
+        self.data, self.parts, self.n_bytes = None, [], 0
+        return data
+
+
+async def _produce(
+    events: AsyncIterator[tuple[StreamEvent, Any]],
+    queue: asyncio.Queue,
+    tag: Optional[Callable[[Any], Any]] = None,
+    name: str = "Event stream producer",
+) -> None:
+    """Moves the events of a producer into a queue, ending with `_END`.
+
+    The events end with a `done` event, or an `error` event if the producer
+    failed.
+
+    Args:
+        events (AsyncIterator[tuple[StreamEvent, Any]]): The event producer.
+        queue (asyncio.Queue): The queue of the consumer.
+        tag (Optional[Callable[[Any], Any]], optional): Maps the payloads
+            before they are queued. Defaults to None, they are queued as is.
+        name (str, optional): The name of the producer in the logs.
+    """
+    tag = tag or (lambda data: data)
+    try:
+        async for event, data in events:
+            await queue.put((event, tag(data)))
+    except Exception as exc:
+        logger.exception(f"{name} failed.")
+        await queue.put((StreamEvent.error, tag({"message": str(exc)})))
+    else:
+        await queue.put((StreamEvent.done, tag({})))
+    await queue.put(_END)
+
+
+async def interleave(
+    streams: Mapping[Any, AsyncIterator[tuple[StreamEvent, Any]]], key: str
+) -> AsyncGenerator[tuple[StreamEvent, Any], None]:
+    """Runs several event producers concurrently and interleaves their events.
+
+    Every event is tagged with the ID of its producer under `key`: dict
+    payloads get the ID added, other payloads are wrapped as
+    `{key: ID, "data": payload}`. Each producer ends with a tagged `done`
+    event, or a tagged `error` event if it failed, without affecting the
+    others. Closing the generator cancels the producers.
+
+    Args:
+        streams (Mapping[Any, AsyncIterator[tuple[StreamEvent, Any]]]): The
+            event producers by ID.
+        key (str): The payload key of the producer ID.
+
+    Yields:
+        tuple[StreamEvent, Any]: The tagged events, in the order they arrived.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=64)
+
+    def tag(stream_id: Any, data: Any) -> dict[str, Any]:
+        if isinstance(data, dict):
+            return {**data, key: stream_id}
+        return {key: stream_id, "data": data}
+
+    producers = [
+        asyncio.create_task(
+            _produce(
+                events,
+                queue,
+                partial(tag, stream_id),
+                f"Event producer {stream_id}",
+            )
+        )
+        for stream_id, events in streams.items()
+    ]
+    try:
+        remaining = len(producers)
+        while remaining:
+            item = await queue.get()
+            if item is _END:
+                remaining -= 1
+            else:
+                yield item
+    finally:
+        for task in producers:
+            task.cancel()
+        await asyncio.gather(*producers, return_exceptions=True)
+
+
+async def coalesce(
+    events: AsyncIterator[tuple[StreamEvent, Any]],
+    flush_policy: FlushPolicy,
+    wake_interval: float,
+) -> AsyncGenerator[list[tuple[StreamEvent, Any]], None]:
+    """Runs an event producer and yields its events in coalesced batches.
+
+    The producer runs in its own task and its events end with a `done`
+    event, or an `error` event if it failed. Token events are coalesced
+    according to the `flush_policy`, and all events that are ready at the
+    same time are yielded as one batch. An empty batch is yielded whenever
+    no event was ready for `wake_interval` seconds, so the consumer can
+    e.g. check for disconnects. Closing the generator cancels the producer.
+
+    Args:
+        events (AsyncIterator[tuple[StreamEvent, Any]]): The event producer.
+        flush_policy (FlushPolicy): The token coalescing policy.
+        wake_interval (float): Maximum seconds between two batches.
+
+    Yields:
+        list[tuple[StreamEvent, Any]]: The event types and payloads ready
+            to be sent, possibly none.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=64)
+    max_delay = flush_policy.max_delay_ms / 1000
+    producer = asyncio.create_task(_produce(events, queue))
+    # A pending `get` is kept across timeouts so no event is ever dropped
+    getter: Optional[asyncio.Task] = None
+    buffer = _TokenBuffer()
+    try:
+        while True:
+            timeout = wake_interval
+            if buffer.data is not None:
+                timeout = min(timeout, buffer.since + max_delay - time.monotonic())
+            getter = getter or asyncio.create_task(queue.get())
+            done, _ = await asyncio.wait({getter}, timeout=max(timeout, 0))
+            items = [getter.result()] if done else []
+            if done:
+                getter = None
+                if flush_policy.coalesce:
+                    while not queue.empty():
+                        items.append(queue.get_nowait())
+
+            now = time.monotonic()
+            batch: list[tuple[StreamEvent, Any]] = []
+            finished = False
+            for item in items:
+                if item is _END:
+                    finished = True
+                    break
+                event, data = item
+                if flush_policy.coalesce and event == StreamEvent.token:
+                    if not buffer.accepts(data):
+                        batch.append((StreamEvent.token, buffer.pop()))
+                    buffer.add(data, now)
+                    if flush_policy.should_flush(data["text"], buffer.n_bytes):
+                        batch.append((StreamEvent.token, buffer.pop()))
+                    continue
+                if buffer.data is not None:
+                    batch.append((StreamEvent.token, buffer.pop()))
+                batch.append((event, data))
+
+            if buffer.data is not None and (
+                finished or now - buffer.since >= max_delay
+            ):
+                batch.append((StreamEvent.token, buffer.pop()))
+
+            yield batch
+            if finished:
+                return
+    finally:
+        for task in (producer, getter):
+            if task:
+                task.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+
+
+class EventStream:
+    """Serves the events of a producer as a spec-compliant event stream.
+
+    The producer runs in its own task. While it is running, keep-alive
+    comments are sent when no event was sent for `heartbeat_interval`
+    seconds, and the client connection is checked every
+    `disconnect_poll_interval` seconds. If the client went away the
+    producer task is cancelled, which also cancels any upstream
+    LLM request it is awaiting.
+
+    Token events are coalesced according to the `flush_policy`, and all
+    events that are ready at the same time are sent in a single write.
+
+    Attributes:
+        request (Request): The request of the client receiving the stream.
+        events (AsyncIterator[tuple[StreamEvent, Any]]): The producer
+            yielding event types and payloads.
+        heartbeat_interval (float): Seconds of silence before a keep-alive.
+        disconnect_poll_interval (float): Seconds between disconnect checks.
+        flush_policy (FlushPolicy): The token coalescing policy.
+    """
+
+    def __init__(
+        self,
+        request: Request,
+        events: AsyncIterator[tuple[StreamEvent, Any]],
+        heartbeat_interval: float = SSE_HEARTBEAT_INTERVAL,
+        disconnect_poll_interval: float = SSE_DISCONNECT_POLL_INTERVAL,
+        flush_policy: Optional[FlushPolicy] = None,
+    ) -> None:
+        """Initializes the EventStream.
+
+        Args:
+            request (Request): The request of the client receiving the stream.
+            events (AsyncIterator[tuple[StreamEvent, Any]]): The event producer.
+            heartbeat_interval (float, optional): Seconds of silence before
+                a keep-alive comment is sent. Defaults to SSE_HEARTBEAT_INTERVAL.
+            disconnect_poll_interval (float, optional): Seconds between client
+                disconnect checks. Defaults to SSE_DISCONNECT_POLL_INTERVAL.
+            flush_policy (Optional[FlushPolicy], optional): The token coalescing
+                policy. Defaults to the policy configured in the environment.
+        """
+        self.request = request
+        self.events = events
+        self.heartbeat_interval = heartbeat_interval
+        self.disconnect_poll_interval = disconnect_poll_interval
+        self.flush_policy = flush_policy or FlushPolicy()
+
+    async def stream(self) -> AsyncGenerator[str, None]:
+        """Yields the formatted events, heartbeats included.
+
+        Yields:
+            str: Server-sent events and keep-alive comments.
+        """
+        event_id = 0
+        last_sent = last_checked = time.monotonic()
+        batches = coalesce(
+            self.events, self.flush_policy, self.disconnect_poll_interval
+        )
+        async with aclosing(batches):
+            async for batch in batches:
+                now = time.monotonic()
+                if now - last_checked >= self.disconnect_poll_interval:
+                    last_checked = now
+                    if await self.request.is_disconnected():
+                        logger.debug("Client disconnected, cancelling stream.")
+                        return
+                if batch:
+                    last_sent = now
+                    out = []
+                    for event, data in batch:
+                        event_id += 1
+                        out.append(format_sse(event, data, event_id))
+                    yield "".join(out)
+                elif now - last_sent >= self.heartbeat_interval:
+                    last_sent = now
+                    yield HEARTBEAT
+
+    def response(self) -> StreamingResponse:
+        """Wraps the event stream in a StreamingResponse.
+
+        Returns:
+            StreamingResponse: The `text/event-stream` response.
+        """
+        return StreamingResponse(
+            self.stream(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
@@ -0,0 +1,141 @@
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+from sqlmodel import select
+
+from database.database import Database
+from datamodels.enums import JobKind, TaskStatus
+from datamodels.models import Character, JobCreate
+from jobs.handlers import character_jobs
+from jobs.workers import job_workers
+from utils.consts import WARMUP_PRELOAD_CHARACTERS
+from utils.logger import get_logger
+
+logger = get_logger()
+
+
+class Warmup:
+    """Runs the startup warm-up tasks in the background and tracks readiness.
+
+    The app accepts traffic immediately; `/readyz` reports ready once
+    all tasks in `REQUIRED_TASKS` are done.
+
+    Attributes:
+        status (dict[str, TaskStatus]): The status of each warm-up task.
+        errors (dict[str, str]): Error messages of failed warm-up tasks.
+    """
+
+    REQUIRED_TASKS = ("scrape_characters", "open_vector_store")
+
+    def __init__(self) -> None:
+        """Initializes all warm-up tasks as pending."""
+        self.status: dict[str, TaskStatus] = {
+            name: TaskStatus.pending
+            for name in (*self.REQUIRED_TASKS, "preload_characters")
+        }
+        self.errors: dict[str, str] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        """Whether all required warm-up tasks are done."""
+        return all(self.status[name] == TaskStatus.done for name in self.REQUIRED_TASKS)
+
+    def start(self) -> None:
+        """Schedules the warm-up tasks on the running event loop, unless they are."""
+        # FastAPI runs the startup handlers of an included router twice, from
+        # the app and from the lifespan of the router
+        if self._task is None:
+            self._task = asyncio.create_task(self._run_all())
+
+    async def stop(self) -> None:
+        """Cancels the warm-up tasks if they are still running."""
+        if self._task and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run_all(self) -> None:
+        """Runs scraping and vectorDB setup concurrently, then preloads characters."""
+        await asyncio.gather(
+            self._run("scrape_characters", self.scrape_characters),
+            self._run("open_vector_store", self.open_vector_store),
+        )
+        await self._run("preload_characters", self.preload_characters)
+
+    async def _run(self, name: str, task: Callable[[], Awaitable[None]]) -> None:
+        """Runs a single warm-up task and records its status.
+
+        Args:
+            name (str): The name of the task.
+            task (Callable[[], Awaitable[None]]): The task to run.
+        """
+        self.status[name] = TaskStatus.running
+        try:
+            await task()
+        except Exception as exc:
+            logger.exception(f"Warm-up task {name} failed.")
+            self.status[name] = TaskStatus.failed
+            self.errors[name] = repr(exc)
+        else:
+            logger.debug(f"Warm-up task {name} done.")
+            self.status[name] = TaskStatus.done
+
+    @staticmethod
+    async def scrape_characters() -> None:
+        """Scrapes all characters if the database is still empty.
+
+        Runs as a job, so only one of the app workers scrapes, the others
+        wait for it, and failed scrapes are retried.
+
+        Raises:
+            RuntimeError: If the scrape failed for good.
+        """
+        job = JobCreate(kind=JobKind.scrape_characters, key="scrape_characters")
+        [enqueued] = await asyncio.to_thread(job_workers.enqueue, [job])
+        finished = await job_workers.wait(enqueued.id)
+        if finished is None or finished.status != TaskStatus.done:
+            raise RuntimeError(finished.error if finished else "Scrape job vanished.")
+
+    @staticmethod
+    async def open_vector_store() -> None:
+        """Imports the LLM modules, opens the vectorDB and loads the tokenizer."""
+
+        def _open() -> None:
+            # Imported lazily, langchain and chroma are slow to import
+            from llm.context import TokenCounter
+            from llm.llm_workflow import LlmWorkflow  # noqa: F401
+            from llm.rag import RAG
+
+            RAG.vectordb()
+            TokenCounter.tokenizer()
+
+        await asyncio.to_thread(_open)
+
+    @staticmethod
+    async def preload_characters() -> None:
+        """Makes sure the most popular characters can be chatted with right away.
+
+        Characters with the most wiki data are considered the most popular.
+        Jobs creating their personality summaries are enqueued now, so that
+        the first chat with them does not wait for an LLM call.
+        """
+
+        def _preload() -> None:
+            character_ids = (
+                Database()
+                .session.exec(
+                    select(Character.id)
+                    .order_by(Character.data_length.desc())  # type: ignore
+                    .limit(WARMUP_PRELOAD_CHARACTERS)
+                )
+                .all()
+            )
+            job_workers.enqueue(
+                character_jobs(
+                    [character_id for character_id in character_ids if character_id],
+                    kinds=[JobKind.summarize_personality],
+                )
+            )
+
+        if WARMUP_PRELOAD_CHARACTERS > 0:
+            await asyncio.to_thread(_preload)
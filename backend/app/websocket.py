@@ -0,0 +1,224 @@
+import asyncio
+import json
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Callable, Optional
+
+from fastapi import WebSocket
+from pydantic import ValidationError
+
+from app.sse import FlushPolicy, coalesce
+from datamodels.enums import ChatSocketMessageType, StreamChannel, StreamEvent
+from datamodels.models import ChatSocketMessage
+from utils.consts import WS_MAX_TURNS, WS_SEND_QUEUE_SIZE
+from utils.exceptions import OverloadedError
+from utils.logger import get_logger
+from utils.metrics import WS_CONNECTIONS, WS_TURNS
+
+logger = get_logger()
+
+# Turns have no client disconnect to poll for, the receive loop notices it
+WAKE_INTERVAL = 60.0
+
+TurnEvents = Callable[
+    [str, int, str, list[StreamChannel]], AsyncIterator[tuple[StreamEvent, Any]]
+]
+
+
+class ChatSocket:
+    """Serves the chat turns of a thread over a single WebSocket connection.
+
+    The client sends `turn` messages, each with its own ID, and may send
+    the next turn (e.g. to another character) before the previous one is
+    done. Every turn runs in its own task, and its events are sent as JSON
+    messages `{"id": ..., "event": ..., "data": ...}` tagged with the turn
+    ID, so the responses of several characters can be streamed at once.
+    A `cancel` message stops a turn, which is confirmed by a `cancelled`
+    event. All turns are cancelled when the client disconnects.
+
+    Token events are coalesced like in the event stream. Events are sent
+    through a bounded queue, so when the client reads slower than the
+    LLMs generate, the turns wait instead of buffering their responses.
+
+    Attributes:
+        websocket (WebSocket): The connection to the client.
+        thread_id (str): The ID of the chat thread.
+        turn_events (TurnEvents): Produces the events of a turn from the thread
+            ID, the character ID, the query and the requested channels.
+        admit (Callable[[], None]): Raises OverloadedError if a new turn
+            cannot be served.
+        flush_policy (FlushPolicy): The token coalescing policy.
+        max_turns (int): The maximum number of turns in flight.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        thread_id: str,
+        turn_events: TurnEvents,
+        admit: Callable[[], None],
+        flush_policy: Optional[FlushPolicy] = None,
+        max_turns: int = WS_MAX_TURNS,
+        send_queue_size: int = WS_SEND_QUEUE_SIZE,
+    ) -> None:
+        """Initializes the ChatSocket.
+
+        Args:
+            websocket (WebSocket): The connection to the client.
+            thread_id (str): The ID of the chat thread.
+            turn_events (TurnEvents): Produces the events of a turn.
+            admit (Callable[[], None]): Raises OverloadedError if a new turn
+                cannot be served.
+            flush_policy (Optional[FlushPolicy], optional): The token coalescing
+                policy. Defaults to the policy configured in the environment.
+            max_turns (int, optional): The maximum number of turns in flight.
+                Defaults to WS_MAX_TURNS.
+            send_queue_size (int, optional): The number of events buffered
+                before the turns wait for the client. Defaults to
+                WS_SEND_QUEUE_SIZE.
+        """
+        self.websocket = websocket
+        self.thread_id = thread_id
+        self.turn_events = turn_events
+        self.admit = admit
+        self.flush_policy = flush_policy or FlushPolicy()
+        self.max_turns = max_turns
+        self._outbox: asyncio.Queue[str] = asyncio.Queue(maxsize=send_queue_size)
+        self._turns: dict[str, tuple[ChatSocketMessage, asyncio.Task]] = {}
+
+    async def serve(self) -> None:
+        """Accepts the connection and serves turns until the client leaves."""
+        await self.websocket.accept()
+        WS_CONNECTIONS.inc()
+        # The writer fails once the client is gone, while the receiver may be
+        # waiting for room in the send queue, so either of them ends the loop
+        loops = {
+            asyncio.create_task(self._receive()),
+            asyncio.create_task(self._write()),
+        }
+        try:
+            await asyncio.wait(loops, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            WS_CONNECTIONS.dec()
+            tasks = [task for _, task in self._turns.values()] + list(loops)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _receive(self) -> None:
+        """Handles the client's messages until it disconnects."""
+        while True:
+            received = await self.websocket.receive()
+            if received["type"] == "websocket.disconnect":
+                logger.debug("Client disconnected, cancelling its turns.")
+                return
+            try:
+                message = ChatSocketMessage.model_validate_json(
+                    received.get("text") or received.get("bytes") or ""
+                )
+            except ValidationError as exc:
+                errors = [error["msg"] for error in exc.errors()]
+                await self._send(None, StreamEvent.error, {"message": errors})
+                continue
+            if message.type == ChatSocketMessageType.turn:
+                await self._start(message)
+            else:
+                await self._cancel(message.id)
+
+    async def _start(self, message: ChatSocketMessage) -> None:
+        """Starts a turn, unless it is rejected.
+
+        A turn is rejected if its ID or its character already has a turn
+        in flight, since two concurrent turns of a character would both
+        extend the same chat history.
+
+        Args:
+            message (ChatSocketMessage): The turn message.
+        """
+        error: Optional[dict[str, Any]] = None
+        if message.id in self._turns:
+            error = {"message": "A turn with this ID is already in flight."}
+        elif any(
+            turn.character_id == message.character_id
+            for turn, _ in self._turns.values()
+        ):
+            error = {"message": "The character is still responding."}
+        elif len(self._turns) >= self.max_turns:
+            error = {"message": "Too many turns in flight."}
+        else:
+            try:
+                self.admit()
+            except OverloadedError as exc:
+                error = {"message": exc.message, "retry_after": exc.retry_after}
+        if error:
+            WS_TURNS.labels("rejected").inc()
+            await self._send(message.id, StreamEvent.error, error)
+            return
+
+        task = asyncio.create_task(self._run(message))
+        self._turns[message.id] = (message, task)
+
+        def forget(_: asyncio.Task) -> None:
+            if self._turns.get(message.id, (None, None))[1] is task:
+                del self._turns[message.id]
+
+        task.add_done_callback(forget)
+
+    async def _run(self, message: ChatSocketMessage) -> None:
+        """Streams the events of a turn into the send queue.
+
+        Args:
+            message (ChatSocketMessage): The turn message.
+        """
+        assert message.character_id is not None and message.query is not None
+        events = self.turn_events(
+            self.thread_id, message.character_id, message.query, message.channels
+        )
+        result = "error"
+        try:
+            batches = coalesce(events, self.flush_policy, WAKE_INTERVAL)
+            async with aclosing(batches):
+                async for batch in batches:
+                    for event, data in batch:
+                        if event == StreamEvent.done:
+                            result = "done"
+                        await self._send(message.id, event, data)
+        except asyncio.CancelledError:
+            result = "cancelled"
+            raise
+        finally:
+            WS_TURNS.labels(result).inc()
+
+    async def _cancel(self, turn_id: str) -> None:
+        """Cancels a turn in flight and confirms it to the client.
+
+        Args:
+            turn_id (str): The ID of the turn.
+        """
+        turn = self._turns.get(turn_id)
+        if turn is None:
+            message = "No turn with this ID is in flight."
+            await self._send(turn_id, StreamEvent.error, {"message": message})
+            return
+        _, task = turn
+        task.cancel()
+        await asyncio.wait({task})
+        await self._send(turn_id, StreamEvent.cancelled, {})
+
+    async def _send(
+        self, turn_id: Optional[str], event: StreamEvent, data: Any
+    ) -> None:
+        """Queues an event for the client, waiting while the queue is full.
+
+        Args:
+            turn_id (Optional[str]): The ID of the turn, None if the event
+                does not belong to a turn (e.g. an invalid message).
+            event (StreamEvent): The event type.
+            data (Any): The JSON-serializable event payload.
+        """
+        message = {"id": turn_id, "event": event.value, "data": data}
+        await self._outbox.put(json.dumps(message))
+
+    async def _write(self) -> None:
+        """Sends the queued events to the client, in order."""
+        while True:
+            await self.websocket.send_text(await self._outbox.get())
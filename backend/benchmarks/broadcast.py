@@ -0,0 +1,207 @@
+"""Compares asking several characters one after another with a broadcast.
+
+Starts the fake Mistral API and the app once per mode and drives
+concurrent chat sessions, in which every question goes to
+`--characters-per-turn` characters. With `serial`, the characters are
+asked with one `/chats/stream` request after another, as the frontend
+does. With `broadcast`, one `/chats/broadcast` request asks all of them.
+Reports the time until the first token and until all characters
+responded, and the query embedding metrics, as JSON.
+
+Usage (from the `backend` directory):
+    python -m benchmarks.broadcast --sessions 20 --turns 3 --characters-per-turn 3
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from typing import Optional
+
+import httpx
+
+from benchmarks.load_test import QUESTIONS, scrape_metrics, serve_app
+from benchmarks.utils import git_revision, percentiles
+
+MODES = ("serial", "broadcast")
+
+
+async def read_stream(
+    client: httpx.AsyncClient, path: str, body: dict, start: float
+) -> Optional[float]:
+    """Reads an event stream until it ends.
+
+    Args:
+        client (httpx.AsyncClient): The HTTP client.
+        path (str): The path of the streaming route.
+        body (dict): The JSON request body.
+        start (float): The `time.perf_counter()` the turn started at.
+
+    Returns:
+        Optional[float]: Seconds from `start` until the first token, None if
+            no token arrived.
+
+    Raises:
+        RuntimeError: If the stream reported an error.
+    """
+    first_token = None
+    async with client.stream("POST", path, json=body) as response:
+        response.raise_for_status()
+        event = None
+        async for line in response.aiter_lines():
+            if line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:") and event == "token":
+                first_token = first_token or time.perf_counter() - start
+            elif line.startswith("data:") and event == "error":
+                raise RuntimeError(line[5:].strip())
+    return first_token
+
+
+async def ask(
+    client: httpx.AsyncClient,
+    mode: str,
+    thread_id: str,
+    character_ids: list[int],
+    query: str,
+) -> tuple[Optional[float], float]:
+    """Asks several characters the same question.
+
+    Args:
+        client (httpx.AsyncClient): The HTTP client.
+        mode (str): How the characters are asked, one of MODES.
+        thread_id (str): The ID of the chat thread.
+        character_ids (list[int]): The IDs of the characters.
+        query (str): The question.
+
+    Returns:
+        tuple[Optional[float], float]: Seconds until the first token (None if
+            no token arrived) and until all characters responded.
+    """
+    start = time.perf_counter()
+    if mode == "broadcast":
+        body = {"query": query, "character_ids": character_ids, "thread_id": thread_id}
+        first_token = await read_stream(client, "/chats/broadcast", body, start)
+    else:
+        first_token = None
+        for character_id in character_ids:
+            body = {"query": query, "character_id": character_id}
+            body["thread_id"] = thread_id
+            token = await read_stream(client, "/chats/stream", body, start)
+            first_token = first_token or token
+    return first_token, time.perf_counter() - start
+
+
+async def run_sessions(mode: str, args: argparse.Namespace, base_url: str) -> dict:
+    """Drives the concurrent chat sessions in a mode.
+
+    Args:
+        mode (str): How the characters are asked, one of MODES.
+        args (argparse.Namespace): The benchmark arguments.
+        base_url (str): The URL of the app.
+
+    Returns:
+        dict: The results of the mode.
+    """
+    rng = random.Random(args.seed)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    first_tokens: list[float] = []
+    rounds: list[float] = []
+    errors: list[str] = []
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=120) as client:
+        characters = (await client.get("/characters?columns=id")).json()
+        character_ids = [character["id"] for character in characters]
+
+        async def session() -> None:
+            async with semaphore:
+                thread_id = str(uuid.uuid4())
+                session_ids = rng.sample(character_ids, args.characters_per_turn)
+                for _ in range(args.turns):
+                    try:
+                        first_token, total = await ask(
+                            client, mode, thread_id, session_ids, rng.choice(QUESTIONS)
+                        )
+                    except (httpx.HTTPError, RuntimeError) as exc:
+                        errors.append(repr(exc))
+                        continue
+                    if first_token is not None:
+                        first_tokens.append(first_token)
+                    rounds.append(total)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(session() for _ in range(args.sessions)))
+        duration = time.perf_counter() - start
+        metrics = await scrape_metrics(
+            client, ["query_embedding_cache", "query_embedding_batch_size_count"]
+        )
+
+    return {
+        "rounds": len(rounds),
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "throughput_rounds_per_s": len(rounds) / duration,
+        "time_to_first_token_s": percentiles(first_tokens),
+        "all_responses_s": percentiles(rounds),
+        "metrics": metrics,
+    }
+
+
+def run_mode(mode: str, args: argparse.Namespace) -> dict:
+    """Starts a fresh app and fake Mistral API and benchmarks a mode.
+
+    Args:
+        mode (str): How the characters are asked, one of MODES.
+        args (argparse.Namespace): The benchmark arguments.
+
+    Returns:
+        dict: The results of the mode.
+    """
+    with serve_app(
+        args.characters,
+        args.seed,
+        args.port,
+        args.fake_port,
+        [
+            f"--latency-ms={args.latency_ms}",
+            f"--tokens-per-second={args.tokens_per_second}",
+        ],
+    ) as app:
+        if app is None:
+            return {"error": "app did not become ready"}
+        return asyncio.run(run_sessions(mode, args, app[0]))
+
+
+def main() -> None:
+    """Benchmarks both modes and prints the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=5)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--characters-per-turn", type=int, default=3)
+    parser.add_argument("--characters", type=int, default=20)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--fake-port", type=int, default=8099)
+    parser.add_argument("--latency-ms", type=float, default=200.0)
+    parser.add_argument("--tokens-per-second", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Append the result to this JSONL file.")
+    args = parser.parse_args()
+
+    result = {
+        "benchmark": "broadcast",
+        "revision": git_revision(),
+        "config": vars(args),
+        **{mode: run_mode(mode, args) for mode in args.modes},
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "a") as file:
+            file.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
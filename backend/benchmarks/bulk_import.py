@@ -0,0 +1,182 @@
+"""Compares creating characters one by one with the bulk import.
+
+Starts the fake Mistral API and the app once per mode and uploads
+`--rows` generated characters. With `single`, every character is a
+`POST /characters` request (on a keep-alive connection), which commits
+and refreshes it on its own and enqueues its embedding and summary jobs.
+With `ndjson` and `array`, all characters are streamed in one
+`POST /characters/import` request, as NDJSON or as a JSON array; jobs are
+only enqueued with `--enqueue-jobs`. Reports the import throughput, the
+app CPU time per row and the growth of the app's resident memory during
+the upload as JSON. The memory growth of the bulk modes should not
+depend on `--rows`.
+
+Usage (from the `backend` directory):
+    python -m benchmarks.bulk_import --rows 2000
+    python -m benchmarks.bulk_import --modes ndjson array --rows 50000
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import AsyncIterator, Iterator
+
+import httpx
+
+from benchmarks.fixtures import make_character
+from benchmarks.load_test import serve_app
+from benchmarks.utils import cpu_seconds, git_revision, rss_mb
+
+MODES = ("single", "ndjson", "array")
+
+# Upload chunk size, similar to what clients send
+CHUNK_BYTES = 64 * 1024
+
+
+def generate_rows(n_rows: int, seed: int) -> Iterator[dict]:
+    """Generates characters as `POST /characters` bodies.
+
+    Args:
+        n_rows (int): The number of characters.
+        seed (int): Seed for the generated characters.
+
+    Yields:
+        dict: The characters.
+    """
+    rng = random.Random(seed)
+    for index in range(n_rows):
+        yield make_character(index, rng).model_dump(exclude={"id", "data_length"})
+
+
+async def upload_body(mode: str, n_rows: int, seed: int) -> AsyncIterator[bytes]:
+    """Streams the generated characters in the format of a bulk mode.
+
+    Args:
+        mode (str): `ndjson` or `array`.
+        n_rows (int): The number of characters.
+        seed (int): Seed for the generated characters.
+
+    Yields:
+        bytes: Chunks of about CHUNK_BYTES.
+    """
+    parts = ["["] if mode == "array" else []
+    size = 0
+    for index, row in enumerate(generate_rows(n_rows, seed)):
+        separator = "," if mode == "array" and index else ""
+        part = separator + json.dumps(row) + ("\n" if mode == "ndjson" else "")
+        parts.append(part)
+        size += len(part)
+        if size >= CHUNK_BYTES:
+            yield "".join(parts).encode()
+            parts, size = [], 0
+    if mode == "array":
+        parts.append("]")
+    yield "".join(parts).encode()
+
+
+async def run_import(
+    mode: str, args: argparse.Namespace, base_url: str, pid: int
+) -> dict:
+    """Imports the generated characters in a mode.
+
+    Args:
+        mode (str): How the characters are created, one of MODES.
+        args (argparse.Namespace): The benchmark arguments.
+        base_url (str): The URL of the app.
+        pid (int): The process ID of the app.
+
+    Returns:
+        dict: The results of the mode.
+    """
+    rss_start = rss_mb(pid) or 0.0
+    rss_peak = rss_start
+
+    async def sample_rss() -> None:
+        nonlocal rss_peak
+        while True:
+            rss_peak = max(rss_peak, rss_mb(pid) or 0.0)
+            await asyncio.sleep(0.05)
+
+    sampler = asyncio.create_task(sample_rss())
+    cpu_start = cpu_seconds(pid)
+    start = time.perf_counter()
+    async with httpx.AsyncClient(base_url=base_url, timeout=600) as client:
+        if mode == "single":
+            imported, failed = 0, 0
+            for row in generate_rows(args.rows, args.seed):
+                response = await client.post("/characters", json=row)
+                if response.status_code == 201:
+                    imported += 1
+                else:
+                    failed += 1
+            result = {"imported": imported, "failed": failed}
+        else:
+            response = await client.post(
+                "/characters/import",
+                params={"enqueue_jobs": args.enqueue_jobs},
+                content=upload_body(mode, args.rows, args.seed),
+            )
+            result = response.json()
+            result.pop("errors", None)
+    duration = time.perf_counter() - start
+    cpu_end = cpu_seconds(pid)
+    sampler.cancel()
+
+    return {
+        **result,
+        "duration_s": duration,
+        "rows_per_s": args.rows / duration,
+        "app_cpu_ms_per_row": (
+            (cpu_end - cpu_start) * 1000 / args.rows
+            if cpu_start is not None and cpu_end is not None
+            else None
+        ),
+        "rss_growth_mb": rss_peak - rss_start,
+    }
+
+
+def run_mode(mode: str, args: argparse.Namespace) -> dict:
+    """Starts a fresh app and fake Mistral API and benchmarks a mode.
+
+    Args:
+        mode (str): How the characters are created, one of MODES.
+        args (argparse.Namespace): The benchmark arguments.
+
+    Returns:
+        dict: The results of the mode.
+    """
+    # One seeded character, so the warm-up does not scrape the wiki
+    with serve_app(1, args.seed, args.port, args.fake_port, []) as app:
+        if app is None:
+            return {"error": "app did not become ready"}
+        return asyncio.run(run_import(mode, args, *app))
+
+
+def main() -> None:
+    """Benchmarks the modes and prints the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--enqueue-jobs", action="store_true")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--fake-port", type=int, default=8099)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Append the result to this JSONL file.")
+    args = parser.parse_args()
+
+    result = {
+        "benchmark": "bulk_import",
+        "revision": git_revision(),
+        "config": vars(args),
+        **{mode: run_mode(mode, args) for mode in args.modes},
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "a") as file:
+            file.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
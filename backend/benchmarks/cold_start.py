@@ -0,0 +1,80 @@
+"""Measures the cold-start time of the backend.
+
+Starts the app in a fresh uvicorn process and records the time until the
+first successful response (`/healthz`) and until the app is ready (`/readyz`).
+
+Usage (from the `backend` directory):
+    python -m benchmarks.cold_start --runs 5 --output benchmarks/results.jsonl
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Optional
+
+import httpx
+
+from benchmarks.utils import git_revision, wait_for
+
+
+def measure_cold_start(port: int, timeout: float) -> dict[str, Optional[float]]:
+    """Starts a fresh app process and measures its startup timings.
+
+    Args:
+        port (int): The port to run the app on.
+        timeout (float): Maximum seconds to wait for the app to become ready.
+
+    Returns:
+        dict[str, Optional[float]]: Seconds until the first response and
+            until readiness (None if the app did not become ready in time).
+    """
+    url = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.app:app", "--port", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        with httpx.Client() as client:
+            first_response = wait_for(client, f"{url}/healthz", start, timeout)
+            ready = wait_for(client, f"{url}/readyz", start, timeout)
+    finally:
+        process.terminate()
+        process.wait()
+
+    return {"first_response_s": first_response, "ready_s": ready}
+
+
+def main() -> None:
+    """Runs the cold-start benchmark and prints the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--output", help="Append the result to this JSONL file.")
+    args = parser.parse_args()
+
+    runs = [measure_cold_start(args.port, args.timeout) for _ in range(args.runs)]
+    result: dict[str, Any] = {
+        "benchmark": "cold_start",
+        "revision": git_revision(),
+        "runs": runs,
+    }
+    for key in ("first_response_s", "ready_s"):
+        values = [run[key] for run in runs if run[key] is not None]
+        result[f"median_{key}"] = statistics.median(values) if values else None
+
+    print(json.dumps(result, indent=2))
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "a") as file:
+            file.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""A local stand-in for the Mistral chat completion and embedding APIs.
+
+Responds like the real API (including SSE streaming) with configurable
+latency, token rate and error rate, so benchmarks cost no API money and
+do not depend on the network.
+
+Usage (from the `backend` directory):
+    python -m benchmarks.fake_mistral --port 8099 --latency-ms 300
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import time
+from typing import Any, AsyncGenerator
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from starlette.responses import StreamingResponse
+
+EMBEDDING_SIZE = 1024
+
+ANSWER = (
+    "Hey, I'm gonna become Hokage, believe it! Training with my team is "
+    "the best, even when Sasuke acts all cool. I'll never give up on my "
+    "friends, that's my ninja way!"
+)
+# Answer in JSON mode, with the fields of the app's combined preprocessing call
+JSON_ANSWER = json.dumps(
+    {
+        "user_information": "A curious fan who asks about teams and dreams.",
+        "search_query": "team dream hokage",
+    }
+)
+
+
+class FakeMistralConfig(BaseModel):
+    """Configuration of the fake Mistral API.
+
+    Attributes:
+        latency_ms (float): Mean latency until the first token or response.
+        latency_distribution (str): 'constant', 'exponential' or 'pareto'
+            (heavy-tailed) distribution of the latency.
+        tokens_per_second (float): Rate at which streamed tokens are sent.
+        error_rate (float): Fraction of requests answered with `error_status`.
+        error_status (int): The HTTP status of failed requests, e.g. 429.
+    """
+
+    latency_ms: float = 200.0
+    latency_distribution: str = "constant"
+    tokens_per_second: float = 60.0
+    error_rate: float = 0.0
+    error_status: int = 429
+
+    def sample_latency(self, rng: random.Random) -> float:
+        """Samples a latency in seconds from the configured distribution.
+
+        Args:
+            rng (random.Random): The random number generator.
+
+        Returns:
+            float: The latency in seconds.
+        """
+        mean = self.latency_ms / 1000
+        if self.latency_distribution == "exponential":
+            return rng.expovariate(1 / mean) if mean else 0.0
+        if self.latency_distribution == "pareto":
+            # Shape 1.5 has a finite mean but a heavy tail, scaled to `mean`
+            return mean / 3 * rng.paretovariate(1.5)
+        return mean
+
+
+def embed(text: str) -> list[float]:
+    """Deterministically embeds a text, texts sharing words are similar.
+
+    Args:
+        text (str): The text to embed.
+
+    Returns:
+        list[float]: The normalized embedding.
+    """
+    vector = [0.0] * EMBEDDING_SIZE
+    for word in text.lower().split():
+        digest = hashlib.md5(word.strip(".,!?").encode()).digest()
+        vector[int.from_bytes(digest[:4], "little") % EMBEDDING_SIZE] += 1.0
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+def count_tokens(messages: list[dict[str, Any]]) -> int:
+    """Roughly counts the prompt tokens of chat messages.
+
+    Args:
+        messages (list[dict[str, Any]]): The chat messages.
+
+    Returns:
+        int: The approximate number of tokens.
+    """
+    return sum(len(str(message.get("content", ""))) // 4 for message in messages)
+
+
+def create_app(config: FakeMistralConfig) -> FastAPI:
+    """Creates the fake Mistral API.
+
+    Args:
+        config (FakeMistralConfig): The latency, token rate and error rate.
+
+    Returns:
+        FastAPI: The app serving `/v1/chat/completions` and `/v1/embeddings`.
+    """
+    app = FastAPI()
+    rng = random.Random(0)
+
+    def error_response() -> JSONResponse:
+        return JSONResponse(
+            status_code=config.error_status,
+            content={"message": "Fake error"},
+            headers={"Retry-After": "1"},
+        )
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request) -> Any:
+        body = await request.json()
+        await asyncio.sleep(config.sample_latency(rng))
+        if rng.random() < config.error_rate:
+            return error_response()
+
+        json_mode = (body.get("response_format") or {}).get("type") == "json_object"
+        answer = JSON_ANSWER if json_mode else ANSWER
+        tokens = [token + " " for token in answer.split(" ")]
+        usage = {
+            "prompt_tokens": count_tokens(body["messages"]),
+            "completion_tokens": len(tokens),
+            "total_tokens": count_tokens(body["messages"]) + len(tokens),
+        }
+        base = {"id": "fake", "created": int(time.time()), "model": body["model"]}
+
+        if not body.get("stream"):
+            return {
+                **base,
+                "object": "chat.completion",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": answer},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": usage,
+            }
+
+        async def events() -> AsyncGenerator[str, None]:
+            for i, token in enumerate(tokens):
+                last = i == len(tokens) - 1
+                chunk = {
+                    **base,
+                    "object": "chat.completion.chunk",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "delta": {"role": "assistant", "content": token},
+                            "finish_reason": "stop" if last else None,
+                        }
+                    ],
+                }
+                if last:
+                    chunk["usage"] = usage
+                yield f"data: {json.dumps(chunk)}\n\n"
+                await asyncio.sleep(1 / config.tokens_per_second)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request) -> Any:
+        body = await request.json()
+        await asyncio.sleep(config.sample_latency(rng) / 4)
+        if rng.random() < config.error_rate:
+            return error_response()
+        return {
+            "id": "fake",
+            "object": "list",
+            "model": body["model"],
+            "data": [
+                {"object": "embedding", "index": i, "embedding": embed(text)}
+                for i, text in enumerate(body["input"])
+            ],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        }
+
+    return app
+
+
+def main() -> None:
+    """Runs the fake Mistral API."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8099)
+    for name, field in FakeMistralConfig.model_fields.items():
+        parser.add_argument(
+            f"--{name.replace('_', '-')}", type=field.annotation, default=field.default
+        )
+    args = parser.parse_args()
+    config = FakeMistralConfig(
+        **{name: getattr(args, name) for name in FakeMistralConfig.model_fields}
+    )
+    uvicorn.run(create_app(config), port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
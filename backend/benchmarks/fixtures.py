@@ -0,0 +1,183 @@
+import html
+import random
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+
+from database.database import Database
+from datamodels.models import Character
+
+WORDS = (
+    "ninja village hokage chakra jutsu team mission sensei clan shadow clone "
+    "sage mode tailed beast leaf sand mist cloud stone akatsuki rival friend "
+    "training scroll kunai shuriken summoning genjutsu taijutsu ninjutsu war "
+    "exam chunin jonin anbu kekkei genkai sharingan byakugan rinnegan dream "
+    "protect believe promise bond loneliness courage power peace revenge"
+).split()
+
+SECTIONS = [
+    ("Background", None, None),
+    ("Personality", None, None),
+    ("Appearance", None, None),
+    ("Abilities", "Ninjutsu", None),
+    ("Abilities", "Taijutsu", None),
+    ("Abilities", "Chakra", "Nature Transformation"),
+    ("Part I", "Prologue", None),
+    ("Part I", "Chunin Exams", None),
+    ("Part II", "Kazekage Rescue Mission", None),
+    ("Part II", "Fourth Shinobi World War", "Confrontation"),
+    ("Trivia", None, None),
+]
+
+
+def sentence(rng: random.Random, n_words: int = 14) -> str:
+    """Generates a wiki-like sentence.
+
+    Args:
+        rng (random.Random): The random number generator.
+        n_words (int, optional): The number of words. Defaults to 14.
+
+    Returns:
+        str: The sentence.
+    """
+    words = rng.choices(WORDS, k=n_words)
+    return " ".join(words).capitalize() + "."
+
+
+def paragraph(rng: random.Random, n_sentences: int = 6) -> str:
+    """Generates a wiki-like paragraph.
+
+    Args:
+        rng (random.Random): The random number generator.
+        n_sentences (int, optional): The number of sentences. Defaults to 6.
+
+    Returns:
+        str: The paragraph.
+    """
+    return " ".join(sentence(rng, rng.randint(8, 24)) for _ in range(n_sentences))
+
+
+def make_character(index: int, rng: random.Random) -> Character:
+    """Generates a character with realistically sized wiki data.
+
+    Args:
+        index (int): The index of the character, used for its name.
+        rng (random.Random): The random number generator.
+
+    Returns:
+        Character: The (not yet stored) character.
+    """
+    data = [
+        {
+            "text": " ".join(paragraph(rng) for _ in range(rng.randint(1, 4))),
+            "tag_1": tag_1,
+            "tag_2": tag_2,
+            "tag_3": tag_3,
+        }
+        for tag_1, tag_2, tag_3 in SECTIONS
+    ]
+    return Character(
+        name=f"Character {index}",
+        href=f"https://naruto.fandom.com/wiki/Character_{index}",
+        image_url=f"https://static.wikia.nocookie.net/naruto/images/{index}.png",
+        summary=paragraph(rng, 3),
+        personality=paragraph(rng, 8),
+        summarized_personality=paragraph(rng, 2),
+        data=data,
+        data_length=sum(len(section["text"]) for section in data),
+    )
+
+
+def seed_database(db_file: str, n_characters: int, seed: int = 0) -> None:
+    """Creates an SQLite database populated with generated characters.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        n_characters (int): The number of characters to create.
+        seed (int, optional): Seed for the generated data. Defaults to 0.
+    """
+    rng = random.Random(seed)
+    db = Database(db_file)
+    db.session.add_all(make_character(i, rng) for i in range(n_characters))
+    db.session.commit()
+
+
+def make_wiki_page(character: Character, rng: random.Random) -> str:
+    """Renders a character as HTML shaped like a Naruto Wiki character page.
+
+    Mirrors the parts of the real page the scraper parses (infobox image,
+    headings with edit links, paragraphs with reference marks, 'See also'
+    notes) and the navigation boilerplate it has to skip.
+
+    Args:
+        character (Character): The character to render.
+        rng (random.Random): The random number generator.
+
+    Returns:
+        str: The HTML page.
+    """
+
+    def heading(level: int, text: str) -> str:
+        return (
+            f'<h{level}><span class="mw-headline">{html.escape(text)}</span>'
+            f'<span class="mw-editsection">[<a href="#"></a>]</span></h{level}>'
+        )
+
+    def paragraphs(text: str) -> str:
+        return "".join(
+            f"<p>{html.escape(part)}.<sup>[{rng.randint(1, 99)}]</sup></p>"
+            for part in text.split(". ")
+            if part
+        )
+
+    body = [
+        '<table class="infobox"><tr><td class="imagecell">'
+        f'<img src="{character.image_url}/revision/latest?cb=2016"/></td></tr>'
+        + "".join(
+            f"<tr><th>{word}</th><td>{sentence(rng, 3)}</td></tr>"
+            for word in rng.choices(WORDS, k=30)
+        )
+        + "</table>",
+        paragraphs(character.summary),
+    ]
+    previous = (None, None)
+    for section in character.data:
+        if section["tag_1"] != previous[0]:
+            body.append(heading(2, section["tag_1"]))
+            body.append(f"<p>Main article: {section['tag_1']}</p>")
+        if section["tag_2"] and section["tag_2"] != previous[1]:
+            body.append(heading(3, section["tag_2"]))
+        if section["tag_3"]:
+            body.append(heading(4, section["tag_3"]))
+        body.append(paragraphs(section["text"]))
+        previous = (section["tag_1"], section["tag_2"])
+
+    navigation = "".join(
+        '<div class="navbox"><ul>'
+        + "".join(f'<li><a href="/wiki/{w}">{w}</a></li>' for w in WORDS)
+        + "</ul></div>"
+        for _ in range(20)
+    )
+    return (
+        f"<html><head><title>{character.name}</title></head><body>"
+        f'<div class="page">{navigation}'
+        f'<div class="mw-parser-output">{"".join(body)}</div>'
+        f"{navigation}</div></body></html>"
+    )
+
+
+def make_chat_history(n_messages: int, rng: random.Random) -> list[BaseMessage]:
+    """Generates a chat history alternating between human and AI messages.
+
+    Args:
+        n_messages (int): The number of messages.
+        rng (random.Random): The random number generator.
+
+    Returns:
+        list[BaseMessage]: The chat history, oldest message first.
+    """
+    return [
+        (HumanMessage if i % 2 == 0 else AIMessage)(
+            content=paragraph(rng, rng.randint(1, 3))
+        )
+        for i in range(n_messages)
+    ]
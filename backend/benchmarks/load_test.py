@@ -0,0 +1,313 @@
+"""Load-tests the backend against a local fake Mistral API.
+
+Starts the fake Mistral API and the app (with a generated character
+database) in separate processes, then drives concurrent chat sessions:
+each session picks a character, chats for several turns and fetches the
+chat history. Reports throughput, time-to-first-token and full-turn
+latency percentiles and the RSS growth of the app as JSON. App metrics
+can be added to the report by name prefix, e.g. `--metric query_embedding`.
+
+Usage (from the `backend` directory):
+    python -m benchmarks.load_test --sessions 50 --concurrency 10 --turns 3
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional, Sequence
+
+import httpx
+from prometheus_client.parser import text_string_to_metric_families
+
+from benchmarks.fixtures import seed_database
+from benchmarks.utils import git_revision, percentiles, rss_mb, wait_for
+
+QUESTIONS = [
+    "Who are you?",
+    "Tell me about your team.",
+    "What is your dream?",
+    "What was your hardest mission?",
+    "Who is your rival?",
+]
+
+
+def start_process(args: list[str], env: dict[str, str]) -> subprocess.Popen:
+    """Starts a Python module in a new process.
+
+    Args:
+        args (list[str]): The arguments passed to `python -m`.
+        env (dict[str, str]): Environment variables overriding the current ones.
+
+    Returns:
+        subprocess.Popen: The started process.
+    """
+    return subprocess.Popen(
+        [sys.executable, "-m", *args],
+        env={**os.environ, **env},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+@contextmanager
+def serve_app(
+    n_characters: int,
+    seed: int,
+    port: int,
+    fake_port: int,
+    fake_options: Sequence[str],
+    app_options: Sequence[str] = (),
+) -> Iterator[Optional[tuple[str, int]]]:
+    """Runs the app against the fake Mistral API, with a generated database.
+
+    Args:
+        n_characters (int): The number of characters in the database.
+        seed (int): Seed for the generated characters.
+        port (int): The port of the app.
+        fake_port (int): The port of the fake Mistral API.
+        fake_options (Sequence[str]): The command line options of the fake API.
+        app_options (Sequence[str], optional): Additional uvicorn options.
+
+    Yields:
+        Optional[tuple[str, int]]: The URL and the process ID of the app,
+            None if it did not become ready.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_file = os.path.join(tmp_dir, "database.sqlite3")
+        seed_database(db_file, n_characters, seed)
+        env = {
+            "NARUTO_WIKI_DB_FILE": db_file,
+            "SESSION_DB_FILE": os.path.join(tmp_dir, "sessions.sqlite3"),
+            "JOBS_DB_FILE": os.path.join(tmp_dir, "jobs.sqlite3"),
+            "VECTOR_DB_DIR": os.path.join(tmp_dir, "vectordb"),
+            "MISTRAL_BASE_URL": f"http://127.0.0.1:{fake_port}/v1",
+            "MISTRAL_API_KEY": "fake",
+            "WARMUP_PRELOAD_CHARACTERS": "0",
+        }
+        fake = start_process(
+            ["benchmarks.fake_mistral", f"--port={fake_port}", *fake_options], env
+        )
+        app = start_process(
+            ["uvicorn", "app.app:app", f"--port={port}", *app_options], env
+        )
+        base_url = f"http://127.0.0.1:{port}"
+        try:
+            with httpx.Client() as client:
+                ready = wait_for(client, f"{base_url}/readyz", time.perf_counter(), 120)
+            yield (base_url, app.pid) if ready else None
+        finally:
+            for process in (app, fake):
+                process.terminate()
+                process.wait()
+
+
+async def chat_turn(
+    client: httpx.AsyncClient, thread_id: str, character_id: int, query: str
+) -> tuple[Optional[float], float]:
+    """Sends one chat message and reads the streamed response.
+
+    Args:
+        client (httpx.AsyncClient): The HTTP client.
+        thread_id (str): The ID of the chat thread.
+        character_id (int): The ID of the character.
+        query (str): The message.
+
+    Returns:
+        tuple[Optional[float], float]: Seconds until the first token (None if
+            no token arrived) and until the response was complete.
+
+    Raises:
+        RuntimeError: If the stream reported an error.
+    """
+    start = time.perf_counter()
+    first_token = None
+    body = {"query": query, "character_id": character_id, "thread_id": thread_id}
+    async with client.stream("POST", "/chats/stream", json=body) as response:
+        response.raise_for_status()
+        event = None
+        async for line in response.aiter_lines():
+            if line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:") and event == "token" and not first_token:
+                first_token = time.perf_counter() - start
+            elif line.startswith("data:") and event == "error":
+                raise RuntimeError(line[5:].strip())
+    return first_token, time.perf_counter() - start
+
+
+async def session(
+    client: httpx.AsyncClient,
+    character_ids: list[int],
+    turns: int,
+    rng: random.Random,
+    results: dict[str, list],
+) -> None:
+    """Runs a chat session and records the latency of each turn.
+
+    Args:
+        client (httpx.AsyncClient): The HTTP client.
+        character_ids (list[int]): The IDs of the characters to pick from.
+        turns (int): The number of messages to send.
+        rng (random.Random): The random number generator.
+        results (dict[str, list]): Collects latencies and errors.
+    """
+    thread_id = str(uuid.uuid4())
+    character_id = rng.choice(character_ids)
+    for _ in range(turns):
+        try:
+            first_token, total = await chat_turn(
+                client, thread_id, character_id, rng.choice(QUESTIONS)
+            )
+        except (httpx.HTTPError, RuntimeError) as exc:
+            results["errors"].append(repr(exc))
+            continue
+        if first_token is not None:
+            results["time_to_first_token"].append(first_token)
+        results["turn"].append(total)
+    response = await client.get(f"/chats/{thread_id}/{character_id}")
+    if not response.is_success:
+        results["errors"].append(f"history: {response.status_code}")
+
+
+async def scrape_metrics(
+    client: httpx.AsyncClient, prefixes: list[str]
+) -> dict[str, float]:
+    """Reads the app metrics whose names start with one of the prefixes.
+
+    Args:
+        client (httpx.AsyncClient): The HTTP client of the app.
+        prefixes (list[str]): The metric name prefixes.
+
+    Returns:
+        dict[str, float]: The values by sample name and labels.
+    """
+    if not prefixes:
+        return {}
+    response = await client.get("/metrics")
+    metrics = {}
+    for family in text_string_to_metric_families(response.text):
+        for sample in family.samples:
+            if not sample.name.startswith(tuple(prefixes)):
+                continue
+            if sample.name.endswith("_created"):
+                continue
+            labels = ",".join(f"{k}={v}" for k, v in sample.labels.items())
+            metrics[f"{sample.name}{{{labels}}}"] = sample.value
+    return metrics
+
+
+async def run_load(args: argparse.Namespace, base_url: str, pid: int) -> dict:
+    """Drives the concurrent chat sessions against the app.
+
+    Args:
+        args (argparse.Namespace): The benchmark arguments.
+        base_url (str): The URL of the app.
+        pid (int): The process ID of the app, for measuring its memory.
+
+    Returns:
+        dict: The benchmark results.
+    """
+    rng = random.Random(args.seed)
+    results: dict[str, list] = {"time_to_first_token": [], "turn": [], "errors": []}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+
+    async with httpx.AsyncClient(
+        base_url=base_url, timeout=args.timeout, limits=limits
+    ) as client:
+        characters = (await client.get("/characters?columns=id")).json()
+        character_ids = [character["id"] for character in characters]
+
+        async def limited_session() -> None:
+            async with semaphore:
+                await session(client, character_ids, args.turns, rng, results)
+
+        rss_start = rss_mb(pid)
+        start = time.perf_counter()
+        await asyncio.gather(*(limited_session() for _ in range(args.sessions)))
+        duration = time.perf_counter() - start
+        rss_end = rss_mb(pid)
+        metrics = await scrape_metrics(client, args.metric)
+
+    return {
+        "turns": len(results["turn"]),
+        "errors": len(results["errors"]),
+        "error_samples": results["errors"][:5],
+        "duration_s": duration,
+        "throughput_turns_per_s": len(results["turn"]) / duration,
+        "time_to_first_token_s": percentiles(results["time_to_first_token"]),
+        "turn_s": percentiles(results["turn"]),
+        "rss_start_mb": rss_start,
+        "rss_end_mb": rss_end,
+        "rss_growth_mb": (
+            rss_end - rss_start if rss_start is not None and rss_end else None
+        ),
+        "metrics": metrics,
+    }
+
+
+def main() -> None:
+    """Runs the load test and prints the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--characters", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--fake-port", type=int, default=8099)
+    parser.add_argument("--latency-ms", type=float, default=200.0)
+    parser.add_argument("--latency-distribution", default="constant")
+    parser.add_argument("--tokens-per-second", type=float, default=60.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Append the result to this JSONL file.")
+    parser.add_argument(
+        "--metric",
+        action="append",
+        default=[],
+        help="Report the app metrics with this name prefix (repeatable).",
+    )
+    args = parser.parse_args()
+
+    with serve_app(
+        args.characters,
+        args.seed,
+        args.port,
+        args.fake_port,
+        [
+            f"--latency-ms={args.latency_ms}",
+            f"--latency-distribution={args.latency_distribution}",
+            f"--tokens-per-second={args.tokens_per_second}",
+            f"--error-rate={args.error_rate}",
+        ],
+        [f"--workers={args.workers}"],
+    ) as app:
+        if app is not None:
+            result: dict[str, Any] = asyncio.run(run_load(args, *app))
+        else:
+            result = {"error": "app did not become ready"}
+
+    result = {
+        "benchmark": "load_test",
+        "revision": git_revision(),
+        "config": vars(args),
+        **result,
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "a") as file:
+            file.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
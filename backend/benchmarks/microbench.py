@@ -0,0 +1,239 @@
+"""Microbenchmarks for the CPU-bound hot paths of the backend.
+
+Times wiki page parsing, loading and splitting character documents, chat
+history formatting, fitting the prompt into its token budget and prompt
+rendering, response cache lookups, query parameter parsing and row-to-dict
+conversion on generated fixtures (wiki pages, a populated SQLite file and
+long chat histories). Runs fully offline.
+
+Save a baseline, then compare a later revision against it; the command
+exits with status 1 if any benchmark got slower than the threshold:
+    python -m benchmarks.microbench --save baseline.json
+    python -m benchmarks.microbench --compare baseline.json --threshold 0.25
+
+Usage (from the `backend` directory):
+    python -m benchmarks.microbench
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import timeit
+from typing import Callable
+
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from starlette.requests import Request
+
+from benchmarks.fixtures import (
+    make_character,
+    make_chat_history,
+    make_wiki_page,
+    seed_database,
+)
+from benchmarks.utils import git_revision
+from database.database import Database
+from datamodels.enums import Sender
+from datamodels.models import Character, GetCharactersParams
+from datamodels.state import State
+from llm.context import ContextAssembler
+from llm.prompts import Prompts
+from llm.rag import RAG
+from llm.response_cache import ResponseCache
+from scraper.scraper import NarutoWikiScraper
+
+
+def make_benchmarks(
+    db_file: str, n_characters: int, n_messages: int, seed: int
+) -> dict[str, Callable[[], object]]:
+    """Builds the fixtures and the functions to benchmark.
+
+    Args:
+        db_file (str): The path of the SQLite file to populate.
+        n_characters (int): The number of characters in the database.
+        n_messages (int): The length of the chat history.
+        seed (int): Seed for the generated fixtures.
+
+    Returns:
+        dict[str, Callable[[], object]]: The benchmarks by name.
+    """
+    rng = random.Random(seed)
+    seed_database(db_file, n_characters, seed)
+    db = Database(db_file)
+    rag = RAG(db)
+
+    character = make_character(0, rng)
+    page = make_wiki_page(character, rng)
+    stored_character = db.get_by_id(1, Character)
+    documents = rag.load_character_data(1)
+
+    prompts = Prompts(stored_character)
+    state = State(
+        input="What is your dream?",
+        user_information="A curious fan of the series.",
+        chat_history=make_chat_history(n_messages, rng),
+        chat_summary="The human asked about the character's team and rivals.",
+        context="",
+        answer="",
+    )
+    prompt_inputs = {
+        "input": state["input"],
+        "chat_history": state["chat_history"],
+        "user_information": state["user_information"],
+        "chat_summary": state["chat_summary"],
+        "context": documents[:4],
+    }
+    chat_prompt = ChatPromptTemplate.from_messages(
+        [
+            (Sender.system, prompts.get_system_prompt()),
+            MessagesPlaceholder(variable_name="chat_history"),
+            (Sender.human, "{input}"),
+        ]
+    )
+    # Mistral embeddings have 1024 dimensions
+    response_cache = ResponseCache(max_entries=n_messages)
+    for i in range(n_messages):
+        embedding = [rng.gauss(0, 1) for _ in range(1024)]
+        response_cache.store(1, "stranger", embedding, f"Answer {i}")
+    query_embedding = [rng.gauss(0, 1) for _ in range(1024)]
+    scope = {
+        "type": "http",
+        "query_string": b"columns=id&columns=name&columns=summary"
+        b"&order_by=data_length&asc=false&limit=100",
+        "headers": [],
+    }
+    all_columns = GetCharactersParams.from_request(
+        Request({"type": "http", "query_string": b"limit=100", "headers": []})
+    )
+    one_column = GetCharactersParams.from_request(
+        Request({"type": "http", "query_string": b"columns=id", "headers": []})
+    )
+
+    return {
+        "extract_character_data": lambda: NarutoWikiScraper.extract_character_data(
+            page, character.name, character.href
+        ),
+        "load_character_data": lambda: rag.load_character_data(1),
+        "split_documents": lambda: RAG.split_documents(documents),
+        "format_chat_history": lambda: prompts._format_chat_history(state),
+        "preprocessing_prompts": lambda: (
+            prompts.get_contextualize_q_system_prompt(state),
+            prompts.get_summarize_chat_history_prompt(
+                state["chat_summary"], state["chat_history"][:6]
+            ),
+            prompts.get_characterize_user_prompt(state),
+        ),
+        "assemble_context": lambda: ContextAssembler(prompts.get_system_prompt()).fit(
+            prompt_inputs
+        ),
+        "render_chat_prompt": lambda: chat_prompt.invoke(
+            {
+                **prompt_inputs,
+                "context": "\n\n".join(doc.page_content for doc in documents[:4]),
+            }
+        ),
+        "response_cache_lookup": lambda: response_cache.lookup(
+            1, "stranger", query_embedding
+        ),
+        "get_characters_params": lambda: GetCharactersParams.from_request(
+            Request(scope)
+        ),
+        "database_get_all_columns": lambda: db.get(all_columns),
+        "database_get_one_column": lambda: db.get(one_column),
+    }
+
+
+def measure(function: Callable[[], object], repeat: int) -> dict[str, float]:
+    """Times a function, calling it often enough for stable measurements.
+
+    Args:
+        function (Callable[[], object]): The function to time.
+        repeat (int): The number of timing rounds.
+
+    Returns:
+        dict[str, float]: The median and minimum time per call in microseconds.
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    rounds = [time / number * 1e6 for time in timer.repeat(repeat, number)]
+    return {"median_us": statistics.median(rounds), "min_us": min(rounds)}
+
+
+def compare(
+    results: dict[str, dict[str, float]],
+    baseline: dict[str, dict[str, float]],
+    threshold: float,
+) -> list[str]:
+    """Compares benchmark results against a baseline.
+
+    Args:
+        results (dict[str, dict[str, float]]): The current results.
+        baseline (dict[str, dict[str, float]]): The baseline results.
+        threshold (float): The tolerated relative slowdown, e.g. 0.25 for 25%.
+
+    Returns:
+        list[str]: A description of every benchmark that regressed.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["median_us"] / baseline[name]["median_us"]
+        result["vs_baseline"] = ratio
+        if ratio > 1 + threshold:
+            regressions.append(f"{name}: {ratio:.2f}x slower than the baseline")
+    return regressions
+
+
+def main() -> None:
+    """Runs the microbenchmarks and prints the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--characters", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--filter", default="", help="Only run matching benchmarks.")
+    parser.add_argument("--save", help="Save the results as a baseline file.")
+    parser.add_argument("--compare", help="Compare against a baseline file.")
+    parser.add_argument("--threshold", type=float, default=0.25)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        benchmarks = make_benchmarks(
+            os.path.join(tmp_dir, "database.sqlite3"),
+            args.characters,
+            args.messages,
+            args.seed,
+        )
+        results = {
+            name: measure(function, args.repeat)
+            for name, function in benchmarks.items()
+            if args.filter in name
+        }
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+        regressions = compare(results, baseline, args.threshold)
+
+    output = {
+        "benchmark": "microbench",
+        "revision": git_revision(),
+        "config": vars(args),
+        "results": results,
+        "regressions": regressions,
+    }
+    print(json.dumps(output, indent=2))
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(output, file, indent=2)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""Measures the payload size and serialization CPU of `GET /characters`.
+
+Seeds a character database and compares, per request for `--limit`
+characters:
+- the serialization of the rows: validated through the response model and
+  encoded with the standard json module (FastAPI's default path) vs.
+  encoded with ujson without validation,
+- the body size and compression CPU without compression, with gzip and
+  with brotli,
+- the CPU time of the whole request in-process per `Accept-Encoding`,
+  served from the response cache, and of a revalidation (304).
+
+Reports the results as JSON.
+
+Usage (from the `backend` directory):
+    python -m benchmarks.payload --characters 100 --requests 50
+"""
+
+import argparse
+import gzip
+import json
+import os
+import tempfile
+import time
+from typing import Any, Callable
+
+import brotli
+from fastapi.responses import JSONResponse, UJSONResponse
+from pydantic import TypeAdapter
+
+from benchmarks.utils import git_revision
+
+ENCODINGS = {"identity": "identity", "gzip": "gzip", "br": "br"}
+
+
+def cpu_ms(call: Callable[[], Any], repeat: int) -> float:
+    """Measures the mean CPU time of a call.
+
+    Args:
+        call (Callable[[], Any]): The measured call.
+        repeat (int): The number of calls.
+
+    Returns:
+        float: The CPU milliseconds per call.
+    """
+    start = time.process_time()
+    for _ in range(repeat):
+        call()
+    return (time.process_time() - start) * 1000 / repeat
+
+
+def main() -> None:
+    """Runs the measurements and prints the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--characters", type=int, default=100)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Append the result to this JSONL file.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.environ["NARUTO_WIKI_DB_FILE"] = os.path.join(tmp_dir, "db.sqlite3")
+        os.environ["SESSION_DB_FILE"] = os.path.join(tmp_dir, "sessions.sqlite3")
+        os.environ["JOBS_DB_FILE"] = os.path.join(tmp_dir, "jobs.sqlite3")
+        os.environ["VECTOR_DB_DIR"] = os.path.join(tmp_dir, "vectordb")
+        os.environ["WARMUP_PRELOAD_CHARACTERS"] = "0"
+
+        # Imported after the environment points to the generated database
+        from fastapi.testclient import TestClient
+        from starlette.requests import Request
+
+        from app.app import app
+        from app.responses import exclude_defaults
+        from app.routes import db
+        from benchmarks.fixtures import seed_database
+        from datamodels.models import Character, GetCharactersParams
+        from utils.consts import COMPRESSION_BROTLI_QUALITY, COMPRESSION_GZIP_LEVEL
+
+        seed_database(os.environ["NARUTO_WIKI_DB_FILE"], args.characters, args.seed)
+        client = TestClient(app)
+        query = f"limit={args.limit}"
+        url = f"/characters?{query}"
+        request = Request({"type": "http", "query_string": query.encode()})
+        rows = db.get(GetCharactersParams.from_request(request))
+        adapter = TypeAdapter(list[Character])
+
+        def validated() -> bytes:
+            content = adapter.dump_python(
+                adapter.validate_python(rows), mode="json", exclude_defaults=True
+            )
+            return JSONResponse(content).body
+
+        def trusted() -> bytes:
+            return UJSONResponse(exclude_defaults(Character, rows)).body
+
+        body = trusted()
+        etag = client.get(url).headers["ETag"]
+        compressors: dict[str, Callable[[], bytes]] = {
+            "identity": lambda: body,
+            "gzip": lambda: gzip.compress(body, COMPRESSION_GZIP_LEVEL),
+            "br": lambda: brotli.compress(
+                body, mode=brotli.MODE_TEXT, quality=COMPRESSION_BROTLI_QUALITY
+            ),
+        }
+        result = {
+            "benchmark": "payload",
+            "revision": git_revision(),
+            "config": vars(args),
+            "serialization_cpu_ms": {
+                "validated_json": cpu_ms(validated, args.requests),
+                "trusted_ujson": cpu_ms(trusted, args.requests),
+            },
+            "payload_bytes": {
+                name: len(compress()) for name, compress in compressors.items()
+            },
+            "compression_cpu_ms": {
+                name: cpu_ms(compress, args.requests)
+                for name, compress in compressors.items()
+            },
+            "request_cpu_ms": {
+                name: cpu_ms(
+                    lambda: client.get(url, headers={"Accept-Encoding": encoding}),
+                    args.requests,
+                )
+                for name, encoding in ENCODINGS.items()
+            }
+            | {
+                "not_modified": cpu_ms(
+                    lambda: client.get(url, headers={"If-None-Match": etag}),
+                    args.requests,
+                )
+            },
+        }
+
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "a") as file:
+            file.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Compares the chat event stream with and without token coalescing.
+
+Runs many concurrent event streams fed by a synthetic token producer and
+reports the number of ASGI sends per response and the CPU time per stream.
+
+Usage (from the `backend` directory):
+    python -m benchmarks.stream_coalescing --streams 200 --tokens 300
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Any, AsyncGenerator
+
+from app.sse import EventStream, FlushPolicy
+from benchmarks.utils import git_revision
+from datamodels.enums import StreamEvent
+
+WORDS = "believe it I will become Hokage and protect everyone in the village".split()
+
+
+class ConnectedRequest:
+    """Stand-in for a request whose client never disconnects."""
+
+    async def is_disconnected(self) -> bool:
+        """Always reports a connected client."""
+        return False
+
+
+async def tokens(
+    n_tokens: int, tokens_per_second: float, seed: int
+) -> AsyncGenerator[tuple[StreamEvent, Any], None]:
+    """Yields short token events at roughly the given rate.
+
+    Args:
+        n_tokens (int): The number of tokens to yield.
+        tokens_per_second (float): The token rate.
+        seed (int): Seed for the token texts.
+
+    Yields:
+        tuple[StreamEvent, Any]: Token events of one to a few characters.
+    """
+    rng = random.Random(seed)
+    for i in range(n_tokens):
+        await asyncio.sleep(1 / tokens_per_second)
+        word = rng.choice(WORDS)
+        text = word[: rng.randint(1, 3)] if i % 2 else f" {word[3:]}"
+        if i % 25 == 24:
+            text += "."
+        yield StreamEvent.token, {"text": text}
+
+
+async def run(policy: FlushPolicy, args: argparse.Namespace) -> dict[str, float]:
+    """Runs concurrent streams with a flush policy and measures them.
+
+    Args:
+        policy (FlushPolicy): The flush policy to benchmark.
+        args (argparse.Namespace): The benchmark arguments.
+
+    Returns:
+        dict[str, float]: Sends and bytes per response and CPU ms per stream.
+    """
+    sends: list[int] = []
+    n_bytes: list[int] = []
+
+    async def consume(seed: int) -> None:
+        events = tokens(args.tokens, args.tokens_per_second, seed)
+        stream = EventStream(ConnectedRequest(), events, flush_policy=policy)
+        count = size = 0
+        async for message in stream.stream():
+            count += 1
+            size += len(message.encode())
+        sends.append(count)
+        n_bytes.append(size)
+
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    await asyncio.gather(*(consume(seed) for seed in range(args.streams)))
+    return {
+        "sends_per_response": sum(sends) / len(sends),
+        "bytes_per_response": sum(n_bytes) / len(n_bytes),
+        "cpu_ms_per_stream": 1000 * (time.process_time() - cpu_start) / args.streams,
+        "wall_s": time.perf_counter() - wall_start,
+    }
+
+
+def main() -> None:
+    """Runs the benchmark and prints the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--streams", type=int, default=200)
+    parser.add_argument("--tokens", type=int, default=300)
+    parser.add_argument("--tokens-per-second", type=float, default=100.0)
+    args = parser.parse_args()
+
+    result = {
+        "benchmark": "stream_coalescing",
+        "revision": git_revision(),
+        "uncoalesced": asyncio.run(run(FlushPolicy(max_bytes=0), args)),
+        "coalesced": asyncio.run(run(FlushPolicy(), args)),
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Compares the tail latency of chat turns with deadlines and hedging.
+
+Runs the load test against a fake Mistral API with heavy-tailed (pareto)
+latencies, once without deadlines, once with per-call deadlines of the
+preprocessing LLM calls and once with deadlines and hedged calls. The
+preprocessing calls run on every turn, so that their tail shows up in
+the time to first token. Reports the latency percentiles of each variant
+and the deadline and hedging metrics as JSON.
+
+Usage (from the `backend` directory):
+    python -m benchmarks.tail_latency --sessions 40 --concurrency 10 --turns 5
+"""
+
+import argparse
+import json
+
+from benchmarks.utils import git_revision, run_load_test
+
+# Preprocessing runs on every turn, with or without chat history
+PREPROCESSING_ENV = {
+    "PREPROCESSING_MIN_HISTORY_MESSAGES": "0",
+    "PREPROCESSING_REWRITE_MIN_HISTORY_MESSAGES": "0",
+    "PREPROCESSING_CHARACTERIZE_EVERY_N_TURNS": "1",
+    "RETRIEVAL_SPECULATIVE": "false",
+}
+
+
+def variants(args: argparse.Namespace) -> dict[str, dict[str, str]]:
+    """Returns the environment of each benchmarked variant.
+
+    Args:
+        args (argparse.Namespace): The benchmark arguments.
+
+    Returns:
+        dict[str, dict[str, str]]: The app environment by variant name.
+    """
+    no_deadlines = {
+        "PREPROCESSING_CHARACTERIZE_DEADLINE_S": "0",
+        "PREPROCESSING_CONTEXTUALIZE_DEADLINE_S": "0",
+        "LLM_HEDGING": "false",
+    }
+    deadlines = {
+        "PREPROCESSING_CHARACTERIZE_DEADLINE_S": str(args.deadline_s),
+        "PREPROCESSING_CONTEXTUALIZE_DEADLINE_S": str(args.deadline_s),
+        "LLM_HEDGING": "false",
+    }
+    hedging = deadlines | {
+        "LLM_HEDGING": "true",
+        "LLM_HEDGE_QUANTILE": str(args.hedge_quantile),
+        "LLM_HEDGE_MIN_SAMPLES": "20",
+    }
+    return {"baseline": no_deadlines, "deadlines": deadlines, "hedging": hedging}
+
+
+def main() -> None:
+    """Runs the variants and prints their results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sessions", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--latency-ms", type=float, default=300.0)
+    parser.add_argument("--deadline-s", type=float, default=2.0)
+    parser.add_argument("--hedge-quantile", type=float, default=0.9)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Append the result to this JSONL file.")
+    args = parser.parse_args()
+
+    results = {}
+    for name, env in variants(args).items():
+        load = run_load_test(
+            [
+                f"--sessions={args.sessions}",
+                f"--concurrency={args.concurrency}",
+                f"--turns={args.turns}",
+                f"--latency-ms={args.latency_ms}",
+                "--latency-distribution=pareto",
+                f"--seed={args.seed}",
+                "--metric=llm_hedged",
+                "--metric=chat_preprocessing_steps",
+            ],
+            PREPROCESSING_ENV | env,
+        )
+        results[name] = {
+            "env": env,
+            "turns": load.get("turns"),
+            "errors": load.get("errors"),
+            "time_to_first_token_s": load.get("time_to_first_token_s"),
+            "turn_s": load.get("turn_s"),
+            "metrics": load.get("metrics"),
+        }
+
+    result = {
+        "benchmark": "tail_latency",
+        "revision": git_revision(),
+        "config": vars(args),
+        "variants": results,
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "a") as file:
+            file.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
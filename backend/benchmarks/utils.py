@@ -0,0 +1,136 @@
+import glob
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Optional
+
+import httpx
+
+
+def git_revision() -> str:
+    """Returns the current git commit hash, so results can be compared across commits.
+
+    Returns:
+        str: The short commit hash, or 'unknown' outside a git checkout.
+    """
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def wait_for(
+    client: httpx.Client, url: str, start: float, timeout: float
+) -> Optional[float]:
+    """Polls a URL until it returns a successful response.
+
+    Args:
+        client (httpx.Client): The HTTP client used for polling.
+        url (str): The URL to poll.
+        start (float): The `time.perf_counter()` reference point.
+        timeout (float): Maximum seconds after `start` to keep polling.
+
+    Returns:
+        Optional[float]: Seconds since `start` until the first successful
+            response, or None on timeout.
+    """
+    while time.perf_counter() - start < timeout:
+        try:
+            if client.get(url).is_success:
+                return time.perf_counter() - start
+        except httpx.TransportError:
+            pass
+        time.sleep(0.01)
+    return None
+
+
+def percentiles(values: list[float]) -> dict[str, Optional[float]]:
+    """Computes the p50, p95 and p99 of the given values.
+
+    Args:
+        values (list[float]): The measured values.
+
+    Returns:
+        dict[str, Optional[float]]: The percentiles, None if there are no values.
+    """
+    if len(values) < 2:
+        value = values[0] if values else None
+        return {"p50": value, "p95": value, "p99": value}
+    quantiles = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": quantiles[49], "p95": quantiles[94], "p99": quantiles[98]}
+
+
+def rss_mb(pid: int) -> Optional[float]:
+    """Reads the resident memory of a process and its children (Linux only).
+
+    Args:
+        pid (int): The process ID.
+
+    Returns:
+        Optional[float]: The resident set size in MB, None if unavailable.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            rss_kb = next(
+                int(line.split()[1]) for line in file if line.startswith("VmRSS:")
+            )
+    except (OSError, StopIteration):
+        return None
+
+    children = []
+    for path in glob.glob(f"/proc/{pid}/task/*/children"):
+        with open(path) as file:
+            children.extend(int(child) for child in file.read().split())
+    return rss_kb / 1024 + sum(rss_mb(child) or 0.0 for child in children)
+
+
+def cpu_seconds(pid: int) -> Optional[float]:
+    """Reads the CPU time (user and system) used by a process (Linux only).
+
+    Args:
+        pid (int): The process ID.
+
+    Returns:
+        Optional[float]: The CPU time in seconds, None if unavailable.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as file:
+            # The command name may contain spaces, the fields after it do not
+            fields = file.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def run_load_test(options: list[str], env: dict[str, str]) -> dict:
+    """Runs the load test in a subprocess and returns its results.
+
+    Args:
+        options (list[str]): The command line options of the load test.
+        env (dict[str, str]): Added to the environment of the app.
+
+    Returns:
+        dict: The load test results.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output = os.path.join(tmp_dir, "result.jsonl")
+        subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.load_test",
+                *options,
+                f"--output={output}",
+            ],
+            env=os.environ | env,
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+        with open(output) as file:
+            return json.loads(file.readline())
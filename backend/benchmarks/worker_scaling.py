@@ -0,0 +1,75 @@
+"""Measures how the chat throughput scales with the number of app workers.
+
+Runs the load test against a fake Mistral API once per worker count.
+The conversations are kept in the shared session store, so the turns of
+a session may be served by different workers. Reports the throughput,
+its speedup over the first worker count and the latency percentiles as
+JSON.
+
+Usage (from the `backend` directory):
+    python -m benchmarks.worker_scaling --workers 1 2 4 --sessions 80
+"""
+
+import argparse
+import json
+
+from benchmarks.utils import git_revision, run_load_test
+
+
+def main() -> None:
+    """Runs the load test per worker count and prints the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--sessions", type=int, default=80)
+    parser.add_argument("--concurrency", type=int, default=40)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--latency-ms", type=float, default=200.0)
+    parser.add_argument("--session-store", default="sqlite")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Append the result to this JSONL file.")
+    args = parser.parse_args()
+
+    results = []
+    for workers in args.workers:
+        load = run_load_test(
+            [
+                f"--workers={workers}",
+                f"--sessions={args.sessions}",
+                f"--concurrency={args.concurrency}",
+                f"--turns={args.turns}",
+                f"--latency-ms={args.latency_ms}",
+                f"--seed={args.seed}",
+            ],
+            {"SESSION_STORE": args.session_store},
+        )
+        results.append(
+            {
+                "workers": workers,
+                "turns": load.get("turns"),
+                "errors": load.get("errors"),
+                "throughput_turns_per_s": load.get("throughput_turns_per_s"),
+                "speedup": (
+                    load["throughput_turns_per_s"]
+                    / results[0]["throughput_turns_per_s"]
+                    if results and "throughput_turns_per_s" in load
+                    else 1.0
+                ),
+                "time_to_first_token_s": load.get("time_to_first_token_s"),
+                "turn_s": load.get("turn_s"),
+            }
+        )
+
+    result = {
+        "benchmark": "worker_scaling",
+        "revision": git_revision(),
+        "config": vars(args),
+        "results": results,
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "a") as file:
+            file.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
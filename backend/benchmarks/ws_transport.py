@@ -0,0 +1,272 @@
+"""Compares the per-turn overhead of the WebSocket and the POST chat transports.
+
+Starts the fake Mistral API and the app once per transport and drives
+concurrent chat sessions. With `sse`, every turn is a CORS preflight and a
+POST to `/chats/stream` on a new connection, as sent by the browser. With
+`websocket`, a session keeps one connection to `/chats/{thread_id}/ws`
+open for all of its turns. In each round a session asks the same question
+to `--characters-per-turn` characters at once, as parallel POSTs or as
+multiplexed turns. Reports the latency percentiles and the app CPU time
+per turn as JSON.
+
+Usage (from the `backend` directory):
+    python -m benchmarks.ws_transport --sessions 40 --turns 5 --characters-per-turn 2
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from typing import Optional
+
+import httpx
+from websockets.asyncio.client import connect
+
+from benchmarks.load_test import QUESTIONS, serve_app
+from benchmarks.utils import cpu_seconds, git_revision, percentiles
+
+TRANSPORTS = ("sse", "websocket")
+
+PREFLIGHT_HEADERS = {
+    "Origin": "http://localhost:3000",
+    "Access-Control-Request-Method": "POST",
+    "Access-Control-Request-Headers": "content-type",
+}
+
+
+async def sse_turn(
+    base_url: str, thread_id: str, character_id: int, query: str
+) -> tuple[Optional[float], float]:
+    """Sends one chat message as a preflighted POST on a new connection.
+
+    Args:
+        base_url (str): The URL of the app.
+        thread_id (str): The ID of the chat thread.
+        character_id (int): The ID of the character.
+        query (str): The message.
+
+    Returns:
+        tuple[Optional[float], float]: Seconds until the first token (None if
+            no token arrived) and until the response was complete.
+
+    Raises:
+        RuntimeError: If the stream reported an error.
+    """
+    start = time.perf_counter()
+    first_token = None
+    body = {"query": query, "character_id": character_id, "thread_id": thread_id}
+    async with httpx.AsyncClient(base_url=base_url, timeout=120) as client:
+        response = await client.options("/chats/stream", headers=PREFLIGHT_HEADERS)
+        response.raise_for_status()
+        async with client.stream("POST", "/chats/stream", json=body) as response:
+            response.raise_for_status()
+            event = None
+            async for line in response.aiter_lines():
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                elif line.startswith("data:") and event == "token":
+                    first_token = first_token or time.perf_counter() - start
+                elif line.startswith("data:") and event == "error":
+                    raise RuntimeError(line[5:].strip())
+    return first_token, time.perf_counter() - start
+
+
+async def sse_session(
+    base_url: str,
+    character_ids: list[int],
+    args: argparse.Namespace,
+    rng: random.Random,
+) -> list[tuple[Optional[float], float]]:
+    """Runs a chat session over POST requests.
+
+    Args:
+        base_url (str): The URL of the app.
+        character_ids (list[int]): The characters of the session.
+        args (argparse.Namespace): The benchmark arguments.
+        rng (random.Random): The random number generator.
+
+    Returns:
+        list[tuple[Optional[float], float]]: The latencies of each turn.
+    """
+    thread_id = str(uuid.uuid4())
+    latencies = []
+    for _ in range(args.turns):
+        query = rng.choice(QUESTIONS)
+        latencies += await asyncio.gather(
+            *(sse_turn(base_url, thread_id, id_, query) for id_ in character_ids)
+        )
+    return latencies
+
+
+async def websocket_session(
+    base_url: str,
+    character_ids: list[int],
+    args: argparse.Namespace,
+    rng: random.Random,
+) -> list[tuple[Optional[float], float]]:
+    """Runs a chat session over one WebSocket connection.
+
+    Args:
+        base_url (str): The URL of the app.
+        character_ids (list[int]): The characters of the session.
+        args (argparse.Namespace): The benchmark arguments.
+        rng (random.Random): The random number generator.
+
+    Returns:
+        list[tuple[Optional[float], float]]: The latencies of each turn.
+
+    Raises:
+        RuntimeError: If a turn reported an error.
+    """
+    thread_id = str(uuid.uuid4())
+    url = f"{base_url.replace('http', 'ws', 1)}/chats/{thread_id}/ws"
+    latencies = []
+    async with connect(url) as websocket:
+        for _ in range(args.turns):
+            query = rng.choice(QUESTIONS)
+            starts, first_tokens = {}, {}
+            for character_id in character_ids:
+                turn_id = str(uuid.uuid4())
+                starts[turn_id] = time.perf_counter()
+                message = {
+                    "type": "turn",
+                    "id": turn_id,
+                    "character_id": character_id,
+                    "query": query,
+                }
+                await websocket.send(json.dumps(message))
+            while starts:
+                message = json.loads(await websocket.recv())
+                turn_id, event = message["id"], message["event"]
+                if event == "token" and turn_id not in first_tokens:
+                    first_tokens[turn_id] = time.perf_counter() - starts[turn_id]
+                elif event == "error":
+                    raise RuntimeError(json.dumps(message["data"]))
+                elif event == "done":
+                    latencies.append(
+                        (
+                            first_tokens.get(turn_id),
+                            time.perf_counter() - starts.pop(turn_id),
+                        )
+                    )
+    return latencies
+
+
+async def run_sessions(
+    transport: str, args: argparse.Namespace, base_url: str, pid: int
+) -> dict:
+    """Drives the concurrent chat sessions over a transport.
+
+    Args:
+        transport (str): The transport, one of TRANSPORTS.
+        args (argparse.Namespace): The benchmark arguments.
+        base_url (str): The URL of the app.
+        pid (int): The process ID of the app, for measuring its CPU time.
+
+    Returns:
+        dict: The results of the transport.
+    """
+    rng = random.Random(args.seed)
+    session = sse_session if transport == "sse" else websocket_session
+    semaphore = asyncio.Semaphore(args.concurrency)
+    first_tokens: list[float] = []
+    turns: list[float] = []
+    errors: list[str] = []
+
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        characters = (await client.get("/characters?columns=id")).json()
+    character_ids = [character["id"] for character in characters]
+
+    async def limited_session() -> None:
+        async with semaphore:
+            session_ids = rng.sample(character_ids, args.characters_per_turn)
+            try:
+                latencies = await session(base_url, session_ids, args, rng)
+            except Exception as exc:
+                errors.append(repr(exc))
+                return
+            for first_token, total in latencies:
+                if first_token is not None:
+                    first_tokens.append(first_token)
+                turns.append(total)
+
+    cpu_start = cpu_seconds(pid)
+    start = time.perf_counter()
+    await asyncio.gather(*(limited_session() for _ in range(args.sessions)))
+    duration = time.perf_counter() - start
+    cpu_end = cpu_seconds(pid)
+    return {
+        "turns": len(turns),
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "throughput_turns_per_s": len(turns) / duration,
+        "time_to_first_token_s": percentiles(first_tokens),
+        "turn_s": percentiles(turns),
+        "app_cpu_ms_per_turn": (
+            (cpu_end - cpu_start) * 1000 / len(turns)
+            if turns and cpu_start is not None and cpu_end is not None
+            else None
+        ),
+    }
+
+
+def run_transport(transport: str, args: argparse.Namespace) -> dict:
+    """Starts a fresh app and fake Mistral API and benchmarks a transport.
+
+    Args:
+        transport (str): The transport, one of TRANSPORTS.
+        args (argparse.Namespace): The benchmark arguments.
+
+    Returns:
+        dict: The results of the transport.
+    """
+    with serve_app(
+        args.characters,
+        args.seed,
+        args.port,
+        args.fake_port,
+        [
+            f"--latency-ms={args.latency_ms}",
+            f"--tokens-per-second={args.tokens_per_second}",
+        ],
+    ) as app:
+        if app is None:
+            return {"error": "app did not become ready"}
+        return asyncio.run(run_sessions(transport, args, *app))
+
+
+def main() -> None:
+    """Benchmarks both transports and prints the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--transports", nargs="+", choices=TRANSPORTS, default=list(TRANSPORTS)
+    )
+    parser.add_argument("--sessions", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--characters-per-turn", type=int, default=2)
+    parser.add_argument("--characters", type=int, default=20)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--fake-port", type=int, default=8099)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Append the result to this JSONL file.")
+    args = parser.parse_args()
+
+    result = {
+        "benchmark": "ws_transport",
+        "revision": git_revision(),
+        "config": vars(args),
+        **{transport: run_transport(transport, args) for transport in args.transports},
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "a") as file:
+            file.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
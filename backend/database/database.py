@@ -1,17 +1,54 @@
+import time
 from http import HTTPStatus
-from typing import Any, Type, TypeVar
+from typing import Any, Sequence, Type, TypeVar
 
 from fastapi import HTTPException
-from sqlalchemy import Row
+from sqlalchemy import Row, event, exists
+from sqlalchemy import select as sa_select
+from sqlalchemy import text
+from sqlalchemy.engine import ExceptionContext
 from sqlmodel import Session, SQLModel, create_engine, select
 
-from datamodels.models import QueryParams
+from datamodels.models import Character, QueryParams, TableVersion
 from utils.consts import NARUTO_WIKI_DB_FILE
 from utils.exceptions import NotFoundError
+from utils.metrics import DB_QUERY_LATENCY
+from utils.tracing import tracer
 
 IsAnSQLModel = TypeVar("IsAnSQLModel", bound=SQLModel)
 IsAQueryParams = TypeVar("IsAQueryParams", bound=QueryParams)
 
+# Tables whose writes are counted in `TableVersion`, see `Database.version`
+VERSIONED_MODELS: tuple[Type[SQLModel], ...] = (Character,)
+
+
+def _before_cursor_execute(conn, _cursor, statement: str, *_) -> None:
+    """Remembers the start time of a query and starts its span."""
+    span = None
+    if tracer.current_span() is not None:
+        span = tracer.start_span("sqlite.query", statement=statement[:200])
+    conn.info.setdefault("query_start", []).append((time.perf_counter(), span))
+
+
+def _after_cursor_execute(conn, *_) -> None:
+    """Observes the duration of the query that just finished."""
+    start, span = conn.info["query_start"].pop()
+    DB_QUERY_LATENCY.observe(time.perf_counter() - start)
+    if span is not None:
+        tracer.end_span(span)
+
+
+def _handle_error(context: ExceptionContext) -> None:
+    """Observes the duration of the query that just failed and ends its span."""
+    queries = context.connection.info.get("query_start") if context.connection else None
+    if not queries:
+        # The error was not raised by a query
+        return
+    start, span = queries.pop()
+    DB_QUERY_LATENCY.observe(time.perf_counter() - start)
+    if span is not None:
+        tracer.end_span(span, context.original_exception)
+
 
 class Database:
     """Database handler for managing interactions with an SQLite database using SQLModel.
@@ -31,12 +68,51 @@ class Database:
         sqlite_url = f"sqlite:///{db_file}"
         connect_args = {"check_same_thread": False}
         self.engine = create_engine(sqlite_url, connect_args=connect_args)
+        event.listen(self.engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(self.engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(self.engine, "handle_error", _handle_error)
         self.session = Session(self.engine)
         self.create_db_and_tables()
 
     def create_db_and_tables(self) -> None:
-        """Creates the database and all necessary tables."""
+        """Creates the database, all necessary tables and the version triggers."""
         SQLModel.metadata.create_all(self.engine)
+        with self.engine.begin() as connection:
+            for model in VERSIONED_MODELS:
+                table = model.__tablename__
+                connection.execute(
+                    text(
+                        "INSERT OR IGNORE INTO tableversion (name, version) "
+                        "VALUES (:table, :version)"
+                    ),
+                    {"table": table, "version": time.time_ns() // 1000},
+                )
+                for operation in ("INSERT", "UPDATE", "DELETE"):
+                    connection.execute(
+                        text(
+                            f"CREATE TRIGGER IF NOT EXISTS {table}_version_"
+                            f"{operation.lower()} AFTER {operation} ON {table} "
+                            "BEGIN UPDATE tableversion SET version = version + 1 "
+                            f"WHERE name = '{table}'; END"
+                        )
+                    )
+
+    def version(self, model: Type[IsAnSQLModel]) -> int:
+        """Returns the version of a table, which changes with every write.
+
+        Cheaper than querying the table, so it is used to validate cached
+        rows and as the entity tag of HTTP responses.
+
+        Args:
+            model (Type[IsAnSQLModel]): The SQLModel class, one of
+                VERSIONED_MODELS.
+
+        Returns:
+            int: The version of the table.
+        """
+        return self.session.exec(
+            select(TableVersion.version).where(TableVersion.name == model.__tablename__)
+        ).one()
 
     def get(self, params: IsAQueryParams) -> list[dict[str, Any]]:
         """Fetches records from the database based on query parameters.
@@ -61,6 +137,19 @@ class Database:
             for row in result
         ]
 
+    def exists(self, model: Type[IsAnSQLModel]) -> bool:
+        """Checks whether at least one row of the given model exists.
+
+        Uses an `EXISTS` subquery, so the cost does not grow with the table size.
+
+        Args:
+            model (Type[IsAnSQLModel]): The SQLModel class to query.
+
+        Returns:
+            bool: True if the table contains at least one row.
+        """
+        return bool(self.session.scalar(sa_select(exists().select_from(model))))
+
     def get_by_id(
         self,
         entity_id: int,
@@ -107,6 +196,31 @@ class Database:
 
         return model
 
+    def create_many(
+        self, model: Type[IsAnSQLModel], rows: Sequence[dict[str, Any]]
+    ) -> list[int]:
+        """Inserts rows in one transaction, as multi-row `INSERT ... RETURNING`.
+
+        Bypasses the ORM, so the rows are neither validated nor refreshed.
+        Much faster than `create` for many rows, which commits and refreshes
+        every row on its own.
+
+        Args:
+            model (Type[IsAnSQLModel]): The SQLModel class of the rows, with an
+                integer `id` primary key.
+            rows (Sequence[dict[str, Any]]): The column values of the rows.
+
+        Returns:
+            list[int]: The IDs of the inserted rows, in the order of `rows`.
+        """
+        if not rows:
+            return []
+        table = model.__table__  # type: ignore
+        # RETURNING gives the IDs of exactly these rows, even while others write
+        statement = table.insert().returning(table.c.id, sort_by_parameter_order=True)
+        with self.engine.begin() as connection:
+            return list(connection.execute(statement, rows).scalars())
+
     def update(
         self, model: IsAnSQLModel, updated_fields: dict[str, Any]
     ) -> IsAnSQLModel:
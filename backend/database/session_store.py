@@ -0,0 +1,637 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional, Sequence
+
+from utils.consts import SESSION_DB_FILE, SESSION_LOCK_POLL_S, SESSION_STORE
+from utils.metrics import SESSION_STORE_LATENCY
+
+Session = dict[str, Any]
+
+
+class SessionStore(ABC):
+    """Stores the conversations, shared by all workers of the app.
+
+    A conversation of a thread with a character consists of its session,
+    the JSON-serializable working state of the workflow (e.g. the recent
+    chat history and the chat summary), and the log of all its messages.
+    Logged messages get increasing IDs across all conversations, which
+    serve as paging cursors and, the latest one, as conversation version.
+    Sessions are only changed with atomic read-modify-write updates, so
+    that concurrent turns and chat history folds of different workers do
+    not overwrite each other. The store also provides named locks with a
+    lease, e.g. so that only one worker creates a character's embeddings.
+    """
+
+    @abstractmethod
+    def load(self, thread_id: str, character_id: int) -> Optional[Session]:
+        """Load the session of a conversation.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
+            character_id (int): The ID of the character.
+
+        Returns:
+            Optional[Session]: The session, None if there is no conversation.
+        """
+
+    @abstractmethod
+    def update(
+        self,
+        thread_id: str,
+        character_id: int,
+        update: Callable[[Session], Session],
+        messages: Sequence[dict[str, Any]] = (),
+    ) -> Session:
+        """Atomically update the session of a conversation.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
+            character_id (int): The ID of the character.
+            update (Callable[[Session], Session]): Maps the current session
+                (empty for a new conversation) to the new session.
+            messages (Sequence[dict[str, Any]], optional): Messages appended to
+                the message log in the same transaction. Defaults to none.
+
+        Returns:
+            Session: The new session.
+        """
+
+    @abstractmethod
+    def messages(
+        self,
+        thread_id: str,
+        character_id: int,
+        after: int = 0,
+        limit: Optional[int] = None,
+    ) -> list[tuple[int, dict[str, Any]]]:
+        """Load a page of the message log of a conversation.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
+            character_id (int): The ID of the character.
+            after (int, optional): Only messages with a greater ID are loaded.
+                Defaults to 0, from the first message.
+            limit (Optional[int], optional): The maximum number of messages.
+                Defaults to None, all messages.
+
+        Returns:
+            list[tuple[int, dict[str, Any]]]: The IDs and the messages, oldest
+                first.
+        """
+
+    @abstractmethod
+    def version(self, thread_id: str, character_id: int) -> int:
+        """Return the version of the message log of a conversation.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
+            character_id (int): The ID of the character.
+
+        Returns:
+            int: The ID of the latest message, 0 if there are no messages.
+        """
+
+    @abstractmethod
+    def character_ids(self, thread_id: str) -> list[int]:
+        """List the characters a thread has conversations with.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
+
+        Returns:
+            list[int]: The character IDs, in the order the conversations started.
+        """
+
+    @abstractmethod
+    def delete(self, thread_id: str, character_id: int) -> None:
+        """Delete the session and the messages of a conversation.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
+            character_id (int): The ID of the character.
+        """
+
+    @abstractmethod
+    def acquire(self, name: str, timeout_s: float, ttl_s: float) -> Optional[str]:
+        """Acquire a named lock.
+
+        Args:
+            name (str): The name of the lock.
+            timeout_s (float): The maximum time to wait for the lock, 0 to try
+                only once.
+            ttl_s (float): The lease of the lock, after which it is released
+                even if its owner crashed.
+
+        Returns:
+            Optional[str]: The token to release the lock with, None if it was
+                not acquired in time.
+        """
+
+    @abstractmethod
+    def release(self, name: str, token: str) -> None:
+        """Release a named lock, unless its lease expired and it was taken over.
+
+        Args:
+            name (str): The name of the lock.
+            token (str): The token returned by `acquire`.
+        """
+
+    @contextmanager
+    def lock(
+        self, name: str, timeout_s: float = 0.0, ttl_s: float = 60.0
+    ) -> Iterator[bool]:
+        """Hold a named lock while in the context.
+
+        Args:
+            name (str): The name of the lock.
+            timeout_s (float, optional): The maximum time to wait for the lock.
+                Defaults to 0, try only once.
+            ttl_s (float, optional): The lease of the lock. Defaults to 60.
+
+        Yields:
+            bool: If the lock was acquired, the context runs either way.
+        """
+        token = self.acquire(name, timeout_s, ttl_s)
+        try:
+            yield token is not None
+        finally:
+            if token is not None:
+                self.release(name, token)
+
+
+class MemorySessionStore(SessionStore):
+    """Session store in the memory of the process, for a single worker."""
+
+    def __init__(self) -> None:
+        """Initialize an empty MemorySessionStore."""
+        self._sessions: dict[tuple[str, int], Session] = {}
+        self._messages: dict[tuple[str, int], list[tuple[int, dict[str, Any]]]] = {}
+        self._last_message_id = 0
+        # Lock name to token and expiry
+        self._locks: dict[str, tuple[str, float]] = {}
+        self._condition = threading.Condition()
+
+    def load(self, thread_id: str, character_id: int) -> Optional[Session]:
+        """Load a copy of the session of a conversation.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
+            character_id (int): The ID of the character.
+
+        Returns:
+            Optional[Session]: The session, None if there is no conversation.
+        """
+        with self._condition:
+            session = self._sessions.get((thread_id, character_id))
+            return json.loads(json.dumps(session)) if session is not None else None
+
+    def update(
+        self,
+        thread_id: str,
+        character_id: int,
+        update: Callable[[Session], Session],
+        messages: Sequence[dict[str, Any]] = (),
+    ) -> Session:
+        """Update the session of a conversation under the store's lock.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
+            character_id (int): The ID of the character.
+            update (Callable[[Session], Session]): Maps the current session
+                (empty for a new conversation) to the new session.
+            messages (Sequence[dict[str, Any]], optional): Messages appended to
+                the message log. Defaults to none.
+
+        Returns:
+            Session: The new session.
+        """
+        key = (thread_id, character_id)
+        with self._condition:
+            # Copied, so that sessions behave as if they were serialized
+            session = json.loads(json.dumps(self._sessions.get(key, {})))
+            session = self._sessions[key] = update(session)
+            log = self._messages.setdefault(key, [])
+            for message in messages:
+                self._last_message_id += 1
+                log.append((self._last_message_id, message))
+            return session
+
+    def messages(
+        self,
+        thread_id: str,
+        character_id: int,
+        after: int = 0,
+        limit: Optional[int] = None,
+    ) -> list[tuple[int, dict[str, Any]]]:
+        """Load a page of the message log of a conversation.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
+            character_id (int): The ID of the character.
+            after (int, optional): Only messages with a greater ID are loaded.
+                Defaults to 0, from the first message.
+            limit (Optional[int], optional): The maximum number of messages.
+                Defaults to None, all messages.
+
+        Returns:
+            list[tuple[int, dict[str, Any]]]: The IDs and the messages, oldest
+                first.
+        """
+        with self._condition:
+            log = self._messages.get((thread_id, character_id), [])
+            page = [entry for entry in log if entry[0] > after]
+        return page[:limit] if limit is not None else page
+
+    def version(self, thread_id: str, character_id: int) -> int:
+        """Return the ID of the latest message of a conversation.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
+            character_id (int): The ID of the character.
+
+        Returns:
+            int: The ID, 0 if there are no messages.
+        """
+        with self._condition:
+            log = self._messages.get((thread_id, character_id), [])
+            return log[-1][0] if log else 0
+
+    def character_ids(self, thread_id: str) -> list[int]:
+        """List the characters a thread has conversations with.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
+
+        Returns:
+            list[int]: The character IDs, in the order the conversations started.
+        """
+        with self._condition:
+            return [
+                character_id
+                for session_thread_id, character_id in self._sessions
+                if session_thread_id == thread_id
+            ]
+
+    def delete(self, thread_id: str, character_id: int) -> None:
+        """Delete the session and the messages of a conversation.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
+            character_id (int): The ID of the character.
+        """
+        with self._condition:
+            self._sessions.pop((thread_id, character_id), None)
+            self._messages.pop((thread_id, character_id), None)
+
+    def acquire(self, name: str, timeout_s: float, ttl_s: float) -> Optional[str]:
+        """Acquire a named lock, waiting until it is released or expires.
+
+        Args:
+            name (str): The name of the lock.
+            timeout_s (float): The maximum time to wait for the lock, 0 to try
+                only once.
+            ttl_s (float): The lease of the lock.
+
+        Returns:
+            Optional[str]: The token to release the lock with, None if it was
+                not acquired in time.
+        """
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout_s
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                holder = self._locks.get(name)
+                if holder is None or holder[1] < now:
+                    self._locks[name] = (token, now + ttl_s)
+                    return token
+                if now >= deadline:
+                    return None
+                self._condition.wait(min(deadline, holder[1]) - now)
+
+    def release(self, name: str, token: str) -> None:
+        """Release a named lock and wake up the waiting threads.
+
+        Args:
+            name (str): The name of the lock.
+            token (str): The token returned by `acquire`.
+        """
+        with self._condition:
+            if self._locks.get(name, ("", 0.0))[0] == token:
+                del self._locks[name]
+                self._condition.notify_all()
+
+
+class SqliteSessionStore(SessionStore):
+    """Session store in an SQLite database, shared by the workers of a host.
+
+    Every thread uses its own connection. The database is in WAL mode, so
+    reads do not block the writes of other workers, and updates are
+    `BEGIN IMMEDIATE` transactions, so concurrent updates of a session
+    are serialized instead of failing.
+
+    Attributes:
+        db_file (str): The path to the SQLite database file.
+    """
+
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS chat_session (
+            thread_id TEXT NOT NULL,
+            character_id INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (thread_id, character_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS chat_message (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            thread_id TEXT NOT NULL,
+            character_id INTEGER NOT NULL,
+            message TEXT NOT NULL
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS chat_message_conversation
+        ON chat_message (thread_id, character_id, id)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS store_lock (
+            name TEXT PRIMARY KEY,
+            token TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        """,
+    )
+
+    def __init__(self, db_file: str = SESSION_DB_FILE) -> None:
+        """Initialize the SqliteSessionStore, creating its tables if needed.
+
+        Args:
+            db_file (str, optional): The path to the SQLite database file.
+                Defaults to SESSION_DB_FILE.
+        """
+        self.db_file = db_file
+        self._local = threading.local()
+        with self._transaction("create_tables") as connection:
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+
+    def load(self, thread_id: str, character_id: int) -> Optional[Session]:
+        """Load the session of a conversation.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
+            character_id (int): The ID of the character.
+
+        Returns:
+            Optional[Session]: The session, None if there is no conversation.
+        """
+        with SESSION_STORE_LATENCY.labels("load").time():
+            row = (
+                self._connection()
+                .execute(
+                    "SELECT state FROM chat_session"
+                    " WHERE thread_id = ? AND character_id = ?",
+                    (thread_id, character_id),
+                )
+                .fetchone()
+            )
+        return json.loads(row[0]) if row else None
+
+    def update(
+        self,
+        thread_id: str,
+        character_id: int,
+        update: Callable[[Session], Session],
+        messages: Sequence[dict[str, Any]] = (),
+    ) -> Session:
+        """Update the session of a conversation in a write transaction.
+
+        The session is read inside the transaction, so concurrent updates
+        of other workers wait instead of being overwritten.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
+            character_id (int): The ID of the character.
+            update (Callable[[Session], Session]): Maps the current session
+                (empty for a new conversation) to the new session.
+            messages (Sequence[dict[str, Any]], optional): Messages appended to
+                the message log. Defaults to none.
+
+        Returns:
+            Session: The new session.
+        """
+        with self._transaction("update") as connection:
+            row = connection.execute(
+                "SELECT state FROM chat_session"
+                " WHERE thread_id = ? AND character_id = ?",
+                (thread_id, character_id),
+            ).fetchone()
+            session = update(json.loads(row[0]) if row else {})
+            now = time.time()
+            connection.execute(
+                "INSERT INTO chat_session"
+                " (thread_id, character_id, state, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (thread_id, character_id)"
+                " DO UPDATE SET"
+                " state = excluded.state, updated_at = excluded.updated_at",
+                (thread_id, character_id, json.dumps(session), now, now),
+            )
+            connection.executemany(
+                "INSERT INTO chat_message (thread_id, character_id, message)"
+                " VALUES (?, ?, ?)",
+                [
+                    (thread_id, character_id, json.dumps(message))
+                    for message in messages
+                ],
+            )
+        return session
+
+    def messages(
+        self,
+        thread_id: str,
+        character_id: int,
+        after: int = 0,
+        limit: Optional[int] = None,
+    ) -> list[tuple[int, dict[str, Any]]]:
+        """Load a page of the message log of a conversation.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
+            character_id (int): The ID of the character.
+            after (int, optional): Only messages with a greater ID are loaded.
+                Defaults to 0, from the first message.
+            limit (Optional[int], optional): The maximum number of messages.
+                Defaults to None, all messages.
+
+        Returns:
+            list[tuple[int, dict[str, Any]]]: The IDs and the messages, oldest
+                first.
+        """
+        with SESSION_STORE_LATENCY.labels("messages").time():
+            rows = (
+                self._connection()
+                .execute(
+                    "SELECT id, message FROM chat_message"
+                    " WHERE thread_id = ? AND character_id = ? AND id > ?"
+                    " ORDER BY id LIMIT ?",
+                    (thread_id, character_id, after, -1 if limit is None else limit),
+                )
+                .fetchall()
+            )
+        return [(message_id, json.loads(message)) for message_id, message in rows]
+
+    def version(self, thread_id: str, character_id: int) -> int:
+        """Return the ID of the latest message of a conversation.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
+            character_id (int): The ID of the character.
+
+        Returns:
+            int: The ID, 0 if there are no messages.
+        """
+        with SESSION_STORE_LATENCY.labels("version").time():
+            (version,) = (
+                self._connection()
+                .execute(
+                    "SELECT MAX(id) FROM chat_message"
+                    " WHERE thread_id = ? AND character_id = ?",
+                    (thread_id, character_id),
+                )
+                .fetchone()
+            )
+        return version or 0
+
+    def character_ids(self, thread_id: str) -> list[int]:
+        """List the characters a thread has conversations with.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
+
+        Returns:
+            list[int]: The character IDs, in the order the conversations started.
+        """
+        with SESSION_STORE_LATENCY.labels("character_ids").time():
+            rows = (
+                self._connection()
+                .execute(
+                    "SELECT character_id FROM chat_session"
+                    " WHERE thread_id = ? ORDER BY created_at",
+                    (thread_id,),
+                )
+                .fetchall()
+            )
+        return [character_id for character_id, in rows]
+
+    def delete(self, thread_id: str, character_id: int) -> None:
+        """Delete the session and the messages of a conversation.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
+            character_id (int): The ID of the character.
+        """
+        with self._transaction("delete") as connection:
+            for table in ("chat_session", "chat_message"):
+                connection.execute(
+                    f"DELETE FROM {table} WHERE thread_id = ? AND character_id = ?",
+                    (thread_id, character_id),
+                )
+
+    def acquire(self, name: str, timeout_s: float, ttl_s: float) -> Optional[str]:
+        """Acquire a named lock, polling until it is released or expires.
+
+        Args:
+            name (str): The name of the lock.
+            timeout_s (float): The maximum time to wait for the lock, 0 to try
+                only once.
+            ttl_s (float): The lease of the lock.
+
+        Returns:
+            Optional[str]: The token to release the lock with, None if it was
+                not acquired in time.
+        """
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout_s
+        while True:
+            with self._transaction("acquire") as connection:
+                now = time.time()
+                connection.execute(
+                    "DELETE FROM store_lock WHERE name = ? AND expires_at < ?",
+                    (name, now),
+                )
+                acquired = connection.execute(
+                    "INSERT OR IGNORE INTO store_lock (name, token, expires_at)"
+                    " VALUES (?, ?, ?)",
+                    (name, token, now + ttl_s),
+                ).rowcount
+            if acquired:
+                return token
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(SESSION_LOCK_POLL_S)
+
+    def release(self, name: str, token: str) -> None:
+        """Release a named lock, unless it expired and was taken over.
+
+        Args:
+            name (str): The name of the lock.
+            token (str): The token returned by `acquire`.
+        """
+        with self._transaction("release") as connection:
+            connection.execute(
+                "DELETE FROM store_lock WHERE name = ? AND token = ?", (name, token)
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        """Return the connection of the current thread, opening it on first use.
+
+        Returns:
+            sqlite3.Connection: The connection, in autocommit mode.
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.db_file, timeout=30.0, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def _transaction(self, operation: str) -> Iterator[sqlite3.Connection]:
+        """Run statements in a write transaction, timed as an operation.
+
+        Args:
+            operation (str): The name of the operation in the metrics.
+
+        Yields:
+            sqlite3.Connection: The connection of the transaction.
+        """
+        connection = self._connection()
+        with SESSION_STORE_LATENCY.labels(operation).time():
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+
+SESSION_STORES: dict[str, type[SessionStore]] = {
+    "memory": MemorySessionStore,
+    "sqlite": SqliteSessionStore,
+}
+
+session_store = SESSION_STORES[SESSION_STORE]()
@@ -7,3 +7,73 @@ class Sender(str, Enum):
     human = "human"
     ai = "ai"
     system = "system"
+
+
+class TaskStatus(str, Enum):
+    """Enum for the status of background tasks."""
+
+    pending = "pending"
+    running = "running"
+    done = "done"
+    failed = "failed"
+
+
+class JobKind(str, Enum):
+    """Enum for the kinds of background jobs."""
+
+    embed_character = "embed_character"
+    summarize_personality = "summarize_personality"
+    scrape_characters = "scrape_characters"
+
+
+class StreamEvent(str, Enum):
+    """Enum for the event types of a chat event stream."""
+
+    token = "token"
+    done = "done"
+    error = "error"
+    context = "context"
+    timing = "timing"
+    state = "state"
+    cancelled = "cancelled"
+
+
+class StreamChannel(str, Enum):
+    """Enum for the optional event channels a client can subscribe to."""
+
+    context = "context"
+    timing = "timing"
+    state = "state"
+
+
+class ChatSocketMessageType(str, Enum):
+    """Enum for the types of messages a client sends over a chat WebSocket."""
+
+    turn = "turn"
+    cancel = "cancel"
+
+
+class PreprocessingStep(str, Enum):
+    """Enum for the LLM calls that maintain the memory of a conversation.
+
+    The chat history is summarized after a response, the other steps run
+    before it. `combined` characterizes the user and contextualizes the
+    query in a single call.
+    """
+
+    summarize_chat_history = "summarize_chat_history"
+    characterize_user = "characterize_user"
+    contextualize_query = "contextualize_query"
+    combined = "combined"
+
+
+class LlmPriority(str, Enum):
+    """Enum for the priorities of LLM calls, from the highest to the lowest.
+
+    The streamed response is waited for by the user, preprocessing calls
+    delay it, background calls (e.g. folding the chat history) do not.
+    """
+
+    response = "response"
+    preprocessing = "preprocessing"
+    background = "background"
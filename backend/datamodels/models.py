@@ -1,16 +1,20 @@
-from typing import Any, Optional, Sequence
+from typing import Any, Optional
 
 from fastapi import Query, Request
 from fastapi.exceptions import RequestValidationError
-from langchain_core.messages import BaseMessage
-from langgraph.graph.message import add_messages
 from pydantic import BaseModel, model_validator
 from sqlalchemy import JSON, Column, UnaryExpression
 from sqlalchemy.orm import InstrumentedAttribute
 from sqlmodel import Field, SQLModel
-from typing_extensions import Annotated, TypedDict
+from typing_extensions import Annotated
 
-from datamodels.enums import Sender
+from datamodels.enums import (
+    ChatSocketMessageType,
+    JobKind,
+    Sender,
+    StreamChannel,
+    TaskStatus,
+)
 
 
 class QueryParams(BaseModel):
@@ -75,6 +79,16 @@ class GetCharactersParams(QueryParams):
 
         return cls(**params)
 
+    @property
+    def cache_key(self) -> tuple:
+        """The shape of the query, equal for all requests of the same rows."""
+        return (
+            tuple(str(column) for column in self.columns or ()),
+            tuple(str(column) for column in self.order_by or ()),
+            self.offset,
+            self.limit,
+        )
+
     @staticmethod
     def _get_validated_columns(
         columns: list[str], valid_columns: list[str]
@@ -151,16 +165,56 @@ class CharacterCreate(BaseModel):
         Returns:
             dict[str, Any]: The updated data with the computed `data_length`.
         """
+        # Malformed input is left for the field validation to report
+        if not isinstance(data, dict) or not isinstance(data.get("data") or [], list):
+            return data
         data.update(
             {
                 "data_length": sum(
-                    [len(section["text"]) for section in data.get("data", [])]
+                    [
+                        len(section["text"])
+                        for section in data.get("data") or []
+                        if isinstance(section, dict)
+                        and isinstance(section.get("text"), str)
+                    ]
                 )
             }
         )
         return data
 
 
+class CharacterImportError(BaseModel):
+    """Model for a row of a character import that was rejected.
+
+    Attributes:
+        row (int): The position of the row, its line for NDJSON and its
+            element (from 1) for a JSON array.
+        errors (list[str]): What is wrong with the row.
+    """
+
+    row: int
+    errors: list[str]
+
+
+class CharacterImportResult(BaseModel):
+    """Model for the result of a character import.
+
+    Attributes:
+        imported (int): The number of imported characters.
+        failed (int): The number of rejected rows.
+        jobs (int): The number of jobs enqueued for the imported characters.
+        errors (list[CharacterImportError]): The first rejected rows.
+        error (Optional[str]): Why the import stopped early, e.g. malformed
+            JSON, the rows before were imported.
+    """
+
+    imported: int = 0
+    failed: int = 0
+    jobs: int = 0
+    errors: list[CharacterImportError] = []
+    error: Optional[str] = None
+
+
 class Character(SQLModel, table=True):
     """SQLModel representation of a Character entity.
 
@@ -202,6 +256,64 @@ class EmbeddingLog(SQLModel, table=True):
     character_id: int = Field(default=None, index=True, foreign_key="character.id")
 
 
+class TableVersion(SQLModel, table=True):
+    """SQLModel for the version of a table, for caching its rows.
+
+    The version is increased by triggers on every insert, update and delete,
+    so it changes with writes of any connection or process.
+
+    Attributes:
+        name (str): The name of the table.
+        version (int): The version, starting at the creation time in
+            microseconds so versions are not reused by a recreated database.
+    """
+
+    name: str = Field(primary_key=True)
+    version: int
+
+
+class JobCreate(BaseModel):
+    """Model for a background job to enqueue.
+
+    Attributes:
+        kind (JobKind): The kind of the job, which selects its handler.
+        payload (dict[str, Any]): The JSON-serializable arguments of the handler.
+        key (Optional[str]): Deduplicates jobs, while a job with the same key
+            is pending or running no other one is enqueued.
+        priority (int): Jobs with a higher priority run first. Defaults to 0.
+    """
+
+    kind: JobKind
+    payload: dict[str, Any] = {}
+    key: Optional[str] = None
+    priority: int = 0
+
+
+class Job(JobCreate):
+    """Model for a background job in the job queue.
+
+    Attributes:
+        id (int): The ID of the job.
+        status (TaskStatus): The status of the job, failed jobs that are
+            retried are pending again.
+        attempts (int): How often the job was started.
+        max_attempts (int): How often the job is started before it fails.
+        error (Optional[str]): The error of the last failed attempt.
+        run_at (float): The UNIX time the job may start at, later for retries.
+        created_at (float): The UNIX time the job was enqueued at.
+        updated_at (float): The UNIX time the job last changed at.
+    """
+
+    id: int
+    status: TaskStatus
+    attempts: int
+    max_attempts: int
+    error: Optional[str] = None
+    run_at: float
+    created_at: float
+    updated_at: float
+
+
 class DocumentMetadata(BaseModel):
     """Metadata model for documents associated with characters.
 
@@ -225,6 +337,24 @@ class DocumentMetadata(BaseModel):
     tag_3: Optional[str] = "null"
 
 
+class PreprocessingResult(BaseModel):
+    """Model for the structured response of the combined preprocessing call.
+
+    Attributes:
+        user_information (str): The updated characterization of the user.
+        search_query (str): The query for looking up relevant character data.
+    """
+
+    user_information: str = Field(
+        min_length=1, description="The updated personality description of the human."
+    )
+    search_query: str = Field(
+        min_length=1,
+        description="A short search query to look up information relevant "
+        "to the conversation.",
+    )
+
+
 class Message(BaseModel):
     """Model representing a message in a chat.
 
@@ -237,24 +367,32 @@ class Message(BaseModel):
     text: str
 
 
-class State(TypedDict):
-    """TypedDict representing the state of a conversation.
+class ChatSocketMessage(BaseModel):
+    """Model for a message sent by the client over a chat WebSocket.
 
-    A TypedDict instead of pydantic model is used for easier
-    integration with langchain (same input and output keys as
-    `rag_chain`).
+    A `turn` message starts a response of a character, a `cancel` message
+    stops the in-flight response with the same ID.
 
     Attributes:
-        input (str): The input from the user.
-        chat_history (Annotated[Sequence[BaseMessage], add_messages]):
-            The history of the chat.
-        context (str): The current context of the conversation.
-        answer (str): The generated answer based on the conversation.
+        type (ChatSocketMessageType): The type of the message.
+        id (str): The client-chosen ID of the turn, events of the turn carry it.
+        character_id (Optional[int]): The ID of the character to respond,
+            required for turns.
+        query (Optional[str]): The input query from the user, required for turns.
+        channels (list[StreamChannel]): Additional event channels to stream.
     """
 
-    input: str
-    user_information: Annotated[str, "latest"]
-    chat_history: Annotated[Sequence[BaseMessage], add_messages]
-    chat_summary: str
-    context: str
-    answer: str
+    type: ChatSocketMessageType
+    id: str = Field(min_length=1, max_length=64)
+    character_id: Optional[int] = None
+    query: Optional[str] = None
+    channels: list[StreamChannel] = []
+
+    @model_validator(mode="after")
+    def check_turn(self) -> "ChatSocketMessage":
+        """Checks that turns name a character and a query."""
+        if self.type == ChatSocketMessageType.turn and (
+            self.character_id is None or not self.query
+        ):
+            raise ValueError("A turn needs a character_id and a query.")
+        return self
@@ -0,0 +1,34 @@
+from typing import Sequence
+
+from langchain_core.messages import BaseMessage
+from langgraph.graph.message import add_messages
+from typing_extensions import Annotated, NotRequired, TypedDict
+
+
+class State(TypedDict):
+    """TypedDict representing the state of a conversation.
+
+    A TypedDict instead of pydantic model is used for easier
+    integration with langchain (same input and output keys as
+    `rag_chain`).
+
+    Attributes:
+        input (str): The input from the user.
+        chat_history (Annotated[Sequence[BaseMessage], add_messages]):
+            The history of the chat.
+        message_count (int): The number of messages of the conversation before
+            the current turn, including those folded into the chat summary.
+        search_query (str): The query for the vectorDB, if it was already
+            generated in the current turn.
+        context (str): The current context of the conversation.
+        answer (str): The generated answer based on the conversation.
+    """
+
+    input: str
+    user_information: Annotated[str, "latest"]
+    chat_history: Annotated[Sequence[BaseMessage], add_messages]
+    message_count: NotRequired[int]
+    chat_summary: str
+    search_query: str
+    context: str
+    answer: str
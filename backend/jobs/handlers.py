@@ -0,0 +1,115 @@
+import asyncio
+from typing import Any, Callable, Coroutine, Iterable, Sequence
+
+from sqlmodel import select
+
+from database.database import Database
+from datamodels.enums import JobKind
+from datamodels.models import Character, EmbeddingLog, JobCreate
+from scraper.scraper import NarutoWikiScraper
+
+# The LLM modules (langchain, chroma, mistralai) are imported lazily inside
+# the handlers, they are slow to import
+
+JobHandler = Callable[[dict[str, Any]], Coroutine[Any, Any, None]]
+
+# The jobs preparing a character for chats, so the first chat does not wait
+CHARACTER_JOB_KINDS = (JobKind.embed_character, JobKind.summarize_personality)
+
+
+async def embed_character(payload: dict[str, Any]) -> None:
+    """Creates the embeddings of a character unless they already exist.
+
+    Args:
+        payload (dict[str, Any]): The `character_id`.
+    """
+    from llm.rag import RAG
+
+    await asyncio.to_thread(RAG(Database()).ensure_embeddings, payload["character_id"])
+
+
+async def summarize_personality(payload: dict[str, Any]) -> None:
+    """Summarizes the personality of a character unless it already is.
+
+    Args:
+        payload (dict[str, Any]): The `character_id`.
+    """
+    from llm.llm_workflow import LlmWorkflow
+
+    def _summarize() -> None:
+        db = Database()
+        character = db.get_by_id(payload["character_id"], Character)
+        LlmWorkflow.ensure_personality_summary(db, character)
+
+    await asyncio.to_thread(_summarize)
+
+
+async def scrape_characters(_: dict[str, Any]) -> None:
+    """Scrapes all characters if the database is still empty."""
+    await NarutoWikiScraper().scrape_all_characters()
+
+
+HANDLERS: dict[JobKind, JobHandler] = {
+    JobKind.embed_character: embed_character,
+    JobKind.summarize_personality: summarize_personality,
+    JobKind.scrape_characters: scrape_characters,
+}
+
+
+def character_jobs(
+    character_ids: Iterable[int],
+    kinds: Sequence[JobKind] = CHARACTER_JOB_KINDS,
+    priority: int = 0,
+) -> list[JobCreate]:
+    """Creates the jobs preparing characters for chats.
+
+    The jobs of a character are keyed by their kind and the character ID,
+    so a character is prepared only once at a time.
+
+    Args:
+        character_ids (Iterable[int]): The IDs of the characters.
+        kinds (Sequence[JobKind], optional): The kinds of jobs to create.
+            Defaults to CHARACTER_JOB_KINDS.
+        priority (int, optional): The priority of the jobs. Defaults to 0.
+
+    Returns:
+        list[JobCreate]: The jobs to enqueue.
+    """
+    return [
+        JobCreate(
+            kind=kind,
+            payload={"character_id": character_id},
+            key=f"{kind.value}:{character_id}",
+            priority=priority,
+        )
+        for character_id in character_ids
+        for kind in kinds
+    ]
+
+
+def missing_character_job_kinds(db: Database, character_id: int) -> list[JobKind]:
+    """Checks which jobs preparing a character for chats did not run yet.
+
+    Only columns are selected, so the result is current even if the
+    character is already loaded in the session of the database.
+
+    Args:
+        db (Database): The database of the character.
+        character_id (int): The ID of the character.
+
+    Returns:
+        list[JobKind]: The kinds of the missing jobs.
+    """
+    kinds = []
+    if (
+        db.session.exec(
+            select(EmbeddingLog.id).where(EmbeddingLog.character_id == character_id)
+        ).first()
+        is None
+    ):
+        kinds.append(JobKind.embed_character)
+    if not db.session.exec(
+        select(Character.summarized_personality).where(Character.id == character_id)
+    ).first():
+        kinds.append(JobKind.summarize_personality)
+    return kinds
@@ -0,0 +1,435 @@
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional, Sequence
+
+from datamodels.enums import JobKind, TaskStatus
+from datamodels.models import Job, JobCreate
+from utils.consts import (
+    JOBS_BACKOFF_MAX_S,
+    JOBS_BACKOFF_S,
+    JOBS_DB_FILE,
+    JOBS_MAX_ATTEMPTS,
+)
+from utils.metrics import JOBS
+
+# Jobs of these statuses are active, their keys are unique
+ACTIVE_STATUSES = (TaskStatus.pending.value, TaskStatus.running.value)
+
+
+class JobQueue:
+    """Durable queue of background jobs in an SQLite database.
+
+    The queue is shared by all workers of the app. Jobs are claimed in
+    `BEGIN IMMEDIATE` transactions, so a job runs in one worker at a time,
+    the highest priority first. A claimed job has a lease, which its
+    worker renews while the job runs. If the worker crashes, the job is
+    claimed again once the lease expired. Failed jobs are retried after an
+    exponential backoff until they were started `max_attempts` times.
+    Every attempt increases `attempts`, which fences off the results of an
+    attempt whose lease was taken over.
+
+    A job key deduplicates jobs: while a job with the key is pending or
+    running, enqueueing another one returns the active job instead.
+
+    Attributes:
+        db_file (str): The path to the SQLite database file.
+        max_attempts (int): How often a job is started before it fails.
+        backoff_s (float): The delay of the first retry, doubled per retry.
+        backoff_max_s (float): The maximum delay of a retry.
+    """
+
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS job (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            key TEXT,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL,
+            error TEXT,
+            run_at REAL NOT NULL,
+            lease_expires_at REAL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS job_active_key
+        ON job (key) WHERE status IN ('pending', 'running')
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS job_ready
+        ON job (status, priority DESC, run_at)
+        """,
+    )
+
+    def __init__(
+        self,
+        db_file: str = JOBS_DB_FILE,
+        max_attempts: int = JOBS_MAX_ATTEMPTS,
+        backoff_s: float = JOBS_BACKOFF_S,
+        backoff_max_s: float = JOBS_BACKOFF_MAX_S,
+    ) -> None:
+        """Initialize the JobQueue, creating its table if needed.
+
+        Args:
+            db_file (str, optional): The path to the SQLite database file.
+                Defaults to JOBS_DB_FILE.
+            max_attempts (int, optional): How often a job is started before
+                it fails. Defaults to JOBS_MAX_ATTEMPTS.
+            backoff_s (float, optional): The delay of the first retry.
+                Defaults to JOBS_BACKOFF_S.
+            backoff_max_s (float, optional): The maximum delay of a retry.
+                Defaults to JOBS_BACKOFF_MAX_S.
+        """
+        self.db_file = db_file
+        self.max_attempts = max_attempts
+        self.backoff_s = backoff_s
+        self.backoff_max_s = backoff_max_s
+        self._local = threading.local()
+        with self._transaction() as connection:
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+
+    def enqueue(self, jobs: Sequence[JobCreate]) -> list[Job]:
+        """Enqueue jobs, in one transaction.
+
+        A job whose key belongs to an active job is not enqueued, the active
+        job is returned instead, and its priority raised if needed.
+
+        Args:
+            jobs (Sequence[JobCreate]): The jobs to enqueue.
+
+        Returns:
+            list[Job]: The enqueued or active jobs, in the order of `jobs`.
+        """
+        enqueued = []
+        with self._transaction() as connection:
+            now = time.time()
+            for job in jobs:
+                row = None
+                if job.key is not None:
+                    row = connection.execute(
+                        "SELECT * FROM job WHERE key = ? AND status IN (?, ?)",
+                        (job.key, *ACTIVE_STATUSES),
+                    ).fetchone()
+                if row is None:
+                    job_id = connection.execute(
+                        "INSERT INTO job (kind, key, payload, status, priority,"
+                        " max_attempts, run_at, created_at, updated_at)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            job.kind.value,
+                            job.key,
+                            json.dumps(job.payload),
+                            TaskStatus.pending.value,
+                            job.priority,
+                            self.max_attempts,
+                            now,
+                            now,
+                            now,
+                        ),
+                    ).lastrowid
+                    assert job_id is not None
+                    JOBS.labels(job.kind.value, "enqueued").inc()
+                    enqueued.append(self._get(connection, job_id))
+                    continue
+                JOBS.labels(job.kind.value, "deduplicated").inc()
+                if job.priority > row["priority"]:
+                    connection.execute(
+                        "UPDATE job SET priority = ? WHERE id = ?",
+                        (job.priority, row["id"]),
+                    )
+                    enqueued.append(self._get(connection, row["id"]))
+                else:
+                    enqueued.append(self._to_job(row))
+        return enqueued
+
+    def claim(self, lease_s: float) -> Optional[Job]:
+        """Claim the next job that is due, starting an attempt.
+
+        Running jobs whose lease expired are claimed again, unless they used
+        up their attempts, then they fail.
+
+        Args:
+            lease_s (float): The lease of the attempt in seconds.
+
+        Returns:
+            Optional[Job]: The claimed job, None if no job is due.
+        """
+        with self._transaction() as connection:
+            now = time.time()
+            connection.execute(
+                "UPDATE job SET status = ?, error = ?, updated_at = ?"
+                " WHERE status = ? AND lease_expires_at < ?"
+                " AND attempts >= max_attempts",
+                (
+                    TaskStatus.failed.value,
+                    "The lease of the last attempt expired.",
+                    now,
+                    TaskStatus.running.value,
+                    now,
+                ),
+            )
+            row = connection.execute(
+                "SELECT id FROM job"
+                " WHERE (status = ? AND run_at <= ?)"
+                " OR (status = ? AND lease_expires_at < ?)"
+                " ORDER BY priority DESC, run_at, id LIMIT 1",
+                (TaskStatus.pending.value, now, TaskStatus.running.value, now),
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE job SET status = ?, attempts = attempts + 1,"
+                " lease_expires_at = ?, updated_at = ? WHERE id = ?",
+                (TaskStatus.running.value, now + lease_s, now, row["id"]),
+            )
+            return self._get(connection, row["id"])
+
+    def renew(self, job: Job, lease_s: float) -> bool:
+        """Renew the lease of a running attempt.
+
+        Args:
+            job (Job): The job, as claimed.
+            lease_s (float): The new lease in seconds, from now.
+
+        Returns:
+            bool: False if the attempt lost its lease to another one.
+        """
+        now = time.time()
+        return self._finish(
+            job, "lease_expires_at = ?, updated_at = ?", (now + lease_s, now)
+        )
+
+    def complete(self, job: Job) -> bool:
+        """Mark an attempt as done.
+
+        Args:
+            job (Job): The job, as claimed.
+
+        Returns:
+            bool: False if the attempt lost its lease to another one.
+        """
+        return self._finish(
+            job,
+            "status = ?, error = NULL, lease_expires_at = NULL, updated_at = ?",
+            (TaskStatus.done.value, time.time()),
+        )
+
+    def fail(self, job: Job, error: str, retry: bool = True) -> Optional[Job]:
+        """Record a failed attempt, scheduling a retry if attempts are left.
+
+        Args:
+            job (Job): The job, as claimed.
+            error (str): The error of the attempt.
+            retry (bool, optional): Whether the job may be retried, False for
+                errors that would happen again. Defaults to True.
+
+        Returns:
+            Optional[Job]: The job, pending if it is retried, None if the
+                attempt lost its lease to another one.
+        """
+        now = time.time()
+        if retry and job.attempts < job.max_attempts:
+            delay = min(self.backoff_s * 2 ** (job.attempts - 1), self.backoff_max_s)
+            status, run_at = TaskStatus.pending, now + delay
+        else:
+            status, run_at = TaskStatus.failed, job.run_at
+        finished = self._finish(
+            job,
+            "status = ?, error = ?, run_at = ?, lease_expires_at = NULL,"
+            " updated_at = ?",
+            (status.value, error, run_at, now),
+        )
+        return self.get(job.id) if finished else None
+
+    def release(self, job: Job) -> bool:
+        """Return a running job to the queue without counting its attempt.
+
+        E.g. when the worker shuts down.
+
+        Args:
+            job (Job): The job, as claimed.
+
+        Returns:
+            bool: False if the attempt lost its lease to another one.
+        """
+        return self._finish(
+            job,
+            "status = ?, attempts = attempts - 1, lease_expires_at = NULL,"
+            " updated_at = ?",
+            (TaskStatus.pending.value, time.time()),
+        )
+
+    def get(self, job_id: int) -> Optional[Job]:
+        """Load a job.
+
+        Args:
+            job_id (int): The ID of the job.
+
+        Returns:
+            Optional[Job]: The job, None if it does not exist.
+        """
+        row = self._select(self._connection(), job_id)
+        return self._to_job(row) if row else None
+
+    def list(
+        self,
+        status: Optional[TaskStatus] = None,
+        kind: Optional[JobKind] = None,
+        limit: int = 100,
+    ) -> list[Job]:
+        """List the most recently enqueued jobs.
+
+        Args:
+            status (Optional[TaskStatus], optional): Only jobs of this status.
+                Defaults to None, all statuses.
+            kind (Optional[JobKind], optional): Only jobs of this kind.
+                Defaults to None, all kinds.
+            limit (int, optional): The maximum number of jobs. Defaults to 100.
+
+        Returns:
+            list[Job]: The jobs, newest first.
+        """
+        conditions, params = ["1 = 1"], []
+        if status is not None:
+            conditions.append("status = ?")
+            params.append(status.value)
+        if kind is not None:
+            conditions.append("kind = ?")
+            params.append(kind.value)
+        rows = (
+            self._connection()
+            .execute(
+                f"SELECT * FROM job WHERE {' AND '.join(conditions)}"
+                " ORDER BY id DESC LIMIT ?",
+                (*params, limit),
+            )
+            .fetchall()
+        )
+        return [self._to_job(row) for row in rows]
+
+    def purge(self, older_than_s: float) -> int:
+        """Delete done and failed jobs that last changed a while ago.
+
+        Args:
+            older_than_s (float): The minimum age in seconds.
+
+        Returns:
+            int: The number of deleted jobs.
+        """
+        with self._transaction() as connection:
+            return connection.execute(
+                "DELETE FROM job WHERE status IN (?, ?) AND updated_at < ?",
+                (
+                    TaskStatus.done.value,
+                    TaskStatus.failed.value,
+                    time.time() - older_than_s,
+                ),
+            ).rowcount
+
+    def _finish(self, job: Job, assignments: str, params: tuple[Any, ...]) -> bool:
+        """Update a running attempt, unless it lost its lease.
+
+        Args:
+            job (Job): The job, as claimed.
+            assignments (str): The SET clause of the update.
+            params (tuple[Any, ...]): The parameters of the SET clause.
+
+        Returns:
+            bool: False if the attempt lost its lease to another one.
+        """
+        with self._transaction() as connection:
+            return bool(
+                connection.execute(
+                    f"UPDATE job SET {assignments}"
+                    " WHERE id = ? AND status = ? AND attempts = ?",
+                    (*params, job.id, TaskStatus.running.value, job.attempts),
+                ).rowcount
+            )
+
+    @staticmethod
+    def _select(connection: sqlite3.Connection, job_id: int) -> Optional[sqlite3.Row]:
+        """Select the row of a job.
+
+        Args:
+            connection (sqlite3.Connection): The connection to use.
+            job_id (int): The ID of the job.
+
+        Returns:
+            Optional[sqlite3.Row]: The row, None if the job does not exist.
+        """
+        row: Optional[sqlite3.Row] = connection.execute(
+            "SELECT * FROM job WHERE id = ?", (job_id,)
+        ).fetchone()
+        return row
+
+    @classmethod
+    def _get(cls, connection: sqlite3.Connection, job_id: int) -> Job:
+        """Select a job that exists, e.g. within the transaction that wrote it.
+
+        Args:
+            connection (sqlite3.Connection): The connection to use.
+            job_id (int): The ID of the job.
+
+        Returns:
+            Job: The job.
+        """
+        row = cls._select(connection, job_id)
+        assert row is not None, f"Job {job_id} does not exist."
+        return cls._to_job(row)
+
+    @staticmethod
+    def _to_job(row: sqlite3.Row) -> Job:
+        """Convert a row to a job.
+
+        Args:
+            row (sqlite3.Row): The row of the job.
+
+        Returns:
+            Job: The job.
+        """
+        return Job.model_validate({**dict(row), "payload": json.loads(row["payload"])})
+
+    def _connection(self) -> sqlite3.Connection:
+        """Return the connection of the current thread, opening it on first use.
+
+        Returns:
+            sqlite3.Connection: The connection, in autocommit mode.
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.db_file, timeout=30.0, isolation_level=None
+            )
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Run statements in a write transaction.
+
+        Yields:
+            sqlite3.Connection: The connection of the transaction.
+        """
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+
+job_queue = JobQueue()
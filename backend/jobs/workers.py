@@ -0,0 +1,201 @@
+import asyncio
+import time
+from typing import Optional, Sequence
+
+from fastapi import HTTPException
+
+from datamodels.enums import JobKind, TaskStatus
+from datamodels.models import Job, JobCreate
+from jobs.handlers import HANDLERS, JobHandler
+from jobs.queue import JobQueue, job_queue
+from utils.consts import (
+    JOBS_CONCURRENCY,
+    JOBS_LEASE_S,
+    JOBS_POLL_INTERVAL_S,
+    JOBS_RETENTION_S,
+)
+from utils.logger import get_logger
+from utils.metrics import JOB_DURATION, JOBS, JOBS_RUNNING
+
+logger = get_logger()
+
+
+class JobWorkers:
+    """Runs the jobs of the job queue in the background of an app worker.
+
+    Every app worker runs `concurrency` job workers, which claim the due
+    jobs of the shared queue. Idle job workers poll the queue, and are
+    woken up right away when this process enqueues a job. Jobs failing
+    with a client error (e.g. a character that does not exist) are not
+    retried.
+
+    Attributes:
+        queue (JobQueue): The job queue.
+        handlers (dict[JobKind, JobHandler]): The handler of each job kind.
+        concurrency (int): The number of jobs run at once.
+        poll_interval (float): Seconds between polls of idle job workers.
+        lease_s (float): The lease of a job attempt, renewed while it runs.
+    """
+
+    PURGE_INTERVAL_S = 3600.0
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        handlers: dict[JobKind, JobHandler],
+        concurrency: int = JOBS_CONCURRENCY,
+        poll_interval: float = JOBS_POLL_INTERVAL_S,
+        lease_s: float = JOBS_LEASE_S,
+    ) -> None:
+        """Initializes the JobWorkers, which do not run until started.
+
+        Args:
+            queue (JobQueue): The job queue.
+            handlers (dict[JobKind, JobHandler]): The handler of each job kind.
+            concurrency (int, optional): The number of jobs run at once.
+                Defaults to JOBS_CONCURRENCY.
+            poll_interval (float, optional): Seconds between polls of idle job
+                workers. Defaults to JOBS_POLL_INTERVAL_S.
+            lease_s (float, optional): The lease of a job attempt. Defaults to
+                JOBS_LEASE_S.
+        """
+        self.queue = queue
+        self.handlers = handlers
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.lease_s = lease_s
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._finished: Optional[asyncio.Condition] = None
+        self._tasks: list[asyncio.Task] = []
+        self._next_purge = 0.0
+
+    def start(self) -> None:
+        """Starts the job workers on the running event loop, unless they run."""
+        # Startup handlers may run twice, see `Warmup.start`
+        if self._tasks:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._finished = asyncio.Condition()
+        self._tasks = [
+            asyncio.create_task(self._work()) for _ in range(self.concurrency)
+        ]
+
+    async def stop(self) -> None:
+        """Stops the job workers, returning their running jobs to the queue."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def enqueue(self, jobs: Sequence[JobCreate]) -> list[Job]:
+        """Enqueues jobs and wakes up idle job workers.
+
+        Blocks on the database, so it is called in a thread from async code.
+
+        Args:
+            jobs (Sequence[JobCreate]): The jobs to enqueue.
+
+        Returns:
+            list[Job]: The enqueued jobs, or the active jobs with their keys.
+        """
+        enqueued = self.queue.enqueue(jobs)
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        return enqueued
+
+    async def wait(self, job_id: int, timeout: Optional[float] = None) -> Optional[Job]:
+        """Waits until a job is done or failed.
+
+        Jobs run by other app workers are noticed by polling the queue.
+
+        Args:
+            job_id (int): The ID of the job.
+            timeout (Optional[float], optional): The maximum time to wait in
+                seconds. Defaults to None, no limit.
+
+        Returns:
+            Optional[Job]: The job, still active if the wait timed out, None if
+                it does not exist.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = await asyncio.to_thread(self.queue.get, job_id)
+            if job is None or job.status in (TaskStatus.done, TaskStatus.failed):
+                return job
+            wait_s = self.poll_interval
+            if deadline is not None:
+                wait_s = min(wait_s, deadline - time.monotonic())
+                if wait_s <= 0:
+                    return job
+            if self._finished is None:
+                await asyncio.sleep(wait_s)
+                continue
+            async with self._finished:
+                try:
+                    await asyncio.wait_for(self._finished.wait(), wait_s)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _work(self) -> None:
+        """Runs due jobs one after another, until cancelled."""
+        assert self._wakeup is not None
+        while True:
+            if time.monotonic() >= self._next_purge:
+                self._next_purge = time.monotonic() + self.PURGE_INTERVAL_S
+                await asyncio.to_thread(self.queue.purge, JOBS_RETENTION_S)
+            self._wakeup.clear()
+            job = await asyncio.to_thread(self.queue.claim, self.lease_s)
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job)
+
+    async def _run(self, job: Job) -> None:
+        """Runs an attempt of a job and records its result.
+
+        Args:
+            job (Job): The claimed job.
+        """
+        kind = job.kind.value
+        logger.debug(f"Run job {job.id} ({kind}), attempt {job.attempts}.")
+        task = asyncio.create_task(self.handlers[job.kind](job.payload))
+        JOBS_RUNNING.labels(kind).inc()
+        start = time.perf_counter()
+        try:
+            # Renew the lease well before it expires
+            while not (await asyncio.wait({task}, timeout=self.lease_s / 3))[0]:
+                await asyncio.to_thread(self.queue.renew, job, self.lease_s)
+            task.result()
+        except asyncio.CancelledError:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            self.queue.release(job)
+            raise
+        except Exception as exc:
+            retry = not (isinstance(exc, HTTPException) and exc.status_code < 500)
+            failed = await asyncio.to_thread(self.queue.fail, job, repr(exc), retry)
+            if failed is None:
+                logger.warning(f"Job {job.id} ({kind}) lost its lease: {exc!r}")
+            elif failed.status == TaskStatus.pending:
+                logger.warning(f"Job {job.id} ({kind}) failed, retrying: {exc!r}")
+                JOBS.labels(kind, "retried").inc()
+            else:
+                logger.exception(f"Job {job.id} ({kind}) failed.")
+                JOBS.labels(kind, "failed").inc()
+        else:
+            await asyncio.to_thread(self.queue.complete, job)
+            JOBS.labels(kind, "done").inc()
+        finally:
+            JOBS_RUNNING.labels(kind).dec()
+            JOB_DURATION.labels(kind).observe(time.perf_counter() - start)
+        assert self._finished is not None
+        async with self._finished:
+            self._finished.notify_all()
+
+
+job_workers = JobWorkers(job_queue, HANDLERS)
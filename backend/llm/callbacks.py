@@ -0,0 +1,144 @@
+import time
+from typing import Any, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+from utils.metrics import LLM_TOKENS, STAGE_LATENCY
+from utils.tracing import Span, tracer
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """Records token usage and stage latencies of LLM and retriever runs.
+
+    Attributes:
+        model (Optional[str]): The model name used as metric label.
+        stage (Optional[str]): The stage whose latency is observed,
+            if None only token usage is recorded.
+    """
+
+    # Recording metrics is cheap, no need to hop to a thread pool
+    run_inline = True
+
+    def __init__(self, model: Optional[str] = None, stage: Optional[str] = None):
+        """Initializes the handler.
+
+        Args:
+            model (Optional[str], optional): The model name used as metric label.
+            stage (Optional[str], optional): The stage whose latency is observed.
+        """
+        self.model = model
+        self.stage = stage
+        self._starts: dict[UUID, float] = {}
+
+    def _start(self, run_id: UUID) -> None:
+        """Remembers the start time of a run."""
+        self._starts[run_id] = time.perf_counter()
+
+    def _end(self, run_id: UUID) -> None:
+        """Observes the duration of a run for the handler's stage."""
+        start = self._starts.pop(run_id, None)
+        if start is not None and self.stage:
+            STAGE_LATENCY.labels(self.stage).observe(time.perf_counter() - start)
+
+    def on_chat_model_start(self, *args: Any, run_id: UUID, **kwargs: Any) -> None:
+        """Called when a chat model run starts."""
+        self._start(run_id)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        """Called when an LLM run ends, records the token usage."""
+        self._end(run_id)
+        model = self.model or (response.llm_output or {}).get("model", "unknown")
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                if usage := getattr(message, "usage_metadata", None):
+                    LLM_TOKENS.labels(model, "input").inc(usage["input_tokens"])
+                    LLM_TOKENS.labels(model, "output").inc(usage["output_tokens"])
+
+    def on_llm_error(
+        self, error: BaseException, *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        """Called when an LLM run fails."""
+        self._starts.pop(run_id, None)
+
+    def on_retriever_start(self, *args: Any, run_id: UUID, **kwargs: Any) -> None:
+        """Called when a retriever run starts."""
+        self._start(run_id)
+
+    def on_retriever_end(self, *args: Any, run_id: UUID, **kwargs: Any) -> None:
+        """Called when a retriever run ends."""
+        self._end(run_id)
+
+    def on_retriever_error(self, *args: Any, run_id: UUID, **kwargs: Any) -> None:
+        """Called when a retriever run fails."""
+        self._starts.pop(run_id, None)
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Records LLM and retriever runs as spans of the current trace.
+
+    Attributes:
+        name (str): The span name, e.g. the model name.
+    """
+
+    run_inline = True
+
+    def __init__(self, name: str):
+        """Initializes the handler.
+
+        Args:
+            name (str): The span name, e.g. the model name.
+        """
+        self.name = name
+        self._spans: dict[UUID, Span] = {}
+
+    def _start(self, run_id: UUID, kind: str, **attributes: Any) -> None:
+        """Starts a span for a run, if the run happens within a trace."""
+        if tracer.current_span() is not None:
+            self._spans[run_id] = tracer.start_span(f"{kind}.{self.name}", **attributes)
+
+    def _end(self, run_id: UUID, error: Optional[BaseException] = None) -> None:
+        """Ends the span of a run."""
+        if span := self._spans.pop(run_id, None):
+            tracer.end_span(span, error)
+
+    def on_chat_model_start(self, *args: Any, run_id: UUID, **kwargs: Any) -> None:
+        """Called when a chat model run starts."""
+        self._start(run_id, "llm", tags=kwargs.get("tags"))
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        """Called when an LLM run ends, adds the token usage to the span."""
+        if span := self._spans.get(run_id):
+            for generations in response.generations:
+                for generation in generations:
+                    message = getattr(generation, "message", None)
+                    if usage := getattr(message, "usage_metadata", None):
+                        span.set_attribute("input_tokens", usage["input_tokens"])
+                        span.set_attribute("output_tokens", usage["output_tokens"])
+        self._end(run_id)
+
+    def on_llm_error(
+        self, error: BaseException, *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        """Called when an LLM run fails."""
+        self._end(run_id, error)
+
+    def on_retriever_start(
+        self, serialized: Any, query: str, *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        """Called when a retriever run starts."""
+        self._start(run_id, "retriever", query=query)
+
+    def on_retriever_end(self, documents: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        """Called when a retriever run ends."""
+        if span := self._spans.get(run_id):
+            span.set_attribute("documents", len(documents))
+        self._end(run_id)
+
+    def on_retriever_error(
+        self, error: BaseException, *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        """Called when a retriever run fails."""
+        self._end(run_id, error)
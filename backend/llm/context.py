@@ -0,0 +1,227 @@
+import os
+import threading
+from typing import Any, Optional
+
+from langchain_core.documents import Document
+from langchain_core.messages import BaseMessage
+from tokenizers import Tokenizer
+
+from utils.consts import PROMPT_MEMORY_TOKEN_LIMIT, PROMPT_TOKEN_BUDGET, TOKENIZER_MODEL
+from utils.logger import get_logger
+from utils.metrics import PROMPT_TOKENS, PROMPT_TRIMMED
+from utils.tracing import tracer
+
+logger = get_logger()
+
+# Rough number of characters per token, used when no tokenizer is available
+CHARS_PER_TOKEN = 4
+# Tokens added by the chat template around each message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class TokenCounter:
+    """Counts tokens with a local Huggingface tokenizer.
+
+    The tokenizer is loaded once and shared. If it cannot be loaded (e.g.
+    without network access or Huggingface token), token counts are
+    estimated from the text length instead.
+    """
+
+    _tokenizer: Optional[Tokenizer] = None
+    _loaded = False
+    _lock = threading.Lock()
+
+    @classmethod
+    def tokenizer(cls) -> Optional[Tokenizer]:
+        """Return the shared tokenizer, loading it on first use.
+
+        Loading may download the tokenizer, so it is done during warm-up.
+
+        Returns:
+            Optional[Tokenizer]: The tokenizer, None if it is unavailable.
+        """
+        with cls._lock:
+            if not cls._loaded:
+                cls._tokenizer = cls._load(TOKENIZER_MODEL)
+                cls._loaded = True
+        return cls._tokenizer
+
+    @staticmethod
+    def _load(model: str) -> Optional[Tokenizer]:
+        """Load a tokenizer from a file or from the Huggingface hub.
+
+        Args:
+            model (str): The path of a tokenizer.json file or a model name.
+
+        Returns:
+            Optional[Tokenizer]: The tokenizer, None if it could not be loaded.
+        """
+        if not model:
+            return None
+        try:
+            if os.path.isfile(model):
+                return Tokenizer.from_file(model)
+            return Tokenizer.from_pretrained(model)
+        except Exception as exc:
+            logger.warning(
+                f"Could not load tokenizer {model}, token counts are estimated "
+                f"from the text length instead: {exc!r}"
+            )
+            return None
+
+    @classmethod
+    def count(cls, texts: list[str]) -> list[int]:
+        """Count the tokens of texts.
+
+        Args:
+            texts (list[str]): The texts.
+
+        Returns:
+            list[int]: The number of tokens of each text.
+        """
+        tokenizer = cls.tokenizer()
+        if tokenizer is None:
+            return [-(-len(text) // CHARS_PER_TOKEN) for text in texts]
+        encodings = tokenizer.encode_batch(texts, add_special_tokens=False)
+        return [len(encoding.ids) for encoding in encodings]
+
+    @classmethod
+    def truncate(cls, text: str, max_tokens: int) -> str:
+        """Cut a text down to at most `max_tokens` tokens.
+
+        Args:
+            text (str): The text.
+            max_tokens (int): The maximum number of tokens.
+
+        Returns:
+            str: The beginning of the text that fits into `max_tokens`.
+        """
+        if max_tokens <= 0:
+            return ""
+        tokenizer = cls.tokenizer()
+        if tokenizer is None:
+            return text[: max_tokens * CHARS_PER_TOKEN]
+        encoding = tokenizer.encode(text, add_special_tokens=False)
+        if len(encoding.offsets) <= max_tokens:
+            return text
+        return text[: encoding.offsets[max_tokens - 1][1]]
+
+
+class ContextAssembler:
+    """Fits the components of the response prompt into a token budget.
+
+    The system prompt and the user's input are always kept. The user
+    characterization and the chat summary are cut to `memory_token_limit`
+    tokens each. If the chat history and the retrieved context do not fit
+    into the remaining budget, the oldest messages are left out first, then
+    the lowest-scoring chunks (retrievers return chunks by descending score).
+
+    Attributes:
+        system_prompt (str): The system prompt template of the character.
+        budget (int): The maximum number of prompt tokens.
+        memory_token_limit (int): The maximum number of tokens of the user
+            characterization and of the chat summary.
+    """
+
+    def __init__(
+        self,
+        system_prompt: str,
+        budget: int = PROMPT_TOKEN_BUDGET,
+        memory_token_limit: int = PROMPT_MEMORY_TOKEN_LIMIT,
+    ):
+        """Initialize the ContextAssembler for a character's system prompt.
+
+        Args:
+            system_prompt (str): The system prompt template of the character.
+            budget (int, optional): The maximum number of prompt tokens.
+                Defaults to PROMPT_TOKEN_BUDGET.
+            memory_token_limit (int, optional): The maximum number of tokens of
+                the user characterization and of the chat summary.
+                Defaults to PROMPT_MEMORY_TOKEN_LIMIT.
+        """
+        self.system_prompt = system_prompt
+        self.budget = budget
+        self.memory_token_limit = memory_token_limit
+
+    def fit(self, inputs: dict[str, Any]) -> dict[str, Any]:
+        """Fit the inputs of the response prompt into the token budget.
+
+        Args:
+            inputs (dict[str, Any]): The inputs of the response prompt, with
+                the retrieved documents as `context`.
+
+        Returns:
+            dict[str, Any]: The inputs with the components that did not fit
+                cut or left out.
+        """
+        user_information = TokenCounter.truncate(
+            inputs.get("user_information", ""), self.memory_token_limit
+        )
+        chat_summary = TokenCounter.truncate(
+            inputs.get("chat_summary", ""), self.memory_token_limit
+        )
+        history: list[BaseMessage] = list(inputs.get("chat_history", []))
+        context: list[Document] = list(inputs.get("context", []))
+
+        counts = TokenCounter.count(
+            [
+                self.system_prompt,
+                user_information,
+                chat_summary,
+                inputs["input"],
+                *(str(message.content) for message in history),
+                *(document.page_content for document in context),
+            ]
+        )
+        tokens = {
+            "system": counts[0],
+            "user_information": counts[1],
+            "chat_summary": counts[2],
+            "input": counts[3] + MESSAGE_OVERHEAD_TOKENS,
+        }
+        history_tokens = [
+            count + MESSAGE_OVERHEAD_TOKENS for count in counts[4 : 4 + len(history)]
+        ]
+        context_tokens = counts[4 + len(history) :]
+
+        available = self.budget - sum(tokens.values())
+        used = sum(history_tokens) + sum(context_tokens)
+        trimmed = {"history": 0, "context": 0}
+        while history and used > available:
+            history.pop(0)
+            used -= history_tokens.pop(0)
+            trimmed["history"] += 1
+        while context and used > available:
+            context.pop()
+            used -= context_tokens.pop()
+            trimmed["context"] += 1
+
+        tokens["history"] = sum(history_tokens)
+        tokens["context"] = sum(context_tokens)
+        tokens["total"] = sum(tokens.values())
+        self._observe(tokens, trimmed)
+
+        return {
+            **inputs,
+            "user_information": user_information,
+            "chat_summary": chat_summary,
+            "chat_history": history,
+            "context": context,
+        }
+
+    @staticmethod
+    def _observe(tokens: dict[str, int], trimmed: dict[str, int]) -> None:
+        """Record the prompt tokens and trimmed items in the metrics and trace.
+
+        Args:
+            tokens (dict[str, int]): The tokens per prompt component.
+            trimmed (dict[str, int]): The number of left out items per component.
+        """
+        for component, count in tokens.items():
+            PROMPT_TOKENS.labels(component).observe(count)
+        for component, count in trimmed.items():
+            if count:
+                PROMPT_TRIMMED.labels(component).inc(count)
+        if span := tracer.current_span():
+            span.set_attribute("prompt_tokens", tokens["total"])
+            span.set_attribute("trimmed", trimmed)
@@ -0,0 +1,248 @@
+import asyncio
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from langchain_core.embeddings import Embeddings
+
+from utils.consts import (
+    EMBEDDING_BATCH_MAX_SIZE,
+    EMBEDDING_BATCH_MAX_WAIT_MS,
+    QUERY_EMBEDDING_CACHE_SIZE,
+)
+from utils.metrics import (
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_BATCH_WAIT,
+    QUERY_EMBEDDING_CACHE,
+)
+
+
+def normalize_query(text: str) -> str:
+    """Normalizes a query so that trivially different queries share embeddings.
+
+    Args:
+        text (str): The query.
+
+    Returns:
+        str: The query in lower case with collapsed whitespace.
+    """
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+class _Batch:
+    """Queries waiting to be embedded together."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Starts an empty batch.
+
+        Args:
+            loop (asyncio.AbstractEventLoop): The event loop of the requests.
+        """
+        self.loop = loop
+        self.futures: dict[str, asyncio.Future] = {}
+        self.start = time.perf_counter()
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class QueryEmbeddings(Embeddings):
+    """Embeds queries with an LRU cache and micro-batched API calls.
+
+    Queries are normalized (see `normalize_query`) and their embeddings
+    are cached. Concurrent async requests for uncached queries are
+    gathered for up to `max_wait_ms` or `max_batch_size` queries and
+    embedded with a single API call, requests for a query that is already
+    being embedded wait for that embedding. Documents are embedded
+    directly by the wrapped embeddings.
+
+    Attributes:
+        embeddings (Embeddings): The embeddings calling the API.
+        cache_size (int): The maximum number of cached query embeddings.
+        max_batch_size (int): The maximum number of queries per API call.
+        max_wait_ms (float): The maximum time a query waits for others to
+            join its batch.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        cache_size: int = QUERY_EMBEDDING_CACHE_SIZE,
+        max_batch_size: int = EMBEDDING_BATCH_MAX_SIZE,
+        max_wait_ms: float = EMBEDDING_BATCH_MAX_WAIT_MS,
+    ):
+        """Initialize the QueryEmbeddings around the embeddings calling the API.
+
+        Args:
+            embeddings (Embeddings): The embeddings calling the API.
+            cache_size (int, optional): The maximum number of cached query
+                embeddings. Defaults to QUERY_EMBEDDING_CACHE_SIZE.
+            max_batch_size (int, optional): The maximum number of queries per
+                API call. Defaults to EMBEDDING_BATCH_MAX_SIZE.
+            max_wait_ms (float, optional): The maximum time a query waits for
+                others to join its batch. Defaults to EMBEDDING_BATCH_MAX_WAIT_MS.
+        """
+        self.embeddings = embeddings
+        self.cache_size = cache_size
+        self.max_batch_size = max(max_batch_size, 1)
+        self.max_wait_ms = max_wait_ms
+        self._cache: OrderedDict[str, list[float]] = OrderedDict()
+        # The sync methods run in executor threads
+        self._cache_lock = threading.Lock()
+        # Queries being embedded (or waiting in the batch) by normalized text
+        self._pending: dict[str, asyncio.Future] = {}
+        self._batch: Optional[_Batch] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """Embed documents with the wrapped embeddings.
+
+        Args:
+            texts (list[str]): The documents.
+
+        Returns:
+            list[list[float]]: The embeddings.
+        """
+        return self.embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        """Embed documents with the wrapped embeddings.
+
+        Args:
+            texts (list[str]): The documents.
+
+        Returns:
+            list[list[float]]: The embeddings.
+        """
+        return await self.embeddings.aembed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        """Embed a query, without batching.
+
+        Args:
+            text (str): The query.
+
+        Returns:
+            list[float]: The embedding.
+        """
+        query = normalize_query(text)
+        if (embedding := self._cache_get(query)) is not None:
+            QUERY_EMBEDDING_CACHE.labels("hit").inc()
+            return embedding
+        QUERY_EMBEDDING_CACHE.labels("miss").inc()
+        embedding = self.embeddings.embed_query(query)
+        self._cache_put(query, embedding)
+        return embedding
+
+    async def aembed_query(self, text: str) -> list[float]:
+        """Embed a query, batched with concurrent queries.
+
+        Args:
+            text (str): The query.
+
+        Returns:
+            list[float]: The embedding.
+        """
+        query = normalize_query(text)
+        if (embedding := self._cache_get(query)) is not None:
+            QUERY_EMBEDDING_CACHE.labels("hit").inc()
+            return embedding
+        future = self._pending.get(query)
+        if future is not None and future.get_loop() is asyncio.get_running_loop():
+            QUERY_EMBEDDING_CACHE.labels("joined").inc()
+        else:
+            QUERY_EMBEDDING_CACHE.labels("miss").inc()
+            future = self._enqueue(query)
+        # A cancelled request must not cancel the others waiting for the query
+        return await asyncio.shield(future)
+
+    def _enqueue(self, query: str) -> asyncio.Future:
+        """Add a query to the current batch, starting a batch if needed.
+
+        Args:
+            query (str): The normalized query.
+
+        Returns:
+            asyncio.Future: Resolves to the embedding of the query.
+        """
+        loop = asyncio.get_running_loop()
+        batch = self._batch
+        if batch is None or batch.loop is not loop:
+            batch = self._batch = _Batch(loop)
+            batch.timer = loop.call_later(self.max_wait_ms / 1000, self._flush, batch)
+        future = batch.futures[query] = self._pending[query] = loop.create_future()
+        if len(batch.futures) >= self.max_batch_size:
+            self._flush(batch)
+        return future
+
+    def _flush(self, batch: _Batch) -> None:
+        """Close a batch and embed its queries in the background.
+
+        Args:
+            batch (_Batch): The batch.
+        """
+        if self._batch is batch:
+            self._batch = None
+        if batch.timer is not None:
+            batch.timer.cancel()
+        task = batch.loop.create_task(self._embed(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _embed(self, batch: _Batch) -> None:
+        """Embed the queries of a batch with one API call.
+
+        Args:
+            batch (_Batch): The batch.
+        """
+        queries = list(batch.futures)
+        EMBEDDING_BATCH_SIZE.observe(len(queries))
+        EMBEDDING_BATCH_WAIT.observe(time.perf_counter() - batch.start)
+        try:
+            embeddings = await self.embeddings.aembed_documents(queries)
+            if len(embeddings) != len(queries):
+                # The embeddings cannot be matched to the queries reliably
+                raise ValueError(
+                    f"Got {len(embeddings)} embeddings for {len(queries)} queries."
+                )
+        except Exception as exc:
+            for query, future in batch.futures.items():
+                self._pending.pop(query, None)
+                future.set_exception(exc)
+                # Only re-raised if a request is still waiting for it
+                future.exception()
+            return
+        for query, embedding in zip(queries, embeddings):
+            self._cache_put(query, embedding)
+            self._pending.pop(query, None)
+            batch.futures[query].set_result(embedding)
+
+    def _cache_get(self, query: str) -> Optional[list[float]]:
+        """Look up a cached query embedding, marking it as recently used.
+
+        Args:
+            query (str): The normalized query.
+
+        Returns:
+            Optional[list[float]]: The embedding, None if it is not cached.
+        """
+        with self._cache_lock:
+            embedding = self._cache.get(query)
+            if embedding is not None:
+                self._cache.move_to_end(query)
+            return embedding
+
+    def _cache_put(self, query: str, embedding: list[float]) -> None:
+        """Cache a query embedding, evicting the least recently used ones.
+
+        Args:
+            query (str): The normalized query.
+            embedding (list[float]): The embedding.
+        """
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[query] = embedding
+            self._cache.move_to_end(query)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
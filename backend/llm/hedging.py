@@ -0,0 +1,130 @@
+import asyncio
+import statistics
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from utils.consts import LLM_HEDGE_MIN_SAMPLES, LLM_HEDGE_QUANTILE, LLM_HEDGING
+from utils.metrics import LLM_HEDGED
+
+T = TypeVar("T")
+
+# Number of recent latencies per stage the hedging delay is estimated from
+LATENCY_WINDOW = 200
+
+
+class Hedger:
+    """Hedges slow calls by racing them against a duplicate.
+
+    If a call of a stage takes longer than the `quantile` of the recent
+    latencies of that stage, a duplicate is started and the first result
+    is used, the other call is cancelled. This cuts the latency tail of
+    the LLM API at the cost of roughly `1 - quantile` extra calls.
+
+    Attributes:
+        enabled (bool): If calls are hedged at all.
+        quantile (float): The latency quantile after which calls are hedged.
+        min_samples (int): The number of latencies of a stage needed before
+            its calls are hedged.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = LLM_HEDGING,
+        quantile: float = LLM_HEDGE_QUANTILE,
+        min_samples: int = LLM_HEDGE_MIN_SAMPLES,
+    ):
+        """Initialize the Hedger.
+
+        Args:
+            enabled (bool, optional): If calls are hedged at all.
+                Defaults to LLM_HEDGING.
+            quantile (float, optional): The latency quantile after which calls
+                are hedged. Defaults to LLM_HEDGE_QUANTILE.
+            min_samples (int, optional): The number of latencies of a stage
+                needed before its calls are hedged.
+                Defaults to LLM_HEDGE_MIN_SAMPLES.
+        """
+        self.enabled = enabled
+        self.quantile = quantile
+        self.min_samples = max(min_samples, 2)
+        self._latencies: dict[str, deque[float]] = {}
+
+    def delay(self, stage: str) -> Optional[float]:
+        """Returns the time after which calls of a stage are hedged.
+
+        Args:
+            stage (str): The stage of the calls.
+
+        Returns:
+            Optional[float]: The delay in seconds, None if the calls of the
+                stage are not hedged (yet).
+        """
+        latencies = self._latencies.get(stage, ())
+        if not self.enabled or len(latencies) < self.min_samples:
+            return None
+        cut = min(max(round(self.quantile * 100), 1), 99)
+        return statistics.quantiles(latencies, n=100, method="inclusive")[cut - 1]
+
+    async def run(self, stage: str, call: Callable[[], Awaitable[T]]) -> T:
+        """Runs a call, hedged with a duplicate if it is slow.
+
+        Args:
+            stage (str): The stage of the call, calls of a stage share their
+                latency statistics.
+            call (Callable[[], Awaitable[T]]): Starts the call, may be called
+                twice.
+
+        Returns:
+            T: The result of the call that finished first.
+
+        Raises:
+            Exception: The error of the primary call, if both calls failed.
+        """
+        delay = self.delay(stage)
+        starts: dict[asyncio.Future, float] = {}
+
+        def start() -> asyncio.Future:
+            future = asyncio.ensure_future(call())
+            starts[future] = time.perf_counter()
+            return future
+
+        primary = start()
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait({primary}, timeout=delay)
+                if not done:
+                    start()
+            pending = set(starts)
+            while True:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    if future.exception() is None:
+                        self._record(stage, time.perf_counter() - starts[future])
+                        if len(starts) > 1:
+                            winner = "primary" if future is primary else "hedge"
+                            LLM_HEDGED.labels(stage, winner).inc()
+                        return future.result()
+                if not pending:
+                    # Raises the error of the primary call
+                    return primary.result()
+        finally:
+            for future in starts:
+                if future.done() and not future.cancelled():
+                    # Marks the error of a failed call as retrieved
+                    future.exception()
+                future.cancel()
+
+    def _record(self, stage: str, latency: float) -> None:
+        """Adds a latency to the statistics of a stage.
+
+        Args:
+            stage (str): The stage of the call.
+            latency (float): The latency of the call in seconds.
+        """
+        self._latencies.setdefault(stage, deque(maxlen=LATENCY_WINDOW)).append(latency)
+
+
+hedger = Hedger()
@@ -1,76 +1,140 @@
-from langchain.chains import create_history_aware_retriever, create_retrieval_chain
+import asyncio
+import time
+from operator import itemgetter
+from typing import (
+    Any,
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Iterable,
+    Optional,
+    TypeVar,
+    cast,
+)
+
 from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.messages import (
+    AIMessage,
+    AIMessageChunk,
+    BaseMessage,
+    HumanMessage,
+    messages_from_dict,
+    messages_to_dict,
+)
+from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.runnables import RunnableBinding, RunnableConfig
+from langchain_core.runnables import (
+    Runnable,
+    RunnableBinding,
+    RunnableConfig,
+    RunnableLambda,
+    RunnablePassthrough,
+)
+from langchain_core.utils.json import parse_json_markdown
 from langchain_mistralai import ChatMistralAI
-from langgraph.checkpoint.memory import MemorySaver
 from langgraph.constants import END, START
 from langgraph.graph import StateGraph
 from langgraph.graph.state import CompiledStateGraph
-from langgraph.types import StateSnapshot
 
 from database.database import Database
-from datamodels.enums import Sender
-from datamodels.models import Character, State
-from llm.prompts import Prompts
+from database.session_store import Session, session_store
+from datamodels.enums import (
+    LlmPriority,
+    PreprocessingStep,
+    Sender,
+    StreamChannel,
+    StreamEvent,
+)
+from datamodels.models import Character, PreprocessingResult
+from datamodels.state import State
+from llm.callbacks import MetricsCallbackHandler, TracingCallbackHandler
+from llm.context import ContextAssembler
+from llm.hedging import hedger
+from llm.policy import PreprocessingPolicy
+from llm.prompts import EMPTY_CHAT_SUMMARY, UNKNOWN_USER, Prompts
 from llm.rag import RAG
-from utils.consts import MISTRAL_LANGUAGE_MODEL_LARGE, MISTRAL_LANGUAGE_MODEL_MEDIUM
+from llm.response_cache import response_cache, user_bucket
+from llm.retrieval import create_speculative_retrieval
+from llm.scheduler import ScheduledChatMistralAI, current_thread_id
+from utils.consts import (
+    LLM_TIMEOUT_S,
+    MISTRAL_BASE_URL,
+    MISTRAL_LANGUAGE_MODEL_LARGE,
+    MISTRAL_LANGUAGE_MODEL_MEDIUM,
+    RESPONSE_CACHE_ENABLED,
+    RETRIEVAL_SPECULATIVE,
+)
 from utils.logger import get_logger
+from utils.metrics import AGENTS, STAGE_LATENCY, observe_stage
+from utils.tracing import tracer
 
 logger = get_logger()
 
+T = TypeVar("T")
+
+# Tags the LLM run that generates the character's response, so that
+# only its tokens are streamed to the client.
+RESPONSE_TAG = "character_response"
+
 
 class LlmWorkflow:
-    """Workflow class that statefully manages the conversation.
+    """Workflow class that manages the conversations with a character.
+
+    The workflow itself is stateless, the conversations are kept in the
+    session store shared by all workers. A turn loads the session of its
+    thread, runs the graph and appends its messages to the session, so
+    that any worker can serve any turn.
 
     Attributes:
-        agents_store (dict): A store that maps thread IDs and character
-            IDs to workflow instances.
+        workflows (dict): The workflows of this worker by character ID.
         db (Database): Database instance for fetching character data.
         character (Character): The character fetched from the database.
         retriever: The RAG retriever for the character data.
+        policy (PreprocessingPolicy): Decides which preprocessing LLM calls
+            run in a turn.
         graph (StateGraph): The runnable graph.
     """
 
-    # TODO: This could be a database for persistence
-    # Currently, chat histories are deleted if the server restarts.
-    agents_store: dict[str, dict[int, "LlmWorkflow"]] = {}
+    workflows: dict[int, "LlmWorkflow"] = {}
 
-    def __init__(self, character_id: int):
-        """Initialize the LlmWorkflow with a specific character and thread.
+    def __init__(self, character_id: int, policy: Optional[PreprocessingPolicy] = None):
+        """Initialize the LlmWorkflow with a specific character.
 
         Args:
             character_id (int): The ID of the character.
+            policy (Optional[PreprocessingPolicy], optional): The preprocessing
+                policy. Defaults to the policy configured in the environment.
         """
         self.db = Database()
         self.character = self.db.get_by_id(character_id, Character)
         self.retriever = RAG().retriever(character_id)
+        self.policy = policy or PreprocessingPolicy()
         self.graph = self._initialize_graph()
         self.prompts = Prompts(self.character)
+        # Chat history foldings running in this worker by thread ID
+        self._fold_tasks: dict[str, asyncio.Task] = {}
 
     def _initialize_graph(self) -> CompiledStateGraph:
         """Initializes the state graph for managing conversation flow.
 
-        Adds nodes and edges for tasks such as summarizing chat history,
-        characterizing the user, and generating responses, and compiles
-        the workflow with memory saving capabilities.
+        Adds nodes and edges for characterizing the user and generating
+        responses. The graph has no checkpointer, the state of a turn is
+        loaded from and saved to the session store, see `stream_response`.
+        The chat history is summarized outside of the graph, after the
+        response, see `fold_chat_history`.
 
         Returns:
             CompiledStateGraph: The compiled workflow graph.
         """
         workflow = StateGraph(state_schema=State)
-        workflow.add_node("summarize_chat_history", self.summarize_chat_history)
         workflow.add_node("characterize_user", self.characterize_user)
         workflow.add_node("model", self.generate_response)
 
-        workflow.add_edge(START, "summarize_chat_history")
-        workflow.add_edge("summarize_chat_history", "characterize_user")
+        workflow.add_edge(START, "characterize_user")
         workflow.add_edge("characterize_user", "model")
         workflow.add_edge("model", END)
 
-        memory = MemorySaver()
-        return workflow.compile(checkpointer=memory)
+        return workflow.compile()
 
     def summarize_character_personality(self):
         """Generate a summarized version of the character's personality.
@@ -79,53 +143,235 @@ class LlmWorkflow:
         Otherwise, generates a summary using the LLM and updates
         the character in the database.
         """
-        if not self.character.summarized_personality:
-            prompt = self.prompts.get_summarize_personality_prompt()
-            llm = self.get_llm(MISTRAL_LANGUAGE_MODEL_MEDIUM)
+        self.ensure_personality_summary(self.db, self.character)
+
+    @classmethod
+    def ensure_personality_summary(cls, db: Database, character: Character) -> None:
+        """Generate and store a character's personality summary if it is missing.
+
+        Does not require a workflow instance, so it can be used to
+        preload characters before anyone chats with them.
+
+        Args:
+            db (Database): Database instance used to update the character.
+            character (Character): The character to summarize.
+        """
+        if not character.summarized_personality:
+            prompt = Prompts(character).get_summarize_personality_prompt()
+            llm = cls.get_llm(MISTRAL_LANGUAGE_MODEL_MEDIUM)
             content = llm.invoke(prompt).content
-            self.db.update(
-                self.character,
+            db.update(
+                character,
                 {
                     Character.summarized_personality.name: content,  # type: ignore
                 },
             )
 
-    async def summarize_chat_history(
-        self, state: State, config: RunnableConfig
-    ) -> State:
-        """Summarizes the chat history to keep conversation context concise.
+    async def fold_chat_history(self, thread_id: str) -> None:
+        """Folds the oldest messages of the chat history into the chat summary.
+
+        Runs after a response has been streamed, so summarizing is off the
+        critical path of a turn. Only once the history outgrows its window
+        by a batch of messages (see `PreprocessingPolicy`), all messages
+        older than the window are summarized and removed from the session,
+        which keeps the session and the response prompt bounded. The folded
+        messages stay in the message log of the conversation. A lock in the
+        session store makes sure that only one worker folds a conversation.
 
         Args:
-            state (State): The current state of the workflow.
-            config (RunnableConfig): Configuration for the runnable.
+            thread_id (str): The ID of the conversation thread.
+        """
+        state = await asyncio.to_thread(self.load_state, thread_id)
+        if not self.policy.decide(
+            PreprocessingStep.summarize_chat_history, cast(State, state)
+        ):
+            return
+        messages = self.policy.messages_to_fold(state["chat_history"])
+
+        lock = f"fold_chat_history:{thread_id}:{self.character.id}"
+        # The lease outlasts the summary call, even if it is retried once
+        token = await asyncio.to_thread(
+            session_store.acquire, lock, 0.0, 2 * LLM_TIMEOUT_S
+        )
+        if token is None:
+            return
+        try:
+            await self._fold_messages(thread_id, state, messages)
+        finally:
+            await asyncio.to_thread(session_store.release, lock, token)
+
+    async def _fold_messages(
+        self, thread_id: str, state: dict[str, Any], messages: list[BaseMessage]
+    ) -> None:
+        """Summarizes messages into the chat summary and removes them.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
+            state (dict[str, Any]): The state of the conversation.
+            messages (list[BaseMessage]): The oldest messages of the history.
+        """
+        with (
+            tracer.span(
+                "fold_chat_history",
+                new_trace=True,
+                character_id=self.character.id,
+                messages=len(messages),
+            ),
+            observe_stage("summarize_chat_history"),
+        ):
+            prompt = self.prompts.get_summarize_chat_history_prompt(
+                state.get("chat_summary", EMPTY_CHAT_SUMMARY), messages
+            )
+            llm = self.get_llm(
+                MISTRAL_LANGUAGE_MODEL_LARGE, priority=LlmPriority.background
+            )
+            # Not hedged, folding is off the critical path of a turn
+            summary = await self._call_with_deadline(
+                PreprocessingStep.summarize_chat_history,
+                lambda: llm.ainvoke(prompt),
+                hedge=False,
+            )
+            if summary is None:
+                # Keeps the previous summary, folded again after the next turn
+                return
+            folded_ids = {message.id for message in messages}
+
+            def fold(session: Session) -> Session:
+                # Turns only append messages, so the folded ones are still there
+                session["chat_history"] = [
+                    message
+                    for message in session.get("chat_history", [])
+                    if message["data"]["id"] not in folded_ids
+                ]
+                session["chat_summary"] = summary.content
+                return session
+
+            await asyncio.to_thread(
+                session_store.update, thread_id, self.character.id, fold
+            )
+
+    def schedule_fold_chat_history(self, thread_id: str) -> None:
+        """Folds the chat history in the background, unless already folding.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
+        """
+        task = self._fold_tasks.get(thread_id)
+        if task is None or task.done():
+            task = asyncio.create_task(self.fold_chat_history(thread_id))
+            task.add_done_callback(self._log_fold_error)
+            task.add_done_callback(self._fold_tasks_done(thread_id))
+            self._fold_tasks[thread_id] = task
+
+    def _fold_tasks_done(self, thread_id: str) -> Callable[[asyncio.Task], None]:
+        """Creates the callback that forgets the folding task of a thread.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
 
         Returns:
-            State: The updated state with summarized chat history.
+            Callable[[asyncio.Task], None]: Forgets the task, unless a newer
+                one was already scheduled.
         """
-        prompt = self.prompts.get_summarize_chat_history_prompt(state)
-        llm = self.get_llm(MISTRAL_LANGUAGE_MODEL_LARGE)
-        content = llm.invoke(prompt, config).content
-        state["chat_summary"] = content
 
-        return state
+        def forget(task: asyncio.Task) -> None:
+            if self._fold_tasks.get(thread_id) is task:
+                del self._fold_tasks[thread_id]
+
+        return forget
+
+    @staticmethod
+    def _log_fold_error(task: asyncio.Task) -> None:
+        """Logs the error of a failed chat history folding."""
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Folding the chat history failed: {task.exception()!r}")
 
     async def characterize_user(self, state: State, config: RunnableConfig) -> State:
         """Generates a characterization of the user based on conversation data.
 
+        Skipped if the preprocessing policy decides against it. In combined
+        mode, the query is also contextualized in the same LLM call if that
+        is due as well, falling back to separate calls if it fails. The
+        previous characterization is kept if the LLM misses its deadline.
+
         Args:
             state (State): The current workflow state.
             config (RunnableConfig): Configuration for the runnable.
 
         Returns:
-            State: The updated state with user characterization.
+            State: The updated state with user characterization and, in
+                combined mode, the search query.
         """
-        user_info_prompt = self.prompts.get_characterize_user_prompt(state)
-        llm = self.get_llm(MISTRAL_LANGUAGE_MODEL_LARGE)
-        content = llm.invoke(user_info_prompt, config).content
-        state["user_information"] = content
+        with tracer.span("node.characterize_user") as span:
+            state["search_query"] = ""
+            if not self.policy.decide(PreprocessingStep.characterize_user, state):
+                span.set_attribute("skipped", True)
+                state.setdefault("user_information", UNKNOWN_USER)
+                return state
+            if self.policy.combined and self.policy.should_run(
+                PreprocessingStep.contextualize_query, state
+            ):
+                span.set_attribute("combined", True)
+                if result := await self.preprocess_combined(state, config):
+                    state["user_information"] = result.user_information
+                    state["search_query"] = result.search_query
+                    return state
+            with observe_stage("characterize_user"):
+                user_info_prompt = self.prompts.get_characterize_user_prompt(state)
+                llm = self.get_llm(MISTRAL_LANGUAGE_MODEL_LARGE)
+                message = await self._call_with_deadline(
+                    PreprocessingStep.characterize_user,
+                    lambda: llm.ainvoke(user_info_prompt, config),
+                )
+        if message is None:
+            state.setdefault("user_information", UNKNOWN_USER)
+        else:
+            state["user_information"] = message.content
 
         return state
 
+    async def preprocess_combined(
+        self, state: State, config: RunnableConfig
+    ) -> Optional[PreprocessingResult]:
+        """Characterizes the user and contextualizes the query in one LLM call.
+
+        The LLM is asked for a JSON object, which is parsed leniently
+        (e.g. surrounded by text or in a markdown code block). If the LLM
+        misses its deadline, the previous characterization and the query
+        itself are used.
+
+        Args:
+            state (State): The current workflow state.
+            config (RunnableConfig): Configuration for the runnable.
+
+        Returns:
+            Optional[PreprocessingResult]: The user characterization and search
+                query, None if the response could not be parsed.
+        """
+        with observe_stage("preprocess_combined"):
+            prompt = self.prompts.get_preprocess_prompt(state)
+            llm = self.get_llm(MISTRAL_LANGUAGE_MODEL_LARGE).bind(
+                response_format={"type": "json_object"}
+            )
+            message = await self._call_with_deadline(
+                PreprocessingStep.combined, lambda: llm.ainvoke(prompt, config)
+            )
+        if message is None:
+            return PreprocessingResult(
+                user_information=state.get("user_information", UNKNOWN_USER),
+                search_query=state["input"],
+            )
+        try:
+            result = PreprocessingResult.model_validate(
+                parse_json_markdown(str(message.content))
+            )
+        except ValueError as exc:
+            logger.warning(f"Combined preprocessing failed, falling back: {exc!r}")
+            self.policy.record(PreprocessingStep.combined, "fallback")
+            return None
+        self.policy.record(PreprocessingStep.combined, "run")
+        return result
+
     async def generate_response(self, state: State, config: RunnableConfig) -> State:
         """Generates a response using the RAG chain and conversation context.
 
@@ -136,24 +382,36 @@ class LlmWorkflow:
         Returns:
            State: The updated state with conversation context.
         """
-        response = await self.rag_chain(state, config).ainvoke(state, config)
+        state.setdefault("chat_summary", EMPTY_CHAT_SUMMARY)
+        with tracer.span("node.model"):
+            response = await self.rag_chain(state, config).ainvoke(state, config)
         return State(
             input=state["input"],
             chat_history=[
                 HumanMessage(response["input"]),
                 AIMessage(response["answer"]),
             ],
-            chat_summary=response["chat_summary"],
+            # The prompt got copies cut to the token budget, the state keeps all
+            chat_summary=state["chat_summary"],
             context=response["context"],
             answer=response["answer"],
-            user_information=response["user_information"],
+            user_information=state["user_information"],
         )
 
     def rag_chain(self, state: State, _config: RunnableConfig) -> RunnableBinding:
         """Builds the RAG-LLM pipeline with retrieval and memory management.
 
         Sets up a retrieval-chat-chain for context-aware conversations
-        using character data and prior conversation history.
+        using character data and prior conversation history. The query is
+        rewritten into a search query only if the preprocessing policy
+        decides so and it was not already rewritten by the combined
+        preprocessing call, otherwise the vectorDB is searched with the query.
+        With speculative retrieval, the vectorDB is searched with the query
+        while it is rewritten. Otherwise the query itself is searched if the
+        rewrite misses its deadline.
+        The retrieved context and the chat history are fit into the prompt
+        token budget before generating the response, unless the response
+        cache holds an answer to a similar search query.
 
         Args:
             state (State): The current workflow state.
@@ -163,18 +421,42 @@ class LlmWorkflow:
             RunnableBinding: The complete RAG-LLM conversation chain.
         """
         # Instruct AI how to respond
+        system_prompt_template = self.prompts.get_system_prompt()
         system_prompt = ChatPromptTemplate.from_messages(
             [
                 (
                     Sender.system,
-                    self.prompts.get_system_prompt(),
+                    system_prompt_template,
                 ),
                 MessagesPlaceholder(variable_name="chat_history"),
                 (Sender.human, "{input}"),
             ]
         )
-        llm_large = self.get_llm(MISTRAL_LANGUAGE_MODEL_LARGE, streaming=True)
+        llm_large = self.get_llm(
+            MISTRAL_LANGUAGE_MODEL_LARGE,
+            streaming=True,
+            tags=[RESPONSE_TAG],
+            priority=LlmPriority.response,
+        )
         chat_chain = create_stuff_documents_chain(llm_large, system_prompt)
+        assembler = ContextAssembler(system_prompt_template)
+
+        retriever = self.retriever.with_config(
+            callbacks=[
+                MetricsCallbackHandler(stage="vector_retrieval"),
+                TracingCallbackHandler("vectordb"),
+            ]
+        )
+        if search_query := state.get("search_query"):
+            # Already contextualized by the combined preprocessing call
+            self.policy.record(PreprocessingStep.contextualize_query, "combined")
+            retrieval = self._retrieval(
+                RunnableLambda(lambda _: search_query), retriever
+            )
+            return self._retrieval_chain(retrieval, assembler, chat_chain)
+        if not self.policy.decide(PreprocessingStep.contextualize_query, state):
+            retrieval = self._retrieval(RunnableLambda(lambda x: x["input"]), retriever)
+            return self._retrieval_chain(retrieval, assembler, chat_chain)
 
         contextualize_prompt = ChatPromptTemplate.from_messages(
             [
@@ -185,24 +467,290 @@ class LlmWorkflow:
                 ),
             ]
         )
-        llm_medium = self.get_llm(MISTRAL_LANGUAGE_MODEL_MEDIUM)
-        history_aware_retriever = create_history_aware_retriever(
-            llm_medium,
-            self.retriever,
-            contextualize_prompt,
+        llm_medium = self.get_llm(
+            MISTRAL_LANGUAGE_MODEL_MEDIUM, stage="query_contextualization"
         )
-        return create_retrieval_chain(history_aware_retriever, chat_chain)
+        if RETRIEVAL_SPECULATIVE:
+            retrieval = create_speculative_retrieval(
+                llm_medium, retriever, contextualize_prompt
+            )
+        else:
+            rewrite_chain = contextualize_prompt | llm_medium | StrOutputParser()
+
+            async def rewrite(inputs: dict[str, Any], config: RunnableConfig) -> str:
+                query = await self._call_with_deadline(
+                    PreprocessingStep.contextualize_query,
+                    lambda: rewrite_chain.ainvoke(inputs, config),
+                )
+                return inputs["input"] if query is None else query
+
+            retrieval = self._retrieval(RunnableLambda(rewrite), retriever)
+        return self._retrieval_chain(retrieval, assembler, chat_chain)
+
+    async def _call_with_deadline(
+        self,
+        step: PreprocessingStep,
+        call: Callable[[], Awaitable[T]],
+        hedge: bool = True,
+    ) -> Optional[T]:
+        """Runs a preprocessing LLM call within the deadline of its step.
+
+        Waiting for the LLM scheduler counts towards the deadline. Slow calls
+        are hedged with a duplicate if hedging is enabled (see `Hedger`).
 
-    def get_state(self, thread_id: str) -> StateSnapshot:
-        """Retrieve the current state of the conversation.
+        Args:
+            step (PreprocessingStep): The preprocessing step of the call.
+            call (Callable[[], Awaitable[T]]): Starts the call, may be called
+                twice if the call is hedged.
+            hedge (bool, optional): If the call may be hedged. Defaults to True.
+
+        Returns:
+            Optional[T]: The result of the call, None if it missed the deadline.
+        """
+        deadline = self.policy.deadline(step)
+        try:
+            return await asyncio.wait_for(
+                hedger.run(step.value, call) if hedge else call(), deadline
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"{step.value} missed its deadline of {deadline}s")
+            self.policy.record(step, "deadline")
+            return None
+
+    @staticmethod
+    def _retrieval(query: Runnable, retriever: Runnable) -> Runnable:
+        """Chains building the search query and retrieving documents for it.
+
+        Args:
+            query (Runnable): Builds the search query from the inputs.
+            retriever (Runnable): Retrieves the documents for a query.
+
+        Returns:
+            Runnable: The chain, returning the inputs with the query as
+                `search_query` and the documents as `context`.
+        """
+        with_query = RunnablePassthrough.assign(search_query=query)
+        return with_query | RunnablePassthrough.assign(
+            context=itemgetter("search_query") | retriever
+        )
+
+    def _retrieval_chain(
+        self, retrieval: Runnable, assembler: ContextAssembler, chat_chain: Runnable
+    ) -> RunnableBinding:
+        """Chains retrieval, fitting the prompt into its budget and generation.
+
+        Like langchain's `create_retrieval_chain`, with the context assembly
+        between retrieving the documents and generating the answer. With the
+        response cache enabled, the answer to a similar search query is
+        reused instead of generating one.
+
+        Args:
+            retrieval (Runnable): Adds the search query and the documents
+                to the inputs, see `_retrieval`.
+            assembler (ContextAssembler): Fits the inputs into the token budget.
+            chat_chain (Runnable): Generates the answer from the documents.
+
+        Returns:
+            RunnableBinding: The chain, returning the inputs with the documents
+                as `context` and the generated `answer`.
+        """
+        if RESPONSE_CACHE_ENABLED:
+            chat_chain = self._cached_chat_chain(chat_chain)
+        return (
+            retrieval.with_config(run_name="retrieve_documents")
+            | RunnableLambda(assembler.fit)
+            | RunnablePassthrough.assign(answer=chat_chain)
+        ).with_config(run_name="retrieval_chain")
+
+    def _cached_chat_chain(self, chat_chain: Runnable) -> Runnable:
+        """Wraps the chat chain with the semantic response cache.
+
+        The cache is keyed by the character, the embedding of the search
+        query and the user-profile bucket. Generated answers are cached,
+        cached answers are returned without calling the LLM. If the query
+        cannot be embedded, the answer is generated and not cached.
+
+        Args:
+            chat_chain (Runnable): Generates the answer from the documents.
+
+        Returns:
+            Runnable: The chat chain returning cached answers if possible.
+        """
+
+        async def answer(inputs: dict[str, Any], config: RunnableConfig) -> str:
+            bucket = user_bucket(inputs["user_information"])
+            embedding, cached = None, None
+            with tracer.span("response_cache.lookup", bucket=bucket) as span:
+                with observe_stage("response_cache_lookup"):
+                    try:
+                        embeddings = RAG.vectordb().embeddings
+                        assert embeddings is not None
+                        embedding = await embeddings.aembed_query(
+                            inputs["search_query"]
+                        )
+                        cached = response_cache.lookup(
+                            self.character.id, bucket, embedding
+                        )
+                    except Exception as exc:
+                        logger.warning(f"Could not embed the search query: {exc!r}")
+                span.set_attribute("hit", cached is not None)
+            if cached is not None:
+                return cached
+            generated = await chat_chain.ainvoke(inputs, config)
+            if embedding is not None:
+                response_cache.store(self.character.id, bucket, embedding, generated)
+            return generated
+
+        return RunnableLambda(answer).with_config(run_name="cached_chat_chain")
+
+    async def stream_response(
+        self,
+        thread_id: str,
+        query: str,
+        channels: Iterable[StreamChannel] = (),
+    ) -> AsyncGenerator[tuple[StreamEvent, Any], None]:
+        """Runs the graph for a query and streams the character's response.
+
+        Tokens are selected by the `RESPONSE_TAG` of the LLM run that emitted
+        them, so the stream does not depend on the shape of the graph.
+        Answers from the response cache are streamed as a single token.
+        Once the response is complete, the chat history is folded into the
+        chat summary in the background if it outgrew its window.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
+            query (str): The input query from the user.
+            channels (Iterable[StreamChannel], optional): Additional event
+                channels to stream (retrieved context, timing, final state).
+
+        Yields:
+            tuple[StreamEvent, Any]: The event type and its JSON-serializable data.
+        """
+        channels = set(channels)
+        # LLM calls of the turn are scheduled fairly across threads
+        current_thread_id.set(thread_id)
+        start = time.perf_counter()
+        timing: dict[str, float] = {}
+
+        def first_token() -> None:
+            if "first_token" not in timing:
+                timing["first_token"] = time.perf_counter() - start
+                STAGE_LATENCY.labels("time_to_first_token").observe(
+                    timing["first_token"]
+                )
+
+        state = await asyncio.to_thread(self.load_state, thread_id)
+        history_ids = {message.id for message in state["chat_history"]}
+        values: dict[str, Any] = state
+        async for mode, chunk in self.graph.astream(
+            {**state, "input": query},
+            stream_mode=["messages", "updates", "values"],
+            config=self.get_config(thread_id),
+        ):
+            # The type of a chunk depends on its stream mode
+            if mode == "values":
+                values = cast(dict[str, Any], chunk)
+                continue
+            if mode == "messages":
+                msg, metadata = cast(tuple[BaseMessage, dict[str, Any]], chunk)
+                if (
+                    isinstance(msg, AIMessageChunk)
+                    and msg.content
+                    and RESPONSE_TAG in metadata.get("tags", ())
+                ):
+                    first_token()
+                    yield StreamEvent.token, {"text": msg.content}
+                continue
+
+            updates = cast(dict[str, dict[str, Any]], chunk)
+            for node, update in updates.items():
+                timing[node] = time.perf_counter() - start
+                if (
+                    node == "model"
+                    and "first_token" not in timing
+                    and update.get("answer")
+                ):
+                    # Cached answers are not generated token by token
+                    first_token()
+                    yield StreamEvent.token, {"text": update["answer"]}
+                if StreamChannel.context in channels and update.get("context"):
+                    yield StreamEvent.context, [
+                        {
+                            "text": document.page_content,
+                            "metadata": document.metadata,
+                        }
+                        for document in update["context"]
+                    ]
+        await asyncio.to_thread(self.save_turn, thread_id, history_ids, values)
+        self.schedule_fold_chat_history(thread_id)
+
+        timing["total"] = time.perf_counter() - start
+        STAGE_LATENCY.labels("stream_total").observe(timing["total"])
+        if StreamChannel.timing in channels:
+            yield StreamEvent.timing, timing
+        if StreamChannel.state in channels:
+            yield StreamEvent.state, {
+                key: values.get(key)
+                for key in ("chat_summary", "user_information", "answer")
+            }
+
+    def load_state(self, thread_id: str) -> dict[str, Any]:
+        """Load the state of a conversation from the session store.
 
         Args:
             thread_id (str): The ID of the conversation thread.
 
         Returns:
-            StateSnapshot: The current snapshot of the conversation state.
+            dict[str, Any]: The chat history within the window, the number of
+                messages of the conversation and, once the conversation
+                started, the chat summary, the user characterization and the
+                last answer.
+        """
+        session = session_store.load(thread_id, self.character.id) or {}
+        state: dict[str, Any] = {
+            key: session[key]
+            for key in ("chat_summary", "user_information", "answer")
+            if key in session
+        }
+        state["chat_history"] = messages_from_dict(session.get("chat_history", []))
+        state["message_count"] = session.get(
+            "message_count", len(state["chat_history"])
+        )
+        return state
+
+    def save_turn(
+        self, thread_id: str, history_ids: set[str], values: dict[str, Any]
+    ) -> None:
+        """Append the messages of a turn to its conversation in the session store.
+
+        Only the new messages are appended, so that a chat history folding
+        that finished during the turn is kept.
+
+        Args:
+            thread_id (str): The ID of the conversation thread.
+            history_ids (set[str]): The IDs of the messages before the turn.
+            values (dict[str, Any]): The state of the graph after the turn.
         """
-        return self.graph.get_state(self.get_config(thread_id))
+        messages = messages_to_dict(
+            [
+                message
+                for message in values["chat_history"]
+                if message.id not in history_ids
+            ]
+        )
+
+        def append(session: Session) -> Session:
+            history = session.get("chat_history", [])
+            # Sessions saved before the count was kept start from their window
+            count = session.get("message_count", len(history))
+            session["message_count"] = count + len(messages)
+            session["chat_history"] = [*history, *messages]
+            session.setdefault("chat_summary", values["chat_summary"])
+            session["user_information"] = values["user_information"]
+            session["answer"] = values["answer"]
+            return session
+
+        session_store.update(thread_id, self.character.id, append, messages)
 
     @staticmethod
     def get_config(thread_id: str) -> RunnableConfig:
@@ -217,29 +765,27 @@ class LlmWorkflow:
         return RunnableConfig(configurable={"thread_id": thread_id})
 
     @classmethod
-    def from_thread_id(cls, thread_id: str, character_id: int) -> "LlmWorkflow":
-        """Retrieve or create a conversational agent based on the thread ID.
+    def for_character(cls, character_id: int) -> "LlmWorkflow":
+        """Retrieve or create the workflow of a character.
 
-        If no agent exists for the thread, a new one is created. If an agent
-        exists but not for the specified character, a new one for the character
-        is created and added.
+        The workflows are cached per worker, the conversations of all
+        threads with the character share it.
 
         Args:
-            thread_id (str): The ID of the conversation thread.
             character_id (int): The ID of the character.
 
         Returns:
-            LlmWorkflow: The workflow instance for the given character and thread.
+            LlmWorkflow: The workflow instance for the given character.
         """
-        if thread_id not in cls.agents_store:
-            logger.debug(f"Creating new agent for thread {thread_id}.")
-            cls.agents_store[thread_id] = {}
-        if character_id not in cls.agents_store[thread_id]:
-            cls.agents_store[thread_id][character_id] = cls(character_id)
-        return cls.agents_store[thread_id][character_id]
+        with tracer.span("llm_workflow.for_character", character_id=character_id):
+            if character_id not in cls.workflows:
+                logger.debug(f"Creating new workflow for {character_id=}.")
+                with observe_stage("workflow_construction"):
+                    cls.workflows[character_id] = cls(character_id)
+            return cls.workflows[character_id]
 
-    @classmethod
-    def get_chat_character_ids(cls, thread_id: str) -> list[int]:
+    @staticmethod
+    def get_chat_character_ids(thread_id: str) -> list[int]:
         """Get a list of character IDs associated with a specific thread ID.
 
         Args:
@@ -248,30 +794,54 @@ class LlmWorkflow:
         Returns:
             list[int]: A list of character IDs associated with the thread.
         """
-        return list(cls.agents_store.get(thread_id, {}).keys())
+        return session_store.character_ids(thread_id)
 
-    @classmethod
-    def delete_character_chat_history(cls, thread_id: str, character_id: int) -> None:
+    @staticmethod
+    def delete_character_chat_history(thread_id: str, character_id: int) -> None:
         """Delete the chat history with a specific character for a thread.
 
         Args:
             thread_id (str): The ID of the conversation thread.
             character_id (int): The ID of the character.
-
-        Returns:
-            list[int]: A list of character IDs associated with the thread.
         """
-        cls.agents_store.get(thread_id, {}).pop(character_id, None)
+        session_store.delete(thread_id, character_id)
 
     @staticmethod
-    def get_llm(model_name: str, streaming: bool = False) -> ChatMistralAI:
+    def get_llm(
+        model_name: str,
+        streaming: bool = False,
+        tags: Optional[list[str]] = None,
+        stage: Optional[str] = None,
+        priority: LlmPriority = LlmPriority.preprocessing,
+    ) -> ChatMistralAI:
         """Get an instance of the specified language model.
 
+        The async calls of the model are scheduled by the LLM scheduler.
+
         Args:
             model_name (str): The name of the language model.
             streaming (bool, optional): Indicates if streaming mode is enabled.
+            tags (Optional[list[str]], optional): Tags attached to the LLM runs.
+            stage (Optional[str], optional): The chat turn stage whose latency
+                is measured by the LLM calls. Token usage is always measured.
+            priority (LlmPriority, optional): The scheduling priority of the
+                calls. Defaults to LlmPriority.preprocessing.
 
         Returns:
             ChatMistralAI: An instance of the specified language model.
         """
-        return ChatMistralAI(model=model_name, streaming=streaming)
+        return ScheduledChatMistralAI(
+            model_name=model_name,
+            base_url=MISTRAL_BASE_URL,
+            streaming=streaming,
+            tags=tags,
+            priority=priority,
+            timeout=LLM_TIMEOUT_S,
+            callbacks=[
+                MetricsCallbackHandler(model_name, stage),
+                TracingCallbackHandler(model_name),
+            ],
+        )
+
+
+AGENTS.set_function(lambda: len(LlmWorkflow.workflows))
@@ -0,0 +1,155 @@
+import math
+from typing import Optional, Sequence
+
+from langchain_core.messages import BaseMessage
+from pydantic import BaseModel, Field
+
+from datamodels.enums import PreprocessingStep
+from datamodels.state import State
+from utils.consts import (
+    CHAT_HISTORY_FOLD_BATCH_MESSAGES,
+    CHAT_HISTORY_FOLD_DEADLINE_S,
+    CHAT_HISTORY_WINDOW_MESSAGES,
+    PREPROCESSING_CHARACTERIZE_DEADLINE_S,
+    PREPROCESSING_CHARACTERIZE_EVERY_N_TURNS,
+    PREPROCESSING_COMBINED,
+    PREPROCESSING_CONTEXTUALIZE_DEADLINE_S,
+    PREPROCESSING_MIN_HISTORY_MESSAGES,
+    PREPROCESSING_REWRITE_MIN_HISTORY_MESSAGES,
+)
+from utils.metrics import PREPROCESSING_STEPS
+
+
+class PreprocessingPolicy(BaseModel):
+    """Policy deciding per turn which preprocessing LLM calls are worth running.
+
+    Early in a conversation there is little to learn about the user, and
+    the response prompt contains the recent chat history verbatim anyway,
+    so skipping these calls saves LLM calls at little cost in quality.
+    The chat history is only summarized when it outgrows its window, by
+    folding its oldest messages into the summary in batches.
+
+    Attributes:
+        min_history_messages (int): Characterize the user only once the
+            conversation has at least this many messages, folded ones included.
+        characterize_every_n_turns (int): Refresh the user characterization
+            every n turns, starting with the first turn it is allowed in.
+        rewrite_min_history_messages (int): Rewrite the query into a search
+            query only once the history has at least this many messages.
+            Without any history the query is never rewritten.
+        history_window_messages (int): The number of most recent messages
+            kept verbatim in the chat history.
+        fold_batch_messages (int): The number of messages beyond the window
+            that are folded into the chat summary at once.
+        combined (bool): Characterize the user and contextualize the query
+            with one structured LLM call when both are due.
+        characterize_deadline_s (float): The deadline of characterizing the
+            user, after which the previous characterization is reused.
+        contextualize_deadline_s (float): The deadline of rewriting the query,
+            after which the vectorDB is searched with the query itself.
+        summarize_deadline_s (float): The deadline of folding the chat history,
+            after which the previous summary is kept until the next turn.
+            A deadline of 0 disables it.
+    """
+
+    min_history_messages: int = Field(default=PREPROCESSING_MIN_HISTORY_MESSAGES, ge=0)
+    characterize_every_n_turns: int = Field(
+        default=PREPROCESSING_CHARACTERIZE_EVERY_N_TURNS, ge=1
+    )
+    rewrite_min_history_messages: int = Field(
+        default=PREPROCESSING_REWRITE_MIN_HISTORY_MESSAGES, ge=0
+    )
+    history_window_messages: int = Field(default=CHAT_HISTORY_WINDOW_MESSAGES, ge=0)
+    fold_batch_messages: int = Field(default=CHAT_HISTORY_FOLD_BATCH_MESSAGES, ge=1)
+    combined: bool = PREPROCESSING_COMBINED
+    characterize_deadline_s: float = Field(
+        default=PREPROCESSING_CHARACTERIZE_DEADLINE_S, ge=0
+    )
+    contextualize_deadline_s: float = Field(
+        default=PREPROCESSING_CONTEXTUALIZE_DEADLINE_S, ge=0
+    )
+    summarize_deadline_s: float = Field(default=CHAT_HISTORY_FOLD_DEADLINE_S, ge=0)
+
+    def should_run(self, step: PreprocessingStep, state: State) -> bool:
+        """Checks whether a preprocessing step should run in the current turn.
+
+        Args:
+            step (PreprocessingStep): The preprocessing step.
+            state (State): The state of the langgraph.
+
+        Returns:
+            bool: True if the step should run.
+        """
+        n_messages = len(state.get("chat_history", []))
+        if step == PreprocessingStep.contextualize_query:
+            return n_messages >= max(self.rewrite_min_history_messages, 1)
+        if step == PreprocessingStep.summarize_chat_history:
+            overflow = n_messages - self.history_window_messages
+            return overflow >= self.fold_batch_messages
+        # The window shrinks when it is folded, so turns count all messages
+        n_messages = max(state.get("message_count", 0), n_messages)
+        if n_messages < self.min_history_messages:
+            return False
+        # Turns are counted from the first turn the step is allowed in
+        turn = n_messages // 2 - math.ceil(self.min_history_messages / 2)
+        return turn % self.characterize_every_n_turns == 0
+
+    def messages_to_fold(
+        self, chat_history: Sequence[BaseMessage]
+    ) -> list[BaseMessage]:
+        """Selects the messages to fold into the chat summary.
+
+        Args:
+            chat_history (Sequence[BaseMessage]): The chat history.
+
+        Returns:
+            list[BaseMessage]: All messages older than the window.
+        """
+        n_messages = len(chat_history) - self.history_window_messages
+        return list(chat_history[: max(n_messages, 0)])
+
+    def deadline(self, step: PreprocessingStep) -> Optional[float]:
+        """Returns the deadline of a preprocessing step.
+
+        The combined call gets the longer deadline of the steps it replaces.
+
+        Args:
+            step (PreprocessingStep): The preprocessing step.
+
+        Returns:
+            Optional[float]: The deadline in seconds, None if it is disabled.
+        """
+        deadlines = {
+            PreprocessingStep.characterize_user: self.characterize_deadline_s,
+            PreprocessingStep.contextualize_query: self.contextualize_deadline_s,
+            PreprocessingStep.summarize_chat_history: self.summarize_deadline_s,
+            PreprocessingStep.combined: max(
+                self.characterize_deadline_s, self.contextualize_deadline_s
+            ),
+        }
+        return deadlines[step] or None
+
+    def decide(self, step: PreprocessingStep, state: State) -> bool:
+        """Like `should_run`, but also counts the decision in the metrics.
+
+        Args:
+            step (PreprocessingStep): The preprocessing step.
+            state (State): The state of the langgraph.
+
+        Returns:
+            bool: True if the step should run.
+        """
+        run = self.should_run(step, state)
+        self.record(step, "run" if run else "skipped")
+        return run
+
+    @staticmethod
+    def record(step: PreprocessingStep, decision: str) -> None:
+        """Counts how a preprocessing step was handled in the metrics.
+
+        Args:
+            step (PreprocessingStep): The preprocessing step.
+            decision (str): E.g. 'run', 'skipped', 'combined', 'fallback' or
+                'deadline'.
+        """
+        PREPROCESSING_STEPS.labels(step.value, decision).inc()
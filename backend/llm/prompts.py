@@ -1,7 +1,15 @@
-from langchain_core.messages import HumanMessage
+import json
+from typing import Sequence
+
+from langchain_core.messages import BaseMessage, HumanMessage
 
 from datamodels.enums import Sender
-from datamodels.models import Character, State
+from datamodels.models import Character, PreprocessingResult
+from datamodels.state import State
+
+# Stand-ins for a chat summary and user characterization not generated yet
+EMPTY_CHAT_SUMMARY = "<empty>"
+UNKNOWN_USER = "a complete stranger"
 
 
 class Prompts:
@@ -28,7 +36,9 @@ class Prompts:
             "## Character Personality\n"
             f"{self.character.summarized_personality}\n"
             "## Human Personality\n"
-            "{user_information}"
+            "{user_information}\n"
+            "## Summary of the Earlier Conversation\n"
+            "{chat_summary}\n"
             "## Context\n"
             "{context}\n\n"
             "## Task\n"
@@ -55,7 +65,7 @@ class Prompts:
             str: A system prompt for generating search queries
                 relevant to the conversation.
         """
-        chat_summary = state.get("chat_summary", "<empty>")
+        chat_summary = state.get("chat_summary", EMPTY_CHAT_SUMMARY)
         formatted_history = self._format_chat_history(state, last_n=2)
         return (
             f"## Chat history between a human and {self.character.name}\n"
@@ -83,20 +93,21 @@ class Prompts:
             "short as possible."
         )
 
-    def get_summarize_chat_history_prompt(self, state: State) -> str:
-        """Generates a prompt to summarize the chat history.
+    def get_summarize_chat_history_prompt(
+        self, chat_summary: str, messages: Sequence[BaseMessage]
+    ) -> str:
+        """Generates a prompt to fold messages into the chat summary.
 
         Args:
-            state (State): The state of the langgraph.
+            chat_summary (str): The summary of the chat so far.
+            messages (Sequence[BaseMessage]): The messages to add to the summary.
 
         Returns:
             str: A system prompt for summarizing the chat history.
         """
-        chat_summary = state.get("chat_summary", "<empty>")
-        formatted_history = self._format_chat_history(state, last_n=2)
         return (
             f"## Chat history between a human and {self.character.name}\n"
-            f"{chat_summary}\n{formatted_history}\n"
+            f"{chat_summary}\n{self._format_messages(messages)}\n"
             "## Task\n"
             "Summarize the chat history. Keep it short and concise."
         )
@@ -110,8 +121,8 @@ class Prompts:
         Returns:
             str: A system prompt for characterizing the user.
         """
-        user_information = state.get("user_information", "a complete stranger")
-        chat_summary = state.get("chat_summary", "<empty>")
+        user_information = state.get("user_information", UNKNOWN_USER)
+        chat_summary = state.get("chat_summary", EMPTY_CHAT_SUMMARY)
         formatted_history = self._format_chat_history(state, last_n=2)
         return (
             f"## Chat history between a human and {self.character.name}\n"
@@ -122,6 +133,37 @@ class Prompts:
             "concise way and based ONLY on the available information."
         )
 
+    def get_preprocess_prompt(self, state: State) -> str:
+        """Generates a prompt to characterize the user and contextualize the query.
+
+        Combines the characterization and contextualization prompts and asks
+        for a JSON object matching `PreprocessingResult`.
+
+        Args:
+            state (State): The state of the langgraph.
+
+        Returns:
+            str: A system prompt for the combined preprocessing call.
+        """
+        user_information = state.get("user_information", UNKNOWN_USER)
+        chat_summary = state.get("chat_summary", EMPTY_CHAT_SUMMARY)
+        formatted_history = self._format_chat_history(state, last_n=2)
+        schema = PreprocessingResult.model_json_schema()
+        schema.pop("description", None)
+        return (
+            f"## Chat history between a human and {self.character.name}\n"
+            f"{chat_summary}\n{formatted_history}\n"
+            f"## Characterization of the human\n"
+            f"{user_information}\n"
+            "## Task\n"
+            "Respond with a JSON object with two fields. 'user_information': "
+            "update the human's personality description in a short and concise "
+            "way and based ONLY on the available information. 'search_query': "
+            "a short search query to look up information relevant to the "
+            "conversation.\n"
+            f"The JSON object must match this schema: {json.dumps(schema)}"
+        )
+
     def _format_chat_history(self, state: State, last_n=0) -> str:
         """Utility function for generating a string of chat history.
 
@@ -132,16 +174,24 @@ class Prompts:
         Returns:
             str: A string of chat history.
         """
-        history = (
-            [
-                (
-                    f"{Sender.human}: {msg.content}"
-                    if isinstance(msg, HumanMessage)
-                    else f"{self.character.name}: {msg.content}"
-                )
-                for msg in state["chat_history"][last_n:]
-            ]
-            if len(state["chat_history"]) > 1
-            else []
+        history = state["chat_history"]
+        history = history[last_n:] if len(history) > 1 else []
+        return self._format_messages([*history, HumanMessage(state["input"])])
+
+    def _format_messages(self, messages: Sequence[BaseMessage]) -> str:
+        """Utility function for generating a string of chat messages.
+
+        Args:
+            messages (Sequence[BaseMessage]): The messages, oldest first.
+
+        Returns:
+            str: One line per message, prefixed with its sender.
+        """
+        return "\n".join(
+            (
+                f"{Sender.human}: {msg.content}"
+                if isinstance(msg, HumanMessage)
+                else f"{self.character.name}: {msg.content}"
+            )
+            for msg in messages
         )
-        return "\n".join(history + [f"{Sender.human}: {state['input']}"])
@@ -1,15 +1,25 @@
+from typing import Optional
+
 from langchain_chroma import Chroma
 from langchain_core.documents import Document
-from langchain_core.vectorstores import VectorStoreRetriever
 from langchain_mistralai import MistralAIEmbeddings
 from langchain_text_splitters import CharacterTextSplitter
 from pydantic import TypeAdapter
 
 from database.database import Database
+from database.session_store import session_store
 from datamodels.models import Character, CharacterData, DocumentMetadata, EmbeddingLog
-from utils.consts import MISTRAL_EMBED_MODEL, VECTOR_DB_DIR
+from llm.embeddings import QueryEmbeddings
+from llm.retrieval import ChromaRetriever
+from utils.consts import (
+    EMBEDDING_LOCK_TIMEOUT_S,
+    MISTRAL_BASE_URL,
+    MISTRAL_EMBED_MODEL,
+    VECTOR_DB_DIR,
+)
 from utils.exceptions import EmbeddingsNotCreatedError, NotFoundError
 from utils.logger import get_logger
+from utils.metrics import EMBEDDING_CACHE
 
 logger = get_logger()
 
@@ -25,9 +35,38 @@ class RAG:
         db (Database): An instance of the NarutoWiki database.
     """
 
-    def __init__(self):
-        """Initialize the RAG class with the NarutoWiki database."""
-        self.db = Database()
+    # Opening Chroma (and loading the embedding tokenizer) is expensive,
+    # so all RAG instances share a single vectorDB client.
+    _vectordb: Optional[Chroma] = None
+
+    def __init__(self, db: Optional[Database] = None):
+        """Initialize the RAG class with the NarutoWiki database.
+
+        Args:
+            db (Optional[Database]): The database to load characters from.
+                Defaults to the NarutoWiki database.
+        """
+        self.db = db or Database()
+
+    @classmethod
+    def vectordb(cls) -> Chroma:
+        """Return the shared Chroma vectorDB, opening it on first use.
+
+        Returns:
+            Chroma: The persistent vectorDB holding all character embeddings.
+        """
+        if cls._vectordb is None:
+            # Workers creating the tables of a new vectorDB at once would fail
+            with session_store.lock("vectordb", timeout_s=EMBEDDING_LOCK_TIMEOUT_S):
+                cls._vectordb = Chroma(
+                    persist_directory=VECTOR_DB_DIR,
+                    embedding_function=QueryEmbeddings(
+                        MistralAIEmbeddings(
+                            model=MISTRAL_EMBED_MODEL, endpoint=MISTRAL_BASE_URL
+                        )
+                    ),
+                )
+        return cls._vectordb
 
     def load_character_data(self, character_id: int) -> list[Document]:
         """Load character data and convert it into Langchain Document format.
@@ -73,6 +112,25 @@ class RAG:
 
         return documents
 
+    @staticmethod
+    def split_documents(documents: list[Document]) -> list[Document]:
+        """Split documents into chunks small enough for embedding.
+
+        Args:
+            documents (list[Document]): The documents to split.
+
+        Returns:
+            list[Document]: The chunks, each keeping its document's metadata.
+        """
+        text_splitter = CharacterTextSplitter(
+            separator=".", chunk_size=256, chunk_overlap=64
+        )
+
+        split_documents = []
+        for document in documents:
+            split_documents.extend(text_splitter.split_documents([document]))
+        return split_documents
+
     def store_embeddings(self, character_id: int):
         """Create and store embeddings for a character in the vectorDB.
 
@@ -89,23 +147,11 @@ class RAG:
                 backend is unreachable.
         """
         documents = self.load_character_data(character_id)
-
-        # Split the text into chunks for embedding
-        text_splitter = CharacterTextSplitter(
-            separator=".", chunk_size=256, chunk_overlap=64
-        )
-
-        split_documents = []
-        for document in documents:
-            split_documents.extend(text_splitter.split_documents([document]))
+        split_documents = self.split_documents(documents)
 
         # Create embeddings and save them in Chroma vector database
         try:
-            Chroma.from_documents(
-                split_documents,
-                persist_directory=VECTOR_DB_DIR,
-                embedding=MistralAIEmbeddings(model=MISTRAL_EMBED_MODEL),
-            )
+            self.vectordb().add_documents(split_documents)
         except KeyError:
             raise EmbeddingsNotCreatedError(
                 f"Could not create embeddings for {split_documents=}, "
@@ -113,14 +159,65 @@ class RAG:
                 f"Try again in a few seconds!"
             )
 
-    def retriever(self, character_id: int, k: int = 2) -> VectorStoreRetriever:
+    def embeddings_exist(self, character_id: int) -> bool:
+        """Check the log table for the embeddings of a character.
+
+        Args:
+            character_id (int): The ID of the character.
+
+        Returns:
+            bool: True if the embeddings were already created.
+        """
+        try:
+            self.db.get_by_id(character_id, EmbeddingLog, id_key="character_id")
+        except NotFoundError:
+            return False
+        return True
+
+    def ensure_embeddings(self, character_id: int) -> None:
+        """Create the embeddings of a character unless they already exist.
+
+        If embeddings already exist in the vectorDB they are not created
+        again, unless the corresponding row in the log table is deleted.
+        A lock in the session store makes sure that only one worker creates
+        a character's embeddings, the others wait for them.
+
+        Args:
+            character_id (int): The ID of the character.
+
+        Raises:
+            EmbeddingsNotCreatedError: If another worker did not finish
+                creating the embeddings in time.
+        """
+        if self.embeddings_exist(character_id):
+            EMBEDDING_CACHE.labels("hit").inc()
+            return
+        with session_store.lock(
+            f"embeddings:{character_id}",
+            timeout_s=EMBEDDING_LOCK_TIMEOUT_S,
+            ttl_s=EMBEDDING_LOCK_TIMEOUT_S,
+        ) as acquired:
+            if not acquired:
+                raise EmbeddingsNotCreatedError(
+                    f"Embeddings for {character_id=} are still being created. "
+                    f"Try again in a few seconds!"
+                )
+            # Another worker may have created them while this one waited
+            if self.embeddings_exist(character_id):
+                EMBEDDING_CACHE.labels("hit").inc()
+            else:
+                EMBEDDING_CACHE.labels("miss").inc()
+                logger.debug(f"Create vectorDB embeddings for {character_id=}.")
+                self.store_embeddings(character_id)
+                self.db.create(EmbeddingLog(character_id=character_id))
+
+    def retriever(self, character_id: int, k: int = 2) -> ChromaRetriever:
         """Return a retriever for a character based on stored embeddings.
 
-        This function checks if embeddings exist for the character in the
-        database. If embeddings already exist in the vectorDB they are not
-        created again, unless the corresponding row in the log table is
-        deleted. This is to improve performance when selecting a
-        new character to chat. It then creates and returns a retriever
+        The embeddings are usually created by a background job before the
+        first chat with the character, otherwise they are created now, see
+        `ensure_embeddings`. This is to improve performance when selecting
+        a new character to chat. It then creates and returns a retriever
         for the character's data.
 
         Args:
@@ -129,22 +226,17 @@ class RAG:
                 Defaults to 2.
 
         Returns:
-            VectorStoreRetriever: A retriever that can search through
+            ChromaRetriever: A retriever that can search through
                 the character's data using embeddings.
-        """
-        try:
-            self.db.get_by_id(character_id, EmbeddingLog, id_key="character_id")
-        except NotFoundError:
-            logger.debug(f"Create vectorDB embeddings for {character_id=}.")
-            self.store_embeddings(character_id)
-            self.db.create(EmbeddingLog(character_id=character_id))
 
-        vectordb = Chroma(
-            persist_directory=VECTOR_DB_DIR,
-            embedding_function=MistralAIEmbeddings(model=MISTRAL_EMBED_MODEL),
-        )
+        Raises:
+            EmbeddingsNotCreatedError: If another worker did not finish
+                creating the embeddings in time.
+        """
+        self.ensure_embeddings(character_id)
 
-        return vectordb.as_retriever(
+        return ChromaRetriever(
+            vectorstore=self.vectordb(),
             search_type="similarity_score_threshold",
             search_kwargs={
                 "k": k,
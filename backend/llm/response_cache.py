@@ -0,0 +1,194 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+from llm.prompts import UNKNOWN_USER
+from utils.consts import (
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_SIMILARITY,
+    RESPONSE_CACHE_TTL_S,
+)
+from utils.metrics import RESPONSE_CACHE, RESPONSE_CACHE_ENTRIES
+
+
+def user_bucket(user_information: str) -> str:
+    """Maps the user characterization to a coarse user-profile bucket.
+
+    Answers to strangers are not reused for users the character already
+    knows something about, and vice versa.
+
+    Args:
+        user_information (str): The user characterization of the turn.
+
+    Returns:
+        str: 'stranger' or 'known'.
+    """
+    if not user_information or user_information == UNKNOWN_USER:
+        return "stranger"
+    return "known"
+
+
+class _Entry:
+    """A cached answer and the normalized embedding of its query."""
+
+    def __init__(self, key: tuple[int, str], embedding: np.ndarray, answer: str):
+        """Creates an entry.
+
+        Args:
+            key (tuple[int, str]): The character ID and the user-profile bucket.
+            embedding (np.ndarray): The normalized embedding of the query.
+            answer (str): The character's answer.
+        """
+        self.key = key
+        self.embedding = embedding
+        self.answer = answer
+        self.created = time.monotonic()
+
+
+class ResponseCache:
+    """Semantic cache of character responses.
+
+    Answers are keyed by the character, the embedding of the contextualized
+    query and a coarse user-profile bucket. A lookup returns the answer of
+    the most similar cached query (cosine similarity) of the same character
+    and bucket, if it is similar enough. Entries expire after `ttl_s`
+    seconds, and the least recently used entries are evicted once the cache
+    holds `max_entries` answers.
+
+    Attributes:
+        min_similarity (float): The minimum cosine similarity for a hit.
+        ttl_s (float): The time to live of an entry in seconds.
+        max_entries (int): The maximum number of cached answers.
+    """
+
+    def __init__(
+        self,
+        min_similarity: float = RESPONSE_CACHE_SIMILARITY,
+        ttl_s: float = RESPONSE_CACHE_TTL_S,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+    ):
+        """Initialize an empty ResponseCache.
+
+        Args:
+            min_similarity (float, optional): The minimum cosine similarity for
+                a hit. Defaults to RESPONSE_CACHE_SIMILARITY.
+            ttl_s (float, optional): The time to live of an entry in seconds.
+                Defaults to RESPONSE_CACHE_TTL_S.
+            max_entries (int, optional): The maximum number of cached answers.
+                Defaults to RESPONSE_CACHE_MAX_ENTRIES.
+        """
+        self.min_similarity = min_similarity
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        # All entries in least recently used order
+        self._entries: OrderedDict[int, _Entry] = OrderedDict()
+        # Entry IDs per character and bucket, the candidates of a lookup
+        self._keys: dict[tuple[int, str], set[int]] = {}
+        self._next_id = 0
+
+    def __len__(self) -> int:
+        """Return the number of cached answers, expired ones included."""
+        return len(self._entries)
+
+    def lookup(
+        self, character_id: int, bucket: str, embedding: list[float]
+    ) -> Optional[str]:
+        """Find the cached answer to the most similar query.
+
+        Args:
+            character_id (int): The ID of the character.
+            bucket (str): The user-profile bucket, see `user_bucket`.
+            embedding (list[float]): The embedding of the query.
+
+        Returns:
+            Optional[str]: The cached answer, None if there is no similar query.
+        """
+        key = (character_id, bucket)
+        self._expire(key)
+        ids = list(self._keys.get(key, ()))
+        if not ids:
+            RESPONSE_CACHE.labels("miss").inc()
+            return None
+
+        matrix = np.stack([self._entries[entry_id].embedding for entry_id in ids])
+        similarities = matrix @ self._normalize(embedding)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.min_similarity:
+            RESPONSE_CACHE.labels("miss").inc()
+            return None
+
+        RESPONSE_CACHE.labels("hit").inc()
+        self._entries.move_to_end(ids[best])
+        return self._entries[ids[best]].answer
+
+    def store(
+        self, character_id: int, bucket: str, embedding: list[float], answer: str
+    ) -> None:
+        """Cache the answer to a query.
+
+        Args:
+            character_id (int): The ID of the character.
+            bucket (str): The user-profile bucket, see `user_bucket`.
+            embedding (list[float]): The embedding of the query.
+            answer (str): The character's answer.
+        """
+        if self.max_entries <= 0 or not answer:
+            return
+        key = (character_id, bucket)
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = _Entry(key, self._normalize(embedding), answer)
+        self._keys.setdefault(key, set()).add(entry_id)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            RESPONSE_CACHE.labels("evicted").inc()
+
+    def clear(self) -> None:
+        """Remove all cached answers."""
+        self._entries.clear()
+        self._keys.clear()
+
+    def _expire(self, key: tuple[int, str]) -> None:
+        """Remove the expired entries of a character and bucket.
+
+        Args:
+            key (tuple[int, str]): The character ID and the bucket.
+        """
+        deadline = time.monotonic() - self.ttl_s
+        for entry_id in list(self._keys.get(key, ())):
+            if self._entries[entry_id].created < deadline:
+                self._remove(entry_id)
+                RESPONSE_CACHE.labels("expired").inc()
+
+    def _remove(self, entry_id: int) -> None:
+        """Remove an entry.
+
+        Args:
+            entry_id (int): The ID of the entry.
+        """
+        entry = self._entries.pop(entry_id)
+        ids = self._keys[entry.key]
+        ids.discard(entry_id)
+        if not ids:
+            del self._keys[entry.key]
+
+    @staticmethod
+    def _normalize(embedding: list[float]) -> np.ndarray:
+        """Scale an embedding to unit length, so dot products are cosines.
+
+        Args:
+            embedding (list[float]): The embedding.
+
+        Returns:
+            np.ndarray: The normalized embedding.
+        """
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+response_cache = ResponseCache()
+
+RESPONSE_CACHE_ENTRIES.set_function(lambda: len(response_cache))
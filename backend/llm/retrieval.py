@@ -0,0 +1,184 @@
+import asyncio
+import re
+from typing import Any, Optional
+
+from langchain_chroma import Chroma
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.language_models import BaseLanguageModel
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import BasePromptTemplate
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+from langchain_core.runnables.config import run_in_executor
+from langchain_core.vectorstores import VectorStoreRetriever
+
+from utils.consts import RETRIEVAL_REUSE_SIMILARITY, RETRIEVAL_REWRITE_TIMEOUT_MS
+from utils.logger import get_logger
+from utils.metrics import SPECULATIVE_RETRIEVAL
+from utils.tracing import tracer
+
+logger = get_logger()
+
+
+class ChromaRetriever(VectorStoreRetriever):
+    """Chroma retriever that embeds the query asynchronously.
+
+    Chroma has no async search, so langchain runs the sync search in a
+    thread, including the embedding API call of the query. This retriever
+    awaits the query embedding instead, so that concurrent queries can be
+    batched (see `QueryEmbeddings`), and only searches by vector in a thread.
+    """
+
+    vectorstore: Chroma
+
+    async def _aget_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: AsyncCallbackManagerForRetrieverRun,
+        **kwargs: Any,
+    ) -> list[Document]:
+        if self.search_type not in ("similarity", "similarity_score_threshold"):
+            return await super()._aget_relevant_documents(
+                query, run_manager=run_manager, **kwargs
+            )
+        embeddings = self.vectorstore.embeddings
+        assert embeddings is not None, "The vector store has no embeddings."
+        embedding = await embeddings.aembed_query(query)
+        return await run_in_executor(
+            None, self.search_by_vector, embedding, **(self.search_kwargs | kwargs)
+        )
+
+    def search_by_vector(
+        self,
+        embedding: list[float],
+        k: int = 4,
+        score_threshold: Optional[float] = None,
+        **kwargs: Any,
+    ) -> list[Document]:
+        """Search the most similar documents to a query embedding.
+
+        Args:
+            embedding (list[float]): The embedding of the query.
+            k (int, optional): The maximum number of documents. Defaults to 4.
+            score_threshold (Optional[float], optional): The minimum relevance
+                score (0 to 1) of the documents. Defaults to None.
+            **kwargs (Any): Passed to the search, e.g. the metadata `filter`.
+
+        Returns:
+            list[Document]: The documents, most similar first.
+        """
+        # Chroma returns distances, converted like langchain's relevance search
+        relevance = self.vectorstore._select_relevance_score_fn()
+        results = self.vectorstore.similarity_search_by_vector_with_relevance_scores(
+            embedding, k, **kwargs
+        )
+        return [
+            document
+            for document, distance in results
+            if score_threshold is None or relevance(distance) >= score_threshold
+        ]
+
+
+def query_similarity(query: str, other: str) -> float:
+    """Computes the word overlap (Jaccard index) of two queries.
+
+    Args:
+        query (str): A query.
+        other (str): Another query.
+
+    Returns:
+        float: 1.0 for the same words, 0.0 for no common words.
+    """
+    words = set(re.findall(r"\w+", query.lower()))
+    other_words = set(re.findall(r"\w+", other.lower()))
+    if not words | other_words:
+        return 1.0
+    return len(words & other_words) / len(words | other_words)
+
+
+def merge_documents(*results: list[Document]) -> list[Document]:
+    """Merges retrieval results, dropping duplicate documents.
+
+    Args:
+        *results (list[Document]): The results, in order of priority.
+
+    Returns:
+        list[Document]: The documents in order of priority, each only once.
+    """
+    seen = set()
+    merged = []
+    for document in (document for result in results for document in result):
+        key = (document.page_content, tuple(sorted(document.metadata.items())))
+        if key not in seen:
+            seen.add(key)
+            merged.append(document)
+    return merged
+
+
+def create_speculative_retrieval(
+    llm: BaseLanguageModel,
+    retriever: Runnable,
+    prompt: BasePromptTemplate,
+    timeout_ms: float = RETRIEVAL_REWRITE_TIMEOUT_MS,
+    min_similarity: float = RETRIEVAL_REUSE_SIMILARITY,
+) -> Runnable:
+    """Creates a history-aware retrieval step that does not wait for the rewrite.
+
+    Like langchain's `create_history_aware_retriever`, but the vectorDB is
+    searched with the raw input while the LLM contextualizes the query.
+    The speculative results are used as they are if the rewritten query is
+    similar enough to the input, or if the rewrite takes longer than
+    `timeout_ms` or fails. Otherwise the vectorDB is searched again with the
+    rewritten query and both results are merged, rewritten results first.
+
+    Args:
+        llm (BaseLanguageModel): The LLM that contextualizes the query.
+        retriever (Runnable): Retrieves the documents for a query.
+        prompt (BasePromptTemplate): The prompt for contextualizing the query.
+        timeout_ms (float, optional): The maximum time to wait for the rewrite.
+            Defaults to RETRIEVAL_REWRITE_TIMEOUT_MS.
+        min_similarity (float, optional): The minimum word overlap of the input
+            and the rewrite to reuse the speculative results.
+            Defaults to RETRIEVAL_REUSE_SIMILARITY.
+
+    Returns:
+        Runnable: A runnable taking the chain inputs and returning them with
+            the rewritten query (the input if the rewrite is not ready) as
+            `search_query` and the documents as `context`.
+    """
+    rewrite_chain = prompt | llm | StrOutputParser()
+
+    async def retrieve(
+        inputs: dict[str, Any], config: RunnableConfig
+    ) -> dict[str, Any]:
+        query = rewritten = inputs["input"]
+        speculative = asyncio.create_task(retriever.ainvoke(query, config))
+        rewrite = asyncio.create_task(rewrite_chain.ainvoke(inputs, config))
+        try:
+            with tracer.span("retrieval.speculative") as span:
+                try:
+                    rewritten = await asyncio.wait_for(rewrite, timeout_ms / 1000)
+                    similarity = query_similarity(query, rewritten)
+                    span.set_attribute("similarity", similarity)
+                    outcome = "reused" if similarity >= min_similarity else "requeried"
+                except asyncio.TimeoutError:
+                    outcome = "timeout"
+                except Exception as exc:
+                    logger.warning(f"Contextualizing the query failed: {exc!r}")
+                    outcome = "error"
+                span.set_attribute("outcome", outcome)
+                SPECULATIVE_RETRIEVAL.labels(outcome).inc()
+
+                if outcome == "requeried":
+                    requeried = await retriever.ainvoke(rewritten, config)
+                    documents = merge_documents(requeried, await speculative)
+                else:
+                    documents = await speculative
+                return {**inputs, "search_query": rewritten, "context": documents}
+        finally:
+            # E.g. if the turn is cancelled because the client disconnected
+            speculative.cancel()
+            rewrite.cancel()
+
+    return RunnableLambda(retrieve).with_config(run_name="speculative_retrieval")
@@ -0,0 +1,497 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Iterable, Optional
+
+import httpx
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_mistralai import ChatMistralAI
+
+from datamodels.enums import LlmPriority
+from utils.consts import (
+    LLM_MAX_CONCURRENCY,
+    LLM_MAX_QUEUE,
+    LLM_MODEL_CONCURRENCY,
+    LLM_QUEUE_TIMEOUT_S,
+    LLM_RATE_LIMIT_BACKOFF_S,
+    LLM_RATE_LIMIT_RETRIES,
+)
+from utils.exceptions import OverloadedError
+from utils.logger import get_logger
+from utils.metrics import (
+    LLM_ACTIVE_CALLS,
+    LLM_CONCURRENCY_LIMIT,
+    LLM_QUEUE_DEPTH,
+    LLM_QUEUE_TIME,
+    LLM_RATE_LIMITED,
+    LLM_REJECTED,
+)
+
+logger = get_logger()
+
+# The chat thread on whose behalf LLM calls are made, for fair scheduling.
+# Tasks inherit it, so it only has to be set once per chat turn.
+current_thread_id: ContextVar[str] = ContextVar("current_thread_id", default="")
+
+
+class _ModelQueue:
+    """The slots and waiting calls of one model.
+
+    Waiting calls are queued per priority, and within a priority per chat
+    thread. Slots are handed out round-robin across the threads, so that
+    a thread with many calls cannot starve the others.
+    """
+
+    def __init__(self, model: str, max_limit: int) -> None:
+        """Creates the queue of a model.
+
+        Args:
+            model (str): The name of the model.
+            max_limit (int): The maximum number of concurrent calls.
+        """
+        self.model = model
+        self.max_limit = max(max_limit, 1)
+        # Adaptive limit, halved on rate limit responses and raised by one
+        # for every `limit` successful calls (AIMD)
+        self.limit = float(self.max_limit)
+        self.active = 0
+        self.n_waiting = 0
+        self.paused_until = 0.0
+        self.resume: Optional[asyncio.TimerHandle] = None
+        self.waiting: dict[LlmPriority, OrderedDict[str, deque[asyncio.Future]]] = {
+            priority: OrderedDict() for priority in LlmPriority
+        }
+        LLM_CONCURRENCY_LIMIT.labels(model).set(self.max_limit)
+
+    def push(
+        self, priority: LlmPriority, thread_id: str, future: asyncio.Future
+    ) -> None:
+        """Queues a waiting call.
+
+        Args:
+            priority (LlmPriority): The priority of the call.
+            thread_id (str): The chat thread of the call.
+            future (asyncio.Future): Resolved when the call gets a slot.
+        """
+        self.waiting[priority].setdefault(thread_id, deque()).append(future)
+        self.n_waiting += 1
+        LLM_QUEUE_DEPTH.labels(self.model).set(self.n_waiting)
+
+    def pop(self) -> Optional[asyncio.Future]:
+        """Dequeues the next waiting call.
+
+        Returns:
+            Optional[asyncio.Future]: The call with the highest priority, of
+                the thread whose turn it is, None if no call is waiting.
+        """
+        for threads in self.waiting.values():
+            if not threads:
+                continue
+            thread_id, futures = next(iter(threads.items()))
+            future = futures.popleft()
+            if futures:
+                threads.move_to_end(thread_id)
+            else:
+                del threads[thread_id]
+            self.n_waiting -= 1
+            LLM_QUEUE_DEPTH.labels(self.model).set(self.n_waiting)
+            return future
+        return None
+
+    def discard(self, future: asyncio.Future) -> None:
+        """Removes a call that stopped waiting.
+
+        Args:
+            future (asyncio.Future): The future of the call.
+        """
+        for threads in self.waiting.values():
+            for thread_id, futures in threads.items():
+                if future in futures:
+                    futures.remove(future)
+                    if not futures:
+                        del threads[thread_id]
+                    self.n_waiting -= 1
+                    LLM_QUEUE_DEPTH.labels(self.model).set(self.n_waiting)
+                    return
+
+    def capacity(self) -> int:
+        """Returns the number of calls that may run concurrently right now."""
+        if time.monotonic() < self.paused_until:
+            return 0
+        return max(int(self.limit), 1)
+
+
+class LlmScheduler:
+    """Admission control and fair scheduling of LLM calls.
+
+    Every model has a limit of concurrent calls. Calls beyond it wait in
+    the model's queue, ordered by priority and round-robin across chat
+    threads. Rate limit (429) responses halve the limit and pause the
+    model for the Retry-After time, successful calls raise it again
+    up to the configured limit.
+
+    Requests are rejected with an `OverloadedError` before they start if
+    `max_queue` calls are already waiting for one of their models (see
+    `admit`), admitted calls only if they waited longer than `queue_timeout_s`.
+
+    Attributes:
+        max_concurrency (int): The default limit of concurrent calls per model.
+        model_concurrency (dict[str, int]): Limits overriding the default.
+        max_queue (int): The maximum number of waiting calls per model.
+        queue_timeout_s (float): The maximum time a call waits for a slot.
+        rate_limit_retries (int): How often rate limited calls are retried.
+        rate_limit_backoff_s (float): The initial backoff of rate limited
+            calls without Retry-After header, doubled on every retry.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        model_concurrency: Optional[dict[str, int]] = None,
+        max_queue: int = LLM_MAX_QUEUE,
+        queue_timeout_s: float = LLM_QUEUE_TIMEOUT_S,
+        rate_limit_retries: int = LLM_RATE_LIMIT_RETRIES,
+        rate_limit_backoff_s: float = LLM_RATE_LIMIT_BACKOFF_S,
+    ):
+        """Initialize the LlmScheduler.
+
+        Args:
+            max_concurrency (int, optional): The default limit of concurrent
+                calls per model. Defaults to LLM_MAX_CONCURRENCY.
+            model_concurrency (Optional[dict[str, int]], optional): Limits
+                overriding the default. Defaults to LLM_MODEL_CONCURRENCY.
+            max_queue (int, optional): The maximum number of waiting calls per
+                model. Defaults to LLM_MAX_QUEUE.
+            queue_timeout_s (float, optional): The maximum time a call waits
+                for a slot. Defaults to LLM_QUEUE_TIMEOUT_S.
+            rate_limit_retries (int, optional): How often rate limited calls
+                are retried. Defaults to LLM_RATE_LIMIT_RETRIES.
+            rate_limit_backoff_s (float, optional): The initial backoff of rate
+                limited calls. Defaults to LLM_RATE_LIMIT_BACKOFF_S.
+        """
+        self.max_concurrency = max_concurrency
+        self.model_concurrency = (
+            LLM_MODEL_CONCURRENCY if model_concurrency is None else model_concurrency
+        )
+        self.max_queue = max_queue
+        self.queue_timeout_s = queue_timeout_s
+        self.rate_limit_retries = rate_limit_retries
+        self.rate_limit_backoff_s = rate_limit_backoff_s
+        self._queues: dict[str, _ModelQueue] = {}
+
+    def admit(self, models: Iterable[str]) -> None:
+        """Checks that new requests calling the models can be served.
+
+        Meant to reject requests before a response is started, rather than
+        failing them while they are being served.
+
+        Args:
+            models (Iterable[str]): The models the request will call.
+
+        Raises:
+            OverloadedError: If the queue of one of the models is full.
+        """
+        for model in models:
+            queue = self._queue(model)
+            if queue.n_waiting >= self.max_queue:
+                LLM_REJECTED.labels(model, "queue_full").inc()
+                raise OverloadedError(
+                    f"Too many requests are waiting for {model}, try again later.",
+                    self._retry_after(queue),
+                )
+
+    @asynccontextmanager
+    async def slot(
+        self, model: str, priority: LlmPriority = LlmPriority.preprocessing
+    ) -> AsyncIterator[None]:
+        """Holds a slot of a model while an LLM call runs.
+
+        Args:
+            model (str): The name of the model.
+            priority (LlmPriority, optional): The priority of the call.
+                Defaults to LlmPriority.preprocessing.
+
+        Yields:
+            None: Control to the LLM call.
+
+        Raises:
+            OverloadedError: If the call waited too long.
+        """
+        queue = self._queue(model)
+        await self._acquire(queue, priority)
+        try:
+            yield
+        finally:
+            self._release(queue)
+
+    def succeeded(self, model: str) -> None:
+        """Raises the concurrency limit of a model after a successful call.
+
+        Args:
+            model (str): The name of the model.
+        """
+        queue = self._queue(model)
+        if queue.limit < queue.max_limit:
+            queue.limit = min(queue.limit + 1 / queue.limit, queue.max_limit)
+            LLM_CONCURRENCY_LIMIT.labels(model).set(int(queue.limit))
+            self._dispatch(queue)
+
+    def rate_limited(
+        self, model: str, retry_after: Optional[float], attempt: int
+    ) -> None:
+        """Backs off after a rate limit response of a model.
+
+        Halves the concurrency limit and pauses the model for `retry_after`
+        seconds, or for an exponential backoff if the API did not send one.
+
+        Args:
+            model (str): The name of the model.
+            retry_after (Optional[float]): The Retry-After time of the response.
+            attempt (int): The number of previous attempts of the call.
+        """
+        queue = self._queue(model)
+        LLM_RATE_LIMITED.labels(model).inc()
+        queue.limit = max(queue.limit / 2, 1.0)
+        LLM_CONCURRENCY_LIMIT.labels(model).set(int(queue.limit))
+        if retry_after is None:
+            retry_after = self.rate_limit_backoff_s * 2**attempt
+        queue.paused_until = max(queue.paused_until, time.monotonic() + retry_after)
+        logger.warning(f"{model} is rate limited, pausing for {retry_after:.1f}s.")
+
+    def _queue(self, model: str) -> _ModelQueue:
+        """Returns the queue of a model, creating it on first use.
+
+        Args:
+            model (str): The name of the model.
+
+        Returns:
+            _ModelQueue: The queue of the model.
+        """
+        if model not in self._queues:
+            limit = self.model_concurrency.get(model, self.max_concurrency)
+            self._queues[model] = _ModelQueue(model, limit)
+        return self._queues[model]
+
+    async def _acquire(self, queue: _ModelQueue, priority: LlmPriority) -> None:
+        """Waits for a slot of a model.
+
+        Args:
+            queue (_ModelQueue): The queue of the model.
+            priority (LlmPriority): The priority of the call.
+
+        Raises:
+            OverloadedError: If the call waited too long.
+        """
+        start = time.perf_counter()
+        if not queue.n_waiting and queue.active < queue.capacity():
+            queue.active += 1
+            self._started(queue, priority, start)
+            return
+        future = asyncio.get_running_loop().create_future()
+        queue.push(priority, current_thread_id.get(), future)
+        self._dispatch(queue)
+        try:
+            await asyncio.wait_for(future, self.queue_timeout_s)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as exc:
+            if future.done() and not future.cancelled():
+                # Got the slot while timing out or being cancelled
+                self._release(queue)
+            else:
+                queue.discard(future)
+            if isinstance(exc, asyncio.TimeoutError):
+                LLM_REJECTED.labels(queue.model, "timeout").inc()
+                raise OverloadedError(
+                    f"Waited too long for {queue.model}, try again later.",
+                    self._retry_after(queue),
+                ) from None
+            raise
+        # The slot was taken for the call by `_dispatch`
+        self._started(queue, priority, start)
+
+    @staticmethod
+    def _started(queue: _ModelQueue, priority: LlmPriority, start: float) -> None:
+        """Records a call that got a slot.
+
+        Args:
+            queue (_ModelQueue): The queue of the model.
+            priority (LlmPriority): The priority of the call.
+            start (float): When the call started waiting.
+        """
+        LLM_ACTIVE_CALLS.labels(queue.model).set(queue.active)
+        LLM_QUEUE_TIME.labels(queue.model, priority.value).observe(
+            time.perf_counter() - start
+        )
+
+    def _release(self, queue: _ModelQueue) -> None:
+        """Frees a slot and hands it to the next waiting call.
+
+        Args:
+            queue (_ModelQueue): The queue of the model.
+        """
+        queue.active -= 1
+        LLM_ACTIVE_CALLS.labels(queue.model).set(queue.active)
+        self._dispatch(queue)
+
+    def _dispatch(self, queue: _ModelQueue) -> None:
+        """Hands free slots to waiting calls.
+
+        If the model is paused, dispatching is resumed once the pause ends.
+
+        Args:
+            queue (_ModelQueue): The queue of the model.
+        """
+        while queue.active < queue.capacity():
+            future = queue.pop()
+            if future is None:
+                return
+            if future.done():
+                continue
+            queue.active += 1
+            future.set_result(None)
+
+        pause = queue.paused_until - time.monotonic()
+        if queue.n_waiting and pause > 0 and queue.resume is None:
+
+            def resume() -> None:
+                queue.resume = None
+                self._dispatch(queue)
+
+            loop = asyncio.get_running_loop()
+            queue.resume = loop.call_later(pause, resume)
+
+    @staticmethod
+    def _retry_after(queue: _ModelQueue) -> int:
+        """Estimates when a rejected request may be retried.
+
+        Args:
+            queue (_ModelQueue): The queue of the model.
+
+        Returns:
+            int: Seconds until the model resumes after a pause, at least 1.
+        """
+        return max(math.ceil(queue.paused_until - time.monotonic()), 1)
+
+
+def retry_after(error: httpx.HTTPStatusError) -> Optional[float]:
+    """Reads the Retry-After header of an error response.
+
+    Args:
+        error (httpx.HTTPStatusError): The error.
+
+    Returns:
+        Optional[float]: Seconds to wait, None if the header is missing.
+    """
+    value = error.response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_rate_limited(error: Exception) -> bool:
+    """Checks if an LLM call failed because of a rate limit.
+
+    Args:
+        error (Exception): The error of the call.
+
+    Returns:
+        bool: True for 429 responses.
+    """
+    return (
+        isinstance(error, httpx.HTTPStatusError)
+        and error.response.status_code == httpx.codes.TOO_MANY_REQUESTS
+    )
+
+
+llm_scheduler = LlmScheduler()
+
+
+class ScheduledChatMistralAI(ChatMistralAI):
+    """Mistral chat model whose async calls go through the LLM scheduler.
+
+    Rate limited calls are retried once the model resumes. Streamed calls
+    are only retried if the rate limit response came before the first chunk.
+
+    Attributes:
+        priority (LlmPriority): The priority of the model's calls.
+    """
+
+    priority: LlmPriority = LlmPriority.preprocessing
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: Optional[list[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        stream: Optional[bool] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if stream if stream is not None else self.streaming:
+            # Scheduled by `_astream`
+            return await super()._agenerate(
+                messages, stop, run_manager, stream=stream, **kwargs
+            )
+        attempt = 0
+        while True:
+            async with llm_scheduler.slot(self.model, self.priority):
+                try:
+                    result = await super()._agenerate(
+                        messages, stop, run_manager, stream=False, **kwargs
+                    )
+                    llm_scheduler.succeeded(self.model)
+                    return result
+                except httpx.HTTPStatusError as exc:
+                    if not self._back_off(exc, attempt):
+                        raise
+            attempt += 1
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: Optional[list[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        attempt = 0
+        while True:
+            streamed = False
+            async with llm_scheduler.slot(self.model, self.priority):
+                try:
+                    async for chunk in super()._astream(
+                        messages, stop, run_manager, **kwargs
+                    ):
+                        streamed = True
+                        yield chunk
+                    llm_scheduler.succeeded(self.model)
+                    return
+                except httpx.HTTPStatusError as exc:
+                    if streamed or not self._back_off(exc, attempt):
+                        raise
+            attempt += 1
+
+    def _back_off(self, error: httpx.HTTPStatusError, attempt: int) -> bool:
+        """Reports a failed call to the scheduler if it was rate limited.
+
+        Args:
+            error (httpx.HTTPStatusError): The error of the call.
+            attempt (int): The number of previous attempts of the call.
+
+        Returns:
+            bool: True if the call should be retried.
+        """
+        if not is_rate_limited(error):
+            return False
+        llm_scheduler.rate_limited(self.model, retry_after(error), attempt)
+        return attempt < llm_scheduler.rate_limit_retries
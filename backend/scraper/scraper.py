@@ -5,7 +5,6 @@ from typing import Any, List, Tuple
 import bs4
 import httpx
 from bs4 import BeautifulSoup, SoupStrainer
-from sqlalchemy import select
 from tqdm import tqdm
 
 from database.database import Database
@@ -229,8 +228,7 @@ class NarutoWikiScraper:
         This method checks the database for existing characters. If none are found,
         it fetches all characters from the Naruto Wiki and stores them in the database.
         """
-        character_count = self.db.session.exec(select(Character)).all()
-        if len(character_count) == 0:
+        if not self.db.exists(Character):
             characters = await self.fetch_all_characters()
             self.db.session.bulk_save_objects(characters)
             self.db.session.commit()
@@ -0,0 +1,23 @@
+from pathlib import Path
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from database.database import Database
+from utils.tracing import tracer
+
+
+def test_failed_query_ends_its_span(tmp_path: Path) -> None:
+    """A failing query ends its span with the error and is not left open."""
+    db = Database(str(tmp_path / "database.sqlite3"))
+
+    with db.engine.connect() as connection:
+        with pytest.raises(OperationalError):
+            with tracer.span("test.failed_query"):
+                connection.execute(text("SELECT * FROM missing"))
+        assert connection.info["query_start"] == []
+
+    trace = tracer.recent(1)[0]
+    assert [span["name"] for span in trace] == ["sqlite.query", "test.failed_query"]
+    assert "no such table: missing" in trace[0]["error"]
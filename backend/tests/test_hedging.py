@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+from llm.hedging import Hedger
+
+STAGE = "characterize_user"
+
+
+def _hedger() -> Hedger:
+    """Creates a Hedger hedging calls slower than its recent ones.
+
+    Returns:
+        Hedger: The hedger, with latencies of a few milliseconds recorded.
+    """
+    hedger = Hedger(enabled=True, quantile=0.5, min_samples=2)
+    for latency in (0.01, 0.01, 0.01):
+        hedger._record(STAGE, latency)
+    return hedger
+
+
+async def _race(latencies: list[float]) -> tuple[str, list[str], float]:
+    """Runs a hedged call whose attempts take the given latencies.
+
+    Args:
+        latencies (list[float]): The latency of the primary call and of the
+            duplicate, in seconds.
+
+    Returns:
+        tuple[str, list[str], float]: The result, the cancelled attempts
+            and how long the call took.
+    """
+    names = iter(["primary", "hedge"])
+    cancelled: list[str] = []
+
+    async def call() -> str:
+        name = next(names)
+        try:
+            await asyncio.sleep(latencies[0 if name == "primary" else 1])
+        except asyncio.CancelledError:
+            cancelled.append(name)
+            raise
+        return name
+
+    start = time.monotonic()
+    result = await _hedger().run(STAGE, call)
+    await asyncio.sleep(0)
+    return result, cancelled, time.monotonic() - start
+
+
+def test_run_returns_the_faster_duplicate() -> None:
+    """A slow primary call loses to its duplicate, which is returned."""
+    result, cancelled, duration = asyncio.run(_race([5.0, 0.05]))
+
+    assert result == "hedge"
+    assert cancelled == ["primary"]
+    assert duration < 1.0
+
+
+def test_run_returns_the_faster_primary() -> None:
+    """A primary call finishing before its duplicate is returned."""
+    result, cancelled, duration = asyncio.run(_race([0.1, 5.0]))
+
+    assert result == "primary"
+    assert cancelled == ["hedge"]
+    assert duration < 1.0
@@ -0,0 +1,53 @@
+import asyncio
+from typing import Optional
+
+from prometheus_client import REGISTRY
+
+from datamodels.enums import PreprocessingStep
+from llm.llm_workflow import LlmWorkflow
+from llm.policy import PreprocessingPolicy
+
+DEADLINE = 0.1
+
+
+def _deadlines_missed(step: PreprocessingStep) -> float:
+    """Reads how often a preprocessing step missed its deadline.
+
+    Args:
+        step (PreprocessingStep): The preprocessing step.
+
+    Returns:
+        float: The count of the step's 'deadline' decisions.
+    """
+    value = REGISTRY.get_sample_value(
+        "chat_preprocessing_steps_total",
+        {"step": step.value, "decision": "deadline"},
+    )
+    return value or 0.0
+
+
+def test_call_with_deadline_gives_up_on_overrunning_call() -> None:
+    """A call overrunning its step's deadline returns None and is counted."""
+    step = PreprocessingStep.characterize_user
+    # The deadline only needs the policy, not the character or its graph
+    workflow = LlmWorkflow.__new__(LlmWorkflow)
+    workflow.policy = PreprocessingPolicy(characterize_deadline_s=DEADLINE)
+    cancelled = False
+
+    async def call() -> str:
+        nonlocal cancelled
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        return "too late"
+
+    before = _deadlines_missed(step)
+    result: Optional[str] = asyncio.run(
+        asyncio.wait_for(workflow._call_with_deadline(step, call), 2)
+    )
+
+    assert result is None
+    assert cancelled
+    assert _deadlines_missed(step) == before + 1
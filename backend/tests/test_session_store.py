@@ -0,0 +1,57 @@
+import threading
+from pathlib import Path
+
+from database.session_store import Session, SqliteSessionStore
+
+
+def test_stores_on_one_file_see_each_others_writes(tmp_path: Path) -> None:
+    """Two workers' stores on one file share sessions, messages and locks."""
+    db_file = str(tmp_path / "sessions.sqlite3")
+    first, second = SqliteSessionStore(db_file), SqliteSessionStore(db_file)
+
+    first.update("thread", 1, lambda session: {"answer": "Hi"}, [{"text": "Hi"}])
+    assert second.load("thread", 1) == {"answer": "Hi"}
+
+    second.update(
+        "thread", 1, lambda session: {**session, "answer": "Bye"}, [{"text": "Bye"}]
+    )
+    assert first.load("thread", 1) == {"answer": "Bye"}
+    assert [message for _, message in first.messages("thread", 1)] == [
+        {"text": "Hi"},
+        {"text": "Bye"},
+    ]
+    assert first.version("thread", 1) == second.version("thread", 1) > 0
+    assert second.character_ids("thread") == [1]
+
+    with first.lock("embeddings:1") as acquired:
+        assert acquired
+        assert second.acquire("embeddings:1", 0.0, 60.0) is None
+    token = second.acquire("embeddings:1", 0.0, 60.0)
+    assert token is not None
+    second.release("embeddings:1", token)
+
+    second.delete("thread", 1)
+    assert first.load("thread", 1) is None
+    assert first.messages("thread", 1) == []
+
+
+def test_concurrent_updates_of_two_stores_are_not_lost(tmp_path: Path) -> None:
+    """Concurrent read-modify-write updates of two stores are serialized."""
+    db_file = str(tmp_path / "sessions.sqlite3")
+    stores = [SqliteSessionStore(db_file), SqliteSessionStore(db_file)]
+
+    def increment(session: Session) -> Session:
+        return {"count": session.get("count", 0) + 1}
+
+    def work(store: SqliteSessionStore) -> None:
+        for _ in range(50):
+            store.update("thread", 1, increment, [{"text": "turn"}])
+
+    threads = [threading.Thread(target=work, args=(store,)) for store in stores]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert stores[0].load("thread", 1) == {"count": 100}
+    assert len(stores[1].messages("thread", 1)) == 100
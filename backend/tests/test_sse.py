@@ -0,0 +1,85 @@
+import asyncio
+import time
+from typing import Any, AsyncGenerator, Optional
+
+from app.sse import EventStream, FlushPolicy
+from datamodels.enums import StreamEvent
+
+POLL_INTERVAL = 0.1
+# Scheduling slack on top of the poll interval
+TOLERANCE = 0.05
+
+
+class FakeRequest:
+    """Request stub whose client disconnects when told to."""
+
+    def __init__(self) -> None:
+        """Initializes a connected request."""
+        self.disconnected = False
+
+    async def is_disconnected(self) -> bool:
+        """Checks if the client disconnected.
+
+        Returns:
+            bool: True once the client disconnected.
+        """
+        return self.disconnected
+
+
+class SlowProducer:
+    """Event producer yielding one token, then waiting for a slow LLM."""
+
+    def __init__(self) -> None:
+        """Initializes the SlowProducer."""
+        self.cancelled_at: Optional[float] = None
+
+    async def events(self) -> AsyncGenerator[tuple[StreamEvent, Any], None]:
+        """Yields a token, then blocks until cancelled.
+
+        Yields:
+            tuple[StreamEvent, Any]: The token event.
+        """
+        yield StreamEvent.token, {"text": "Believe it"}
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            self.cancelled_at = time.monotonic()
+            raise
+        yield StreamEvent.token, {"text": "!"}
+
+
+async def _disconnect_after_first_chunk() -> tuple[list[str], float, SlowProducer]:
+    """Reads the first chunk of a stream, then disconnects its client.
+
+    Returns:
+        tuple[list[str], float, SlowProducer]: The received chunks, when the
+            client disconnected and the producer.
+    """
+    request = FakeRequest()
+    producer = SlowProducer()
+    stream = EventStream(
+        request,  # type: ignore[arg-type]
+        producer.events(),
+        heartbeat_interval=60,
+        disconnect_poll_interval=POLL_INTERVAL,
+        flush_policy=FlushPolicy(max_bytes=0),
+    )
+    chunks = []
+    disconnected_at = 0.0
+    async for chunk in stream.stream():
+        chunks.append(chunk)
+        if not request.disconnected:
+            request.disconnected = True
+            disconnected_at = time.monotonic()
+    return chunks, disconnected_at, producer
+
+
+def test_disconnect_cancels_producer_within_poll_interval() -> None:
+    """A disconnected client cancels the producer within one poll interval."""
+    chunks, disconnected_at, producer = asyncio.run(
+        asyncio.wait_for(_disconnect_after_first_chunk(), 5)
+    )
+
+    assert chunks == ['id: 1\nevent: token\ndata: {"text": "Believe it"}\n\n']
+    assert producer.cancelled_at is not None
+    assert producer.cancelled_at - disconnected_at <= POLL_INTERVAL + TOLERANCE
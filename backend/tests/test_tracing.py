@@ -0,0 +1,37 @@
+import json
+import threading
+from pathlib import Path
+
+from utils.tracing import Tracer
+
+
+def test_traces_are_exported_by_a_background_thread(tmp_path: Path) -> None:
+    """Completed traces are appended to the export file off the calling thread."""
+    export_file = tmp_path / "traces.jsonl"
+    tracer = Tracer(export_file=str(export_file))
+
+    for name in ("first", "second"):
+        with tracer.span(name):
+            with tracer.span(f"{name}.child"):
+                pass
+    exporter = tracer._exporter
+    assert exporter is not None and exporter is not threading.current_thread()
+    tracer.close()
+    assert not exporter.is_alive()
+
+    traces = [json.loads(line) for line in export_file.read_text().splitlines()]
+    assert [[span["name"] for span in trace] for trace in traces] == [
+        ["first.child", "first"],
+        ["second.child", "second"],
+    ]
+
+
+def test_export_errors_do_not_reach_the_span(tmp_path: Path) -> None:
+    """A failing export is logged, ending the span and closing still succeed."""
+    tracer = Tracer(export_file=str(tmp_path / "missing" / "traces.jsonl"))
+
+    with tracer.span("request"):
+        pass
+    tracer.close()
+
+    assert [span["name"] for span in tracer.recent(1)[0]] == ["request"]
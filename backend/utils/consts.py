@@ -7,10 +7,168 @@ dotenv.load_dotenv()
 MISTRAL_EMBED_MODEL = os.environ["MISTRAL_EMBED_MODEL"]
 MISTRAL_LANGUAGE_MODEL_LARGE = os.environ["MISTRAL_LANGUAGE_MODEL_LARGE"]
 MISTRAL_LANGUAGE_MODEL_MEDIUM = os.environ["MISTRAL_LANGUAGE_MODEL_MEDIUM"]
+MISTRAL_BASE_URL = os.environ.get("MISTRAL_BASE_URL", "https://api.mistral.ai/v1")
 
 CURRENT_PATH = os.path.realpath(__file__)
 ROOT_DIR = Path(CURRENT_PATH).parent.parent.absolute()
 LOGS_DIR = str(ROOT_DIR.joinpath("logs"))
-VECTOR_DB_DIR = str(ROOT_DIR.joinpath("llm", "vectordb"))
-NARUTO_WIKI_DB_FILE = str(ROOT_DIR.joinpath("database", "database.sqlite3"))
+VECTOR_DB_DIR = os.environ.get(
+    "VECTOR_DB_DIR", str(ROOT_DIR.joinpath("llm", "vectordb"))
+)
+NARUTO_WIKI_DB_FILE = os.environ.get(
+    "NARUTO_WIKI_DB_FILE", str(ROOT_DIR.joinpath("database", "database.sqlite3"))
+)
 NARUTO_WIKI_BASE_URL = "https://naruto.fandom.com"
+
+# Startup warm-up
+WARMUP_PRELOAD_CHARACTERS = int(os.environ.get("WARMUP_PRELOAD_CHARACTERS", 10))
+
+# Background jobs, stored in SQLite and run by every app worker. Failed jobs are
+# retried with an exponential backoff, running jobs renew their lease, after
+# which the job of a crashed worker is started again
+JOBS_DB_FILE = os.environ.get("JOBS_DB_FILE") or str(
+    ROOT_DIR.joinpath("database", "jobs.sqlite3")
+)
+JOBS_CONCURRENCY = int(os.environ.get("JOBS_CONCURRENCY", 2))
+JOBS_MAX_ATTEMPTS = int(os.environ.get("JOBS_MAX_ATTEMPTS", 5))
+JOBS_BACKOFF_S = float(os.environ.get("JOBS_BACKOFF_S", 2.0))
+JOBS_BACKOFF_MAX_S = float(os.environ.get("JOBS_BACKOFF_MAX_S", 300.0))
+JOBS_POLL_INTERVAL_S = float(os.environ.get("JOBS_POLL_INTERVAL_S", 1.0))
+JOBS_LEASE_S = float(os.environ.get("JOBS_LEASE_S", 60.0))
+JOBS_RETENTION_S = float(os.environ.get("JOBS_RETENTION_S", 7 * 24 * 3600.0))
+# Maximum time a chat turn waits for the jobs preparing its character
+JOBS_WAIT_TIMEOUT_S = float(os.environ.get("JOBS_WAIT_TIMEOUT_S", 60.0))
+
+# Server-sent events
+SSE_HEARTBEAT_INTERVAL = float(os.environ.get("SSE_HEARTBEAT_INTERVAL", 15.0))
+SSE_DISCONNECT_POLL_INTERVAL = float(
+    os.environ.get("SSE_DISCONNECT_POLL_INTERVAL", 0.1)
+)
+# Token coalescing, whichever limit is reached first flushes the buffered tokens
+SSE_FLUSH_BYTES = int(os.environ.get("SSE_FLUSH_BYTES", 48))
+SSE_FLUSH_INTERVAL_MS = float(os.environ.get("SSE_FLUSH_INTERVAL_MS", 40.0))
+SSE_FLUSH_ON_SENTENCE = os.environ.get("SSE_FLUSH_ON_SENTENCE", "true") == "true"
+
+# Chat WebSockets, turns in flight per connection and events buffered per
+# connection before the turns wait for the client to read
+WS_MAX_TURNS = int(os.environ.get("WS_MAX_TURNS", 4))
+WS_SEND_QUEUE_SIZE = int(os.environ.get("WS_SEND_QUEUE_SIZE", 64))
+
+# Character reads, cached serialized responses and their HTTP caching lifetime
+CHARACTER_CACHE_SIZE = int(os.environ.get("CHARACTER_CACHE_SIZE", 256))
+CHARACTER_CACHE_MAX_AGE_S = int(os.environ.get("CHARACTER_CACHE_MAX_AGE_S", 60))
+
+# Response compression, smaller bodies are sent as they are
+COMPRESSION_MIN_BYTES = int(os.environ.get("COMPRESSION_MIN_BYTES", 1024))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get("COMPRESSION_GZIP_LEVEL", 6))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get("COMPRESSION_BROTLI_QUALITY", 5))
+# Compressed bodies of responses with an ETag, reused until the ETag changes
+COMPRESSION_CACHE_SIZE = int(os.environ.get("COMPRESSION_CACHE_SIZE", 32))
+
+# Character imports, rows inserted per transaction, rejected rows reported and
+# the maximum size of a row
+IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", 1000))
+IMPORT_MAX_ERRORS = int(os.environ.get("IMPORT_MAX_ERRORS", 100))
+IMPORT_MAX_ROW_BYTES = int(os.environ.get("IMPORT_MAX_ROW_BYTES", 1_000_000))
+
+# Broadcast chats, the maximum number of characters asked at once
+BROADCAST_MAX_CHARACTERS = int(os.environ.get("BROADCAST_MAX_CHARACTERS", 8))
+
+# Tracing, traces are kept in memory and optionally appended to a JSONL file
+TRACES_BUFFER_SIZE = int(os.environ.get("TRACES_BUFFER_SIZE", 200))
+TRACES_FILE = os.environ.get("TRACES_FILE") or None
+
+# Preprocessing policy, which LLM calls run before a response is generated.
+# PREPROCESSING_MIN_HISTORY_MESSAGES=0 and *_EVERY_N_TURNS=1 run them every turn
+PREPROCESSING_MIN_HISTORY_MESSAGES = int(
+    os.environ.get("PREPROCESSING_MIN_HISTORY_MESSAGES", 4)
+)
+PREPROCESSING_CHARACTERIZE_EVERY_N_TURNS = int(
+    os.environ.get("PREPROCESSING_CHARACTERIZE_EVERY_N_TURNS", 3)
+)
+PREPROCESSING_REWRITE_MIN_HISTORY_MESSAGES = int(
+    os.environ.get("PREPROCESSING_REWRITE_MIN_HISTORY_MESSAGES", 2)
+)
+# Characterize the user and rewrite the query with one structured LLM call
+PREPROCESSING_COMBINED = os.environ.get("PREPROCESSING_COMBINED", "false") == "true"
+
+# Speculative retrieval, the vectorDB is searched with the raw input while the
+# query is contextualized. The results are reused if the rewritten query is
+# similar enough (word overlap) or not ready within the timeout
+RETRIEVAL_SPECULATIVE = os.environ.get("RETRIEVAL_SPECULATIVE", "false") == "true"
+RETRIEVAL_REWRITE_TIMEOUT_MS = float(
+    os.environ.get("RETRIEVAL_REWRITE_TIMEOUT_MS", 1500.0)
+)
+RETRIEVAL_REUSE_SIMILARITY = float(os.environ.get("RETRIEVAL_REUSE_SIMILARITY", 0.5))
+
+# Prompt assembly, tokens are counted with a Huggingface tokenizer (name or
+# local tokenizer.json), or estimated from the text length if it is unavailable
+TOKENIZER_MODEL = os.environ.get("TOKENIZER_MODEL", "mistralai/Mixtral-8x7B-v0.1")
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", 6000))
+PROMPT_MEMORY_TOKEN_LIMIT = int(os.environ.get("PROMPT_MEMORY_TOKEN_LIMIT", 400))
+
+# Chat memory, the last messages are kept verbatim and older ones are folded
+# into the chat summary in batches, once the window overflows by a batch
+CHAT_HISTORY_WINDOW_MESSAGES = int(os.environ.get("CHAT_HISTORY_WINDOW_MESSAGES", 8))
+CHAT_HISTORY_FOLD_BATCH_MESSAGES = int(
+    os.environ.get("CHAT_HISTORY_FOLD_BATCH_MESSAGES", 6)
+)
+
+# Semantic response cache, answers are reused for queries of a character whose
+# embeddings are at least this similar (cosine), per coarse user-profile bucket
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "false") == "true"
+RESPONSE_CACHE_SIMILARITY = float(os.environ.get("RESPONSE_CACHE_SIMILARITY", 0.95))
+RESPONSE_CACHE_TTL_S = float(os.environ.get("RESPONSE_CACHE_TTL_S", 3600.0))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 1000))
+
+# Query embeddings, cached by normalized query text. Concurrent queries are
+# embedded with one API call, gathered for up to the wait time or batch size
+QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get("QUERY_EMBEDDING_CACHE_SIZE", 1024))
+EMBEDDING_BATCH_MAX_SIZE = int(os.environ.get("EMBEDDING_BATCH_MAX_SIZE", 16))
+EMBEDDING_BATCH_MAX_WAIT_MS = float(os.environ.get("EMBEDDING_BATCH_MAX_WAIT_MS", 5.0))
+
+# LLM scheduler, concurrent calls per model (overrides per model, e.g.
+# "mistral-large-latest=4,mistral-small=16"), queued calls per model before
+# requests are rejected, and the maximum time a call waits in the queue
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 32))
+LLM_MODEL_CONCURRENCY = {
+    model.strip(): int(limit)
+    for model, _, limit in (
+        item.partition("=")
+        for item in os.environ.get("LLM_MODEL_CONCURRENCY", "").split(",")
+        if item.strip()
+    )
+}
+LLM_MAX_QUEUE = int(os.environ.get("LLM_MAX_QUEUE", 64))
+LLM_QUEUE_TIMEOUT_S = float(os.environ.get("LLM_QUEUE_TIMEOUT_S", 30.0))
+# Rate limited (429) calls are retried after Retry-After or an exponential backoff
+LLM_RATE_LIMIT_RETRIES = int(os.environ.get("LLM_RATE_LIMIT_RETRIES", 3))
+LLM_RATE_LIMIT_BACKOFF_S = float(os.environ.get("LLM_RATE_LIMIT_BACKOFF_S", 1.0))
+
+# Deadlines of the preprocessing LLM calls, after which the previous results
+# are reused (0 disables a deadline), and the HTTP timeout of all LLM calls
+PREPROCESSING_CHARACTERIZE_DEADLINE_S = float(
+    os.environ.get("PREPROCESSING_CHARACTERIZE_DEADLINE_S", 8.0)
+)
+PREPROCESSING_CONTEXTUALIZE_DEADLINE_S = float(
+    os.environ.get("PREPROCESSING_CONTEXTUALIZE_DEADLINE_S", 4.0)
+)
+CHAT_HISTORY_FOLD_DEADLINE_S = float(
+    os.environ.get("CHAT_HISTORY_FOLD_DEADLINE_S", 30.0)
+)
+LLM_TIMEOUT_S = int(os.environ.get("LLM_TIMEOUT_S", 60))
+# Hedging, slow preprocessing calls are raced against a duplicate once they
+# take longer than this quantile of the recent latencies of their stage
+LLM_HEDGING = os.environ.get("LLM_HEDGING", "false") == "true"
+LLM_HEDGE_QUANTILE = float(os.environ.get("LLM_HEDGE_QUANTILE", 0.95))
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get("LLM_HEDGE_MIN_SAMPLES", 20))
+
+# Session store, the conversations shared by all workers ('sqlite' or 'memory',
+# which only works with a single worker)
+SESSION_STORE = os.environ.get("SESSION_STORE", "sqlite")
+SESSION_DB_FILE = os.environ.get("SESSION_DB_FILE") or str(
+    ROOT_DIR.joinpath("database", "sessions.sqlite3")
+)
+SESSION_LOCK_POLL_S = float(os.environ.get("SESSION_LOCK_POLL_S", 0.05))
+# Maximum time a worker waits for another one to create a character's embeddings
+EMBEDDING_LOCK_TIMEOUT_S = float(os.environ.get("EMBEDDING_LOCK_TIMEOUT_S", 60.0))
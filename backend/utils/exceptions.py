@@ -39,3 +39,31 @@ class EmbeddingsNotCreatedError(HTTPException):
         """
         self.message = detail
         super(HTTPException, self).__init__(HTTPStatus.INTERNAL_SERVER_ERROR, detail)
+
+
+class OverloadedError(HTTPException):
+    """Exception raised when the LLM calls of a request cannot be admitted.
+
+    E.g. when too many LLM calls are already waiting for a model, or
+    when a call waited longer than the queue timeout.
+
+    Attributes:
+        message (str): A detailed description of the error.
+        retry_after (int): Seconds after which the client may retry.
+    """
+
+    def __init__(self, detail: str, retry_after: int = 1):
+        """Initializes OverloadedError with a detail message.
+
+        Args:
+            detail (str): The error message.
+            retry_after (int, optional): Seconds after which the client may
+                retry, sent as Retry-After header. Defaults to 1.
+        """
+        self.message = detail
+        self.retry_after = retry_after
+        super(HTTPException, self).__init__(
+            HTTPStatus.SERVICE_UNAVAILABLE,
+            detail,
+            headers={"Retry-After": str(retry_after)},
+        )
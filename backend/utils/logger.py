@@ -3,6 +3,7 @@ import logging.handlers
 import os
 
 from utils.consts import LOGS_DIR
+from utils.tracing import TraceIdFilter
 
 
 def get_logger(
@@ -34,11 +35,12 @@ def get_logger(
     )
     file_handler.setLevel(level)
 
-    # Create a logging format
+    # Create a logging format, including the ID of the current trace
     formatter = logging.Formatter(
-        "%(asctime)s | %(levelname)-5s | %(name)s | %(message)s"
+        "%(asctime)s | %(levelname)-5s | %(name)s | %(trace_id)s | %(message)s"
     )
     file_handler.setFormatter(formatter)
+    file_handler.addFilter(TraceIdFilter())
 
     # Add the handlers to the logger if not already added
     if not logger.handlers:
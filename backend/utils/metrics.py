@@ -0,0 +1,198 @@
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from prometheus_client import Counter, Gauge, Histogram
+
+STAGE_LATENCY = Histogram(
+    "chat_stage_duration_seconds",
+    "Duration of the stages of a chat turn.",
+    ["stage"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+DB_QUERY_LATENCY = Histogram(
+    "sqlite_query_duration_seconds",
+    "Duration of SQLite queries.",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1, 0.5),
+)
+SESSION_STORE_LATENCY = Histogram(
+    "session_store_duration_seconds",
+    "Duration of session store operations.",
+    ["operation"],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1, 0.5),
+)
+CONDITIONAL_REQUESTS = Counter(
+    "http_conditional_requests_total",
+    "Requests with If-None-Match, by whether the client's response was current.",
+    ["route", "result"],
+)
+VERSIONED_CACHE = Counter(
+    "versioned_cache_requests_total",
+    "Lookups of cached responses, 'stale' entries were of an older version.",
+    ["cache", "result"],
+)
+COMPRESSED_RESPONSES = Counter(
+    "http_compressed_responses_total",
+    "Responses sent compressed, by content encoding.",
+    ["encoding"],
+)
+COMPRESSION_BYTES = Counter(
+    "http_compression_bytes_total",
+    "Body bytes of compressed responses, before ('raw') and after ('sent').",
+    ["encoding", "stage"],
+)
+LLM_TOKENS = Counter(
+    "llm_tokens_total",
+    "Tokens sent to (input) and generated by (output) the LLMs.",
+    ["model", "direction"],
+)
+AGENTS = Gauge(
+    "llm_agents",
+    "Number of character workflows cached by this worker.",
+)
+EMBEDDING_CACHE = Counter(
+    "embedding_cache_requests_total",
+    "Character embedding lookups, a hit means the embeddings were already stored.",
+    ["result"],
+)
+
+PROMPT_TOKENS = Histogram(
+    "chat_prompt_tokens",
+    "Tokens per component of the response prompt, after fitting it into the budget.",
+    ["component"],
+    buckets=(0, 50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000),
+)
+PROMPT_TRIMMED = Counter(
+    "chat_prompt_trimmed_total",
+    "Messages and retrieved chunks left out of the response prompt to fit the budget.",
+    ["component"],
+)
+SPECULATIVE_RETRIEVAL = Counter(
+    "speculative_retrieval_total",
+    "Outcomes of speculative retrieval, the speculative results won if they were "
+    "'reused' or the rewrite ran into a 'timeout' or 'error'.",
+    ["outcome"],
+)
+PREPROCESSING_STEPS = Counter(
+    "chat_preprocessing_steps_total",
+    "Preprocessing steps of chat turns, by whether the policy ran or skipped them.",
+    ["step", "decision"],
+)
+RESPONSE_CACHE = Counter(
+    "response_cache_events_total",
+    "Semantic response cache lookups ('hit', 'miss') and removed entries "
+    "('expired', 'evicted').",
+    ["result"],
+)
+RESPONSE_CACHE_ENTRIES = Gauge(
+    "response_cache_entries",
+    "Number of answers in the semantic response cache.",
+)
+QUERY_EMBEDDING_CACHE = Counter(
+    "query_embedding_cache_requests_total",
+    "Query embedding lookups, 'joined' requests waited for the same query "
+    "being embedded.",
+    ["result"],
+)
+EMBEDDING_BATCH_SIZE = Histogram(
+    "query_embedding_batch_size",
+    "Queries embedded per API call.",
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+EMBEDDING_BATCH_WAIT = Histogram(
+    "query_embedding_batch_wait_seconds",
+    "Time from the first query of a batch until it is sent to the API.",
+    buckets=(0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1),
+)
+
+LLM_QUEUE_TIME = Histogram(
+    "llm_queue_seconds",
+    "Time LLM calls waited for a slot in the scheduler.",
+    ["model", "priority"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+LLM_QUEUE_DEPTH = Gauge(
+    "llm_queue_depth",
+    "LLM calls waiting for a slot in the scheduler.",
+    ["model"],
+)
+LLM_ACTIVE_CALLS = Gauge(
+    "llm_active_calls",
+    "LLM calls holding a slot in the scheduler.",
+    ["model"],
+)
+LLM_CONCURRENCY_LIMIT = Gauge(
+    "llm_concurrency_limit",
+    "Adaptive concurrency limit per model, halved on rate limit responses.",
+    ["model"],
+)
+LLM_RATE_LIMITED = Counter(
+    "llm_rate_limited_total",
+    "Rate limit (429) responses of the LLM API.",
+    ["model"],
+)
+LLM_REJECTED = Counter(
+    "llm_rejected_total",
+    "LLM calls rejected by the scheduler, because the queue was full or the "
+    "call waited too long.",
+    ["model", "reason"],
+)
+
+LLM_HEDGED = Counter(
+    "llm_hedged_calls_total",
+    "Hedged LLM calls, by whether the 'primary' call or the 'hedge' won.",
+    ["stage", "winner"],
+)
+IMPORTED_ROWS = Counter(
+    "character_import_rows_total",
+    "Rows of character imports, by whether they were 'imported' or 'rejected'.",
+    ["result"],
+)
+IMPORT_BATCH_DURATION = Histogram(
+    "character_import_batch_seconds",
+    "Time to validate and insert a batch of imported characters.",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+
+JOBS = Counter(
+    "jobs_total",
+    "Background jobs, by kind and by what happened to them.",
+    ["kind", "result"],
+)
+JOBS_RUNNING = Gauge(
+    "jobs_running",
+    "Background jobs running in this worker.",
+    ["kind"],
+)
+JOB_DURATION = Histogram(
+    "job_duration_seconds",
+    "Duration of background job attempts.",
+    ["kind"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900),
+)
+WS_CONNECTIONS = Gauge(
+    "chat_websocket_connections",
+    "Number of open chat WebSocket connections of this worker.",
+)
+WS_TURNS = Counter(
+    "chat_websocket_turns_total",
+    "Chat turns received over WebSockets, by how they ended.",
+    ["result"],
+)
+
+
+@contextmanager
+def observe_stage(stage: str) -> Iterator[None]:
+    """Measures the duration of a chat turn stage.
+
+    Args:
+        stage (str): The name of the stage.
+
+    Yields:
+        None: Control to the measured block.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(stage).observe(time.perf_counter() - start)
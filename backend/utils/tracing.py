@@ -0,0 +1,282 @@
+import json
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator, Optional
+from uuid import uuid4
+
+from utils.consts import TRACES_BUFFER_SIZE, TRACES_FILE
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+# `utils.logger` imports this module, the logger is configured there
+logger = logging.getLogger("default")
+
+
+class Span:
+    """A timed operation within a trace.
+
+    Attributes:
+        name (str): The name of the operation.
+        trace_id (str): The ID of the trace the span belongs to.
+        span_id (str): The ID of the span.
+        parent_id (Optional[str]): The ID of the parent span, None for roots.
+        attributes (dict[str, Any]): Additional information about the operation.
+        start (float): The start time as UNIX timestamp.
+        duration_ms (Optional[float]): The duration, None while the span is open.
+        error (Optional[str]): The error that ended the span, if any.
+    """
+
+    def __init__(
+        self, name: str, parent: Optional["Span"], attributes: dict[str, Any]
+    ) -> None:
+        """Starts a span.
+
+        Args:
+            name (str): The name of the operation.
+            parent (Optional[Span]): The parent span, None to start a new trace.
+            attributes (dict[str, Any]): Additional information about the operation.
+        """
+        self.name = name
+        self.trace_id: str = parent.trace_id if parent else uuid4().hex
+        self.span_id = uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration_ms: Optional[float] = None
+        self.error: Optional[str] = None
+        self._perf_start = time.perf_counter()
+        # Spans whose trace was already exported are exported on their own
+        self.is_local_root = True
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        """Sets an attribute of the span.
+
+        Args:
+            key (str): The attribute name.
+            value (Any): The JSON-serializable attribute value.
+        """
+        self.attributes[key] = value
+
+    def to_dict(self) -> dict[str, Any]:
+        """Converts the span into a JSON-serializable dictionary.
+
+        Returns:
+            dict[str, Any]: The span data.
+        """
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration_ms": self.duration_ms,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class Tracer:
+    """Collects spans into traces and keeps the most recent traces in memory.
+
+    A trace is complete once its root span ends. Completed traces are kept
+    in a ring buffer and, if `export_file` is set, appended to it as JSON lines
+    by a background thread, so ending a span never waits for the disk.
+    No external collector is needed.
+
+    Attributes:
+        export_file (Optional[str]): The JSONL file traces are exported to.
+    """
+
+    def __init__(
+        self,
+        buffer_size: int = TRACES_BUFFER_SIZE,
+        export_file: Optional[str] = TRACES_FILE,
+    ) -> None:
+        """Initializes the Tracer.
+
+        Args:
+            buffer_size (int, optional): The number of traces kept in memory.
+                Defaults to TRACES_BUFFER_SIZE.
+            export_file (Optional[str], optional): The JSONL file traces are
+                exported to. Defaults to TRACES_FILE.
+        """
+        self.export_file = export_file
+        self._traces: deque[list[dict[str, Any]]] = deque(maxlen=buffer_size)
+        self._open: dict[str, list[dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+        # Completed traces waiting for the exporter thread, None stops it
+        self._exports: queue.Queue[Optional[list[dict[str, Any]]]] = queue.Queue()
+        self._exporter: Optional[threading.Thread] = None
+
+    @staticmethod
+    def current_span() -> Optional[Span]:
+        """Returns the span of the current context.
+
+        Returns:
+            Optional[Span]: The current span, None outside of any span.
+        """
+        return _current_span.get()
+
+    def start_span(
+        self,
+        name: str,
+        parent: Optional[Span] = None,
+        new_trace: bool = False,
+        **attributes: Any,
+    ) -> Span:
+        """Starts a span without making it the current span.
+
+        Args:
+            name (str): The name of the operation.
+            parent (Optional[Span], optional): The parent span.
+                Defaults to the current span.
+            new_trace (bool, optional): Start a new trace instead of continuing
+                the current one, e.g. for background work outliving a request.
+            **attributes (Any): Additional information about the operation.
+
+        Returns:
+            Span: The started span, which must be ended with `end_span`.
+        """
+        if not new_trace:
+            parent = parent or self.current_span()
+        span = Span(name, parent, attributes)
+        with self._lock:
+            if span.trace_id in self._open and span.parent_id:
+                span.is_local_root = False
+            else:
+                self._open[span.trace_id] = []
+        return span
+
+    def end_span(self, span: Span, error: Optional[BaseException] = None) -> None:
+        """Ends a span and completes its trace if it is the root span.
+
+        Args:
+            span (Span): The span to end.
+            error (Optional[BaseException], optional): The error that ended it.
+        """
+        span.duration_ms = (time.perf_counter() - span._perf_start) * 1000
+        if error is not None:
+            span.error = repr(error)
+        with self._lock:
+            spans = self._open.get(span.trace_id)
+            if spans is None:
+                return
+            spans.append(span.to_dict())
+            if not span.is_local_root:
+                return
+            del self._open[span.trace_id]
+            self._traces.append(spans)
+            if self.export_file:
+                if self._exporter is None:
+                    self._exporter = threading.Thread(
+                        target=self._export,
+                        args=(self._exports,),
+                        name="trace-exporter",
+                        daemon=True,
+                    )
+                    self._exporter.start()
+                self._exports.put(spans)
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Exports the completed traces still queued and stops the exporter.
+
+        Traces completed afterwards are queued for a new exporter.
+
+        Args:
+            timeout (float, optional): The maximum seconds to wait for the
+                export. Defaults to 5.0.
+        """
+        with self._lock:
+            exporter, self._exporter = self._exporter, None
+            exports, self._exports = self._exports, queue.Queue()
+        if exporter is not None:
+            exports.put(None)
+            exporter.join(timeout)
+
+    def _export(self, exports: queue.Queue[Optional[list[dict[str, Any]]]]) -> None:
+        """Appends queued traces to the export file until None is queued.
+
+        Runs in the exporter thread, traces queued meanwhile are written at once.
+
+        Args:
+            exports (queue.Queue[Optional[list[dict[str, Any]]]]): The queue
+                of the completed traces of this exporter.
+        """
+        assert self.export_file is not None
+        stopped = False
+        while not stopped:
+            traces = [exports.get()]
+            while not exports.empty():
+                traces.append(exports.get_nowait())
+            stopped = None in traces
+            try:
+                with open(self.export_file, "a") as file:
+                    for spans in traces:
+                        if spans is not None:
+                            file.write(json.dumps(spans, default=str) + "\n")
+            except OSError as exc:
+                logger.error(f"Failed to export traces to {self.export_file}: {exc}")
+
+    @contextmanager
+    def span(
+        self, name: str, new_trace: bool = False, **attributes: Any
+    ) -> Iterator[Span]:
+        """Runs a block within a new span that is the current span meanwhile.
+
+        Args:
+            name (str): The name of the operation.
+            new_trace (bool, optional): Start a new trace instead of continuing
+                the current one.
+            **attributes (Any): Additional information about the operation.
+
+        Yields:
+            Span: The span, e.g. to set attributes.
+        """
+        span = self.start_span(name, new_trace=new_trace, **attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as exc:
+            self.end_span(span, exc)
+            raise
+        else:
+            self.end_span(span)
+        finally:
+            _current_span.reset(token)
+
+    def recent(self, limit: int = 20) -> list[list[dict[str, Any]]]:
+        """Returns the most recently completed traces.
+
+        Args:
+            limit (int, optional): The maximum number of traces. Defaults to 20.
+
+        Returns:
+            list[list[dict[str, Any]]]: The traces (newest first), each a list
+                of spans in the order they ended.
+        """
+        with self._lock:
+            return list(self._traces)[::-1][:limit]
+
+
+class TraceIdFilter(logging.Filter):
+    """Adds the trace ID of the current span to log records."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        """Sets `record.trace_id`, '-' outside of any span.
+
+        Args:
+            record (logging.LogRecord): The log record.
+
+        Returns:
+            bool: Always True, no record is filtered out.
+        """
+        span = _current_span.get()
+        record.trace_id = span.trace_id if span else "-"
+        return True
+
+
+tracer = Tracer()
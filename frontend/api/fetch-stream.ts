@@ -22,3 +22,51 @@ export async function fetchStream(
 
   return response;
 }
+
+export type StreamEvent = {
+  event: string;
+  data: any;
+};
+
+export async function readEventStream(
+  response: Response,
+  onEvent: (event: StreamEvent) => void,
+): Promise<void> {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder("utf-8");
+  let buffer = "";
+  let done = false;
+
+  while (!done) {
+    const { value, done: readerDone } = await reader.read();
+
+    done = readerDone;
+    buffer += decoder.decode(value, { stream: !done });
+
+    // Events are separated by a blank line
+    let boundary = buffer.indexOf("\n\n");
+
+    while (boundary !== -1) {
+      const block = buffer.slice(0, boundary);
+
+      buffer = buffer.slice(boundary + 2);
+      boundary = buffer.indexOf("\n\n");
+
+      let event = "message";
+      let data = "";
+
+      for (const line of block.split("\n")) {
+        // Lines starting with ":" are keep-alive comments
+        if (line.startsWith("event:")) {
+          event = line.slice(6).trim();
+        } else if (line.startsWith("data:")) {
+          data += line.slice(5).trim();
+        }
+      }
+
+      if (data) {
+        onEvent({ event, data: JSON.parse(data) });
+      }
+    }
+  }
+}
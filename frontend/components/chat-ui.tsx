@@ -15,7 +15,7 @@ import { Character, Message } from "@/types";
 import { ResetIcon, SendIcon } from "@/components/icons";
 import useWindowSize from "@/hooks/use-window-size";
 import { fetchChatHistory } from "@/api/fetch-chat-history";
-import { fetchStream } from "@/api/fetch-stream";
+import { fetchStream, readEventStream } from "@/api/fetch-stream";
 import { ChatUiSkeleton } from "@/components/skeletons/chat-ui";
 import { Sender } from "@/types/enums";
 import { deleteChat } from "@/api/delete-chat";
@@ -65,29 +65,23 @@ export function ChatUi({ character, threadId }: ChatUiProps) {
         newMessage.text,
         character.id,
       );
-      const reader = response.body.getReader();
-      const decoder = new TextDecoder("utf-8");
       let characterMessage = "";
-      let done = false;
 
-      while (!done) {
-        const { value, done: readerDone } = await reader.read();
-
-        done = readerDone;
-
-        if (value) {
-          const chunk = decoder.decode(value, { stream: true });
+      await readEventStream(response, ({ event, data }) => {
+        if (event === "error") {
+          throw new Error(data.message);
+        }
+        if (event !== "token") return;
 
-          characterMessage += chunk;
-          setChat((prevChat) => {
-            const updatedChat = [...prevChat];
+        characterMessage += data.text;
+        setChat((prevChat) => {
+          const updatedChat = [...prevChat];
 
-            updatedChat[updatedChat.length - 1].text = characterMessage;
+          updatedChat[updatedChat.length - 1].text = characterMessage;
 
-            return updatedChat;
-          });
-        }
-      }
+          return updatedChat;
+        });
+      });
     } catch (error) {
       console.error("Error streaming message:", error);
     } finally {